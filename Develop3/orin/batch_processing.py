@@ -0,0 +1,135 @@
+import os
+import multiprocessing
+import numpy as np
+import open3d as o3d
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from extrinsics_store import refine_extrinsics
+
+
+# Per-worker state set once by init_worker, so pipelines and transformations are not resent with every frameset
+worker_state = {}
+
+
+def init_worker(pipelines: list, transformations: list, output_folder: str, refine_voxel_size: float = None,
+                reference_index: int = 0):
+    """
+    Initialises a batch worker process.
+
+    Parameters
+    ----------
+    pipelines : list
+        The depth_pipeline of each camera.
+    transformations : list
+        The 4x4 transformation matrix of each camera into the reference camera's view.
+    output_folder : str
+        Folder to save the reconstructions in.
+    refine_voxel_size : float
+        Voxel size to refine the transformations against each frameset at, see refine_extrinsics. Not refined if None.
+    reference_index : int
+        Index of the reference camera.
+    """
+
+    worker_state["pipelines"] = pipelines
+    worker_state["transformations"] = transformations
+    worker_state["output_folder"] = output_folder
+    worker_state["refine_voxel_size"] = refine_voxel_size
+    worker_state["reference_index"] = reference_index
+
+
+def reconstruct_frameset(frameset_index: int, depth_paths: list) -> str:
+    """
+    Preprocesses the depth frames of one frameset, creates their point clouds, transforms them into the
+    reference camera's view, refining the transformations first if the worker was set up to, and saves the
+    combined point cloud.
+
+    Parameters
+    ----------
+    frameset_index : int
+        Index of the frameset, used in the output file name.
+    depth_paths : list
+        File path of the depth frame of each camera.
+
+    Returns
+    ----------
+    filename : str
+        File path of the saved combined point cloud.
+    """
+
+    point_clouds = [pipeline.run(depth_path, create_point_cloud=True)["pcd"] for pipeline, depth_path in zip(worker_state["pipelines"], depth_paths)]
+
+    transformations = worker_state["transformations"]
+    if worker_state["refine_voxel_size"] is not None:
+        transformations = refine_extrinsics(point_clouds, transformations, worker_state["reference_index"], worker_state["refine_voxel_size"])
+
+    pcd_combined = o3d.geometry.PointCloud()
+    for point_cloud, transformation in zip(point_clouds, transformations):
+        point_cloud.transform(transformation)
+        pcd_combined += point_cloud
+
+    filename = os.path.join(worker_state["output_folder"], "combined_pcd_" + str(frameset_index) + ".ply")
+    o3d.io.write_point_cloud(filename, pcd_combined)
+
+    return filename
+
+
+def reconstruct_framesets(framesets_depth_paths: dict, pipelines: list, transformations: list, output_folder: str,
+                          num_workers: int = None, max_pending: int = None, refine_voxel_size: float = None,
+                          reference_index: int = 0) -> dict:
+    """
+    Reconstructs every given frameset in parallel across a process pool. At most max_pending framesets
+    are queued or in progress at once, so memory use does not grow with the length of the capture.
+
+    Parameters
+    ----------
+    framesets_depth_paths : dict
+        The depth frame file path of each camera, keyed by frameset index.
+    pipelines : list
+        The depth_pipeline of each camera.
+    transformations : list
+        The 4x4 transformation matrix of each camera into the reference camera's view.
+    output_folder : str
+        Folder to save the reconstructions in.
+    num_workers : int
+        Number of worker processes. Defaults to the number of CPUs.
+    max_pending : int
+        Maximum number of framesets queued or in progress. Defaults to twice the number of workers.
+    refine_voxel_size : float
+        Voxel size to refine the transformations against each frameset at, see refine_extrinsics. Not refined if None.
+    reference_index : int
+        Index of the reference camera.
+
+    Returns
+    ----------
+    filenames : dict
+        File path of the saved combined point cloud, keyed by frameset index.
+    """
+
+    num_workers = num_workers or os.cpu_count() or 1
+    max_pending = max_pending or 2 * num_workers
+    transformations = [np.asarray(transformation) for transformation in transformations]
+
+    filenames = {}
+    jobs = iter(framesets_depth_paths.items())
+    # Workers are spawned rather than forked, as forking after Open3D has run its OpenMP code in this process can
+    # deadlock the workers. The pipelines and transformations are pickled to each worker once, by init_worker
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn"),
+                             initializer=init_worker,
+                             initargs=(pipelines, transformations, output_folder, refine_voxel_size, reference_index)) as executor:
+        pending = {}
+        while True:
+            # Keep the queue topped up to max_pending framesets
+            for frameset_index, depth_paths in jobs:
+                pending[executor.submit(reconstruct_frameset, frameset_index, depth_paths)] = frameset_index
+                if len(pending) >= max_pending:
+                    break
+
+            if len(pending) == 0:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                frameset_index = pending.pop(future)
+                filenames[frameset_index] = future.result()
+                print("Frameset " + str(frameset_index) + " reconstructed: " + filenames[frameset_index])
+
+    return filenames
@@ -0,0 +1,542 @@
+import os
+import re
+import numpy as np
+
+
+# Matches capture file names, e.g. raspi1_depth_123.raw, raspi1_colour_metadata_123.txt or raspi1_depth_image_123.png
+CAPTURE_FILENAME_PATTERN = re.compile(r"^(?P<raspi>.+?)_(?P<stream>depth|colour)_(?:(?P<kind>metadata|image)_)?"
+                                      r"(?P<frame_number>\d+)\.(?P<extension>[A-Za-z0-9]+)$")
+
+# Columns of the capture table, one row per file
+CAPTURE_TABLE_DTYPE = np.dtype([("raspi", "U32"),
+                                ("stream", "U6"),
+                                ("kind", "U8"),
+                                ("frame_number", np.int64),
+                                ("extension", "U8"),
+                                ("path", object)])
+
+# Columns of the capture manifest, one row per metadata file
+MANIFEST_DTYPE = np.dtype([("raspi", "U32"),
+                           ("stream", "U6"),
+                           ("frame_number", np.int64),
+                           ("ToAt", np.int64),
+                           ("sensor_timestamp", np.int64),
+                           ("file_size", np.int64)])
+
+
+def read_metadata_file(file_path: str) -> dict:
+    """
+    Reads every metadata attribute from a single metadata .txt file.
+
+    Parameters
+    ----------
+    file_path : str
+        File path of the metadata file.
+
+    Returns
+    ----------
+    metadata : dict
+        The value of each metadata attribute, keyed by attribute name, e.g. "Time Of Arrival".
+    """
+
+    metadata = {}
+    with open(file_path) as fp:
+        # Skip the stream and header lines
+        fp.readline()
+        fp.readline()
+
+        for line in fp:
+            split = line.rstrip().split(",")
+            if len(split) == 2:
+                try:
+                    metadata[split[0]] = int(split[1])
+                except ValueError:
+                    metadata[split[0]] = int(float(split[1]))
+
+    return metadata
+
+
+def get_metadata_column_name(attribute: str) -> str:
+    """
+    Converts a metadata attribute name to a record array column name, e.g. "Time Of Arrival" to "time_of_arrival".
+    """
+
+    return attribute.strip().lower().replace(" ", "_")
+
+
+def load_metadata_files(file_paths: list) -> np.ndarray:
+    """
+    Loads every metadata attribute of many metadata .txt files into one structured record array. The files
+    are read once and their attribute/value pairs are parsed together in a single vectorised pass, by
+    attribute name rather than line number.
+
+    Parameters
+    ----------
+    file_paths : list
+        File paths of the metadata files.
+
+    Returns
+    ----------
+    metadata : np.ndarray
+        Structured array with one row per file and one int64 column per metadata attribute, named by
+        get_metadata_column_name, e.g. metadata["time_of_arrival"]. Attributes missing from a file are -1.
+    """
+
+    # Read every file and keep the number of lines of each so lines can be traced back to their file
+    contents = []
+    line_counts = []
+    for file_path in file_paths:
+        with open(file_path) as fp:
+            lines = fp.read().splitlines()
+        contents.extend(lines)
+        line_counts.append(len(lines))
+
+    if len(contents) == 0:
+        return np.full(len(file_paths), -1, dtype=[("time_of_arrival", np.int64)])
+
+    # Split all "attribute,value" lines at once
+    lines = np.array(contents)
+    file_ids = np.repeat(np.arange(len(file_paths)), line_counts)
+    attributes, _, values = np.char.partition(lines, ",").T
+
+    # Drop the "Stream,<stream>" and "Metadata Attribute,Value" header lines and blank lines
+    is_value = (attributes != "Stream") & (attributes != "Metadata Attribute") & (values != "")
+    attributes = attributes[is_value]
+    values = values[is_value]
+    try:
+        values = values.astype(np.int64)
+    except ValueError:
+        values = values.astype(np.float64).astype(np.int64)
+    file_ids = file_ids[is_value]
+
+    # Scatter the values into one column per attribute
+    attribute_names, attribute_ids = np.unique(attributes, return_inverse=True)
+    columns = np.full((len(attribute_names), len(file_paths)), -1, dtype=np.int64)
+    columns[attribute_ids, file_ids] = values
+
+    metadata = np.empty(len(file_paths), dtype=[(get_metadata_column_name(name), np.int64) for name in attribute_names])
+    for i, name in enumerate(metadata.dtype.names):
+        metadata[name] = columns[i]
+
+    return metadata
+
+
+def get_metadata_column(metadata: np.ndarray, column: str) -> np.ndarray:
+    """
+    Gets one column of a metadata record array, or -1 for every row if no file had that attribute.
+    """
+
+    if column in metadata.dtype.names:
+        return metadata[column]
+
+    return np.full(len(metadata), -1, dtype=np.int64)
+
+
+class capture_table:
+    """
+    Table of every capture file in a capture folder, built with a single directory scan. Each row holds
+    the raspberry pi, stream (depth or colour), kind (frame, metadata or image), frame number, file
+    extension and path of one file. One table is shared by all raspberry pi objects of a capture.
+    """
+
+    def __init__(self, folder_path: str, records: np.ndarray = None):
+        """
+        Constructor. Scans the capture folder once.
+
+        Parameters
+        ----------
+        folder_path : str
+            The folder path containing data collected.
+        records : np.ndarray
+            Rows loaded from a capture manifest. The folder is scanned if not given.
+
+        Returns
+        ----------
+        table : capture_table
+            A capture_table object.
+        """
+
+        self.folder_path = folder_path
+
+        if records is not None:
+            self.records = records
+            return
+
+        rows = []
+        with os.scandir(folder_path) as entries:
+            for entry in entries:
+                match = CAPTURE_FILENAME_PATTERN.match(entry.name)
+                if match is None:
+                    continue
+
+                kind = match.group("kind") or "frame"
+                rows.append((match.group("raspi"), match.group("stream"), kind,
+                             int(match.group("frame_number")), match.group("extension"), entry.path))
+
+        # Sort rows so each raspberry pi, stream and kind is contiguous and in frame number order
+        self.records = np.array(rows, dtype=CAPTURE_TABLE_DTYPE)
+        self.records = self.records[np.lexsort((self.records["frame_number"], self.records["kind"],
+                                                self.records["stream"], self.records["raspi"]))]
+
+    def select(self, raspi_name: str, data_type: str, kind: str = "frame", extension: str = None) -> np.ndarray:
+        """
+        Selects the rows of one raspberry pi, stream and kind.
+
+        Parameters
+        ----------
+        raspi_name : str
+            Name of the raspberry pi object.
+        data_type : str
+            Data type of the files: colour or depth.
+        kind : str
+            Kind of the files: frame, metadata or image.
+        extension : str
+            Only select files with this extension (without the dot), e.g. raw or csv. All extensions if None.
+
+        Returns
+        ----------
+        records : np.ndarray
+            The selected rows, in frame number order.
+        """
+
+        mask = (self.records["raspi"] == raspi_name) & (self.records["stream"] == data_type) & (self.records["kind"] == kind)
+        if extension is not None:
+            mask &= self.records["extension"] == extension.lstrip(".")
+
+        return self.records[mask]
+
+    def get_frame_numbers(self, raspi_name: str, data_type: str, kind: str = "frame", extension: str = None) -> np.ndarray:
+        return self.select(raspi_name, data_type, kind, extension)["frame_number"]
+
+    def count_frames(self, raspi_name: str, data_type: str, kind: str = "frame", extension: str = None) -> int:
+        return len(self.select(raspi_name, data_type, kind, extension))
+
+
+class ToAt_index:
+    """
+    In-memory index of the Time of Arrival timestamps (ToAt) of a capture. Every metadata
+    file is read exactly once and the ToAts are stored per raspberry pi and per stream in
+    NumPy arrays sorted by frame number.
+    """
+
+    def __init__(self, folder_path: str, raspi_names: list, table: capture_table = None, manifest=None):
+        """
+        Constructor. Builds the index with a single pass over the metadata files, or from a capture manifest.
+
+        Parameters
+        ----------
+        folder_path : str
+            The folder path containing data collected.
+        raspi_names : list
+            Names of the raspberry pis to index.
+        table : capture_table
+            Capture table of folder_path. The folder is scanned if not given.
+        manifest : capture_manifest
+            Capture manifest of folder_path. If given, no metadata files are read.
+
+        Returns
+        ----------
+        index : ToAt_index
+            A ToAt_index object.
+        """
+
+        self.folder_path = folder_path
+        self.raspi_names = list(raspi_names)
+
+        self.frame_numbers = {}
+        self.ToAts = {}
+
+        # The manifest already holds the ToAt of every metadata file
+        if manifest is not None:
+            for raspi in self.raspi_names:
+                for data_type in ("depth", "colour"):
+                    frames = manifest.select(raspi, data_type)
+                    self.frame_numbers[(raspi, data_type)] = frames["frame_number"].copy()
+                    self.ToAts[(raspi, data_type)] = frames["ToAt"].copy()
+            return
+
+        if table is None:
+            table = capture_table(folder_path)
+
+        # Read the ToAt of every metadata file, the table rows are already in frame number order
+        for raspi in self.raspi_names:
+            for data_type in ("depth", "colour"):
+                records = table.select(raspi, data_type, "metadata", "txt")
+                metadata = load_metadata_files(records["path"].tolist())
+                self.frame_numbers[(raspi, data_type)] = records["frame_number"].copy()
+                self.ToAts[(raspi, data_type)] = get_metadata_column(metadata, "time_of_arrival")
+
+    def get_frame_numbers(self, raspi_name: str, data_type: str) -> np.ndarray:
+        return self.frame_numbers[(raspi_name, data_type)]
+
+    def get_ToAts(self, raspi_name: str, data_type: str) -> np.ndarray:
+        return self.ToAts[(raspi_name, data_type)]
+
+    def lookup(self, raspi_name: str, data_type: str, frame_numbers) -> np.ndarray:
+        """
+        Looks up the ToAts of the given frame numbers.
+
+        Parameters
+        ----------
+        raspi_name : str
+            Name of the raspberry pi object.
+        data_type : str
+            Data type of the frames: colour or depth.
+        frame_numbers : array_like
+            Frame numbers to look up.
+
+        Returns
+        ----------
+        ToAts : np.ndarray
+            The ToAt of each frame number, -1 where the frame has no metadata.
+        """
+
+        indexed_frame_numbers = self.get_frame_numbers(raspi_name, data_type)
+        indexed_ToAts = self.get_ToAts(raspi_name, data_type)
+        frame_numbers = np.asarray(frame_numbers, dtype=np.int64)
+
+        # Find each frame number in the sorted index
+        positions = np.searchsorted(indexed_frame_numbers, frame_numbers)
+        positions = np.minimum(positions, max(len(indexed_frame_numbers) - 1, 0))
+
+        ToAts = np.full(frame_numbers.shape, -1, dtype=np.int64)
+        if len(indexed_frame_numbers) != 0:
+            found = indexed_frame_numbers[positions] == frame_numbers
+            ToAts[found] = indexed_ToAts[positions[found]]
+
+        return ToAts
+
+    def lookup_valid(self, raspi_name: str, data_type: str, frame_numbers) -> tuple:
+        """
+        Looks up the ToAts of the given frame numbers, leaving out frames that have no metadata. Frame
+        matching needs the ToAts sorted, which a -1 for a missing frame would break.
+
+        Parameters
+        ----------
+        raspi_name : str
+            Name of the raspberry pi object.
+        data_type : str
+            Data type of the frames: colour or depth.
+        frame_numbers : array_like
+            Frame numbers to look up.
+
+        Returns
+        ----------
+        frame_numbers : list
+            The frame numbers that have a ToAt, in the given order.
+        ToAts : np.ndarray
+            The ToAt of each of those frame numbers.
+        """
+
+        frame_numbers = np.asarray(frame_numbers, dtype=np.int64)
+        ToAts = self.lookup(raspi_name, data_type, frame_numbers)
+
+        valid = ToAts >= 0
+        if not valid.all():
+            print("Leaving out " + str(int((~valid).sum())) + " " + data_type + " frames of " + raspi_name +
+                  " with no metadata: " + str(frame_numbers[~valid].tolist()))
+
+        return frame_numbers[valid].tolist(), ToAts[valid]
+
+    def get_ToAt(self, raspi_name: str, data_type: str, frame_number: int) -> int:
+        return int(self.lookup(raspi_name, data_type, [frame_number])[0])
+
+
+def get_manifest_path(folder_path: str) -> str:
+    """
+    Gets the file path of the manifest of a capture folder. The manifest is stored beside the folder,
+    not inside it, so writing it does not change the folder's mtime.
+
+    Parameters
+    ----------
+    folder_path : str
+        The folder path containing data collected.
+
+    Returns
+    ----------
+    manifest_path : str
+        File path of the manifest, e.g. uploads_manifest.npz for uploads/.
+    """
+
+    return os.path.normpath(folder_path) + "_manifest.npz"
+
+
+class capture_manifest:
+    """
+    Compact description of a capture folder: its capture table plus the raspberry pi, stream, frame number,
+    ToAt, sensor timestamp and file size of every frame, and every metadata attribute of every frame. It is
+    saved as a .npz file beside the capture folder so later runs can skip directory scans and metadata parsing.
+    """
+
+    def __init__(self, folder_path: str, table: capture_table = None, frames: np.ndarray = None, folder_mtime: int = None,
+                 metadata: np.ndarray = None):
+        """
+        Constructor. Reads every metadata file once unless the frames are given.
+
+        Parameters
+        ----------
+        folder_path : str
+            The folder path containing data collected.
+        table : capture_table
+            Capture table of folder_path. The folder is scanned if not given.
+        frames : np.ndarray
+            Manifest rows loaded from a manifest file. Built from the metadata files if not given.
+        folder_mtime : int
+            The folder's mtime (ns) when the manifest was built.
+        metadata : np.ndarray
+            Metadata record array loaded from a manifest file, one row per row of frames.
+
+        Returns
+        ----------
+        manifest : capture_manifest
+            A capture_manifest object.
+        """
+
+        self.folder_path = folder_path
+        self.table = table if table is not None else capture_table(folder_path)
+        self.folder_mtime = folder_mtime if folder_mtime is not None else os.stat(folder_path).st_mtime_ns
+
+        if frames is not None:
+            self.frames = frames
+            self.metadata = metadata
+            return
+
+        # Store the size of every frame file so it can be found by (raspi, stream, frame number)
+        file_sizes = {}
+        frame_records = self.table.records[self.table.records["kind"] == "frame"]
+        for raspi, stream, frame_number, path in zip(frame_records["raspi"].tolist(), frame_records["stream"].tolist(),
+                                                     frame_records["frame_number"].tolist(), frame_records["path"].tolist()):
+            file_sizes[(raspi, stream, frame_number)] = os.path.getsize(path)
+
+        # Parse every metadata file in one pass, table records are already sorted by raspi, stream and frame number
+        metadata_records = self.table.records[self.table.records["kind"] == "metadata"]
+        self.metadata = load_metadata_files(metadata_records["path"].tolist())
+
+        self.frames = np.empty(len(metadata_records), dtype=MANIFEST_DTYPE)
+        self.frames["raspi"] = metadata_records["raspi"]
+        self.frames["stream"] = metadata_records["stream"]
+        self.frames["frame_number"] = metadata_records["frame_number"]
+        self.frames["ToAt"] = get_metadata_column(self.metadata, "time_of_arrival")
+        self.frames["sensor_timestamp"] = get_metadata_column(self.metadata, "sensor_timestamp")
+        self.frames["file_size"] = [file_sizes.get(key, -1) for key in zip(metadata_records["raspi"].tolist(),
+                                                                            metadata_records["stream"].tolist(),
+                                                                            metadata_records["frame_number"].tolist())]
+
+    def select(self, raspi_name: str, data_type: str) -> np.ndarray:
+        """
+        Selects the manifest rows of one raspberry pi and stream, in frame number order.
+        """
+
+        return self.frames[(self.frames["raspi"] == raspi_name) & (self.frames["stream"] == data_type)]
+
+    def get_metadata(self, raspi_name: str, data_type: str) -> np.ndarray:
+        """
+        Gets the metadata record array of one raspberry pi and stream, in frame number order. Rows line up
+        with select(raspi_name, data_type).
+        """
+
+        return self.metadata[(self.frames["raspi"] == raspi_name) & (self.frames["stream"] == data_type)]
+
+    def is_current(self) -> bool:
+        """
+        Checks that the capture folder has not changed (no files added, removed or renamed) since the
+        manifest was built.
+        """
+
+        return os.path.isdir(self.folder_path) and os.stat(self.folder_path).st_mtime_ns == self.folder_mtime
+
+    def save(self) -> str:
+        """
+        Saves the manifest beside the capture folder.
+
+        Returns
+        ----------
+        manifest_path : str
+            File path of the saved manifest.
+        """
+
+        manifest_path = get_manifest_path(self.folder_path)
+
+        # Paths are rebuilt from the folder path on load, so they are not stored
+        table_columns = [name for name in CAPTURE_TABLE_DTYPE.names if name != "path"]
+        table_records = np.empty(len(self.table.records), dtype=[(name, CAPTURE_TABLE_DTYPE[name]) for name in table_columns])
+        for name in table_columns:
+            table_records[name] = self.table.records[name]
+
+        with open(manifest_path, "wb") as fp:
+            np.savez(fp, table=table_records, frames=self.frames, metadata=self.metadata, folder_mtime=np.int64(self.folder_mtime))
+
+        return manifest_path
+
+
+def load_capture_manifest(folder_path: str) -> capture_manifest:
+    """
+    Loads the manifest of a capture folder if it exists and the folder has not changed since it was saved.
+
+    Parameters
+    ----------
+    folder_path : str
+        The folder path containing data collected.
+
+    Returns
+    ----------
+    manifest : capture_manifest
+        The loaded manifest, or None if there is no manifest or it is out of date.
+    """
+
+    manifest_path = get_manifest_path(folder_path)
+    if not os.path.isfile(manifest_path):
+        return None
+
+    with np.load(manifest_path) as data:
+        table_records = data["table"]
+        frames = data["frames"]
+        folder_mtime = int(data["folder_mtime"])
+
+        # Manifests saved before the metadata columns were added are rebuilt
+        if "metadata" not in data.files:
+            return None
+        metadata = data["metadata"]
+
+    # Check the manifest against the folder before trusting it
+    if not os.path.isdir(folder_path) or os.stat(folder_path).st_mtime_ns != folder_mtime:
+        return None
+
+    # Rebuild the file paths of the capture table
+    records = np.empty(len(table_records), dtype=CAPTURE_TABLE_DTYPE)
+    for name in table_records.dtype.names:
+        records[name] = table_records[name]
+    paths = []
+    for raspi, stream, kind, frame_number, extension in zip(records["raspi"].tolist(), records["stream"].tolist(), records["kind"].tolist(),
+                                                            records["frame_number"].tolist(), records["extension"].tolist()):
+        if kind == "frame":
+            paths.append(os.path.join(folder_path, f"{raspi}_{stream}_{frame_number}.{extension}"))
+        else:
+            paths.append(os.path.join(folder_path, f"{raspi}_{stream}_{kind}_{frame_number}.{extension}"))
+    records["path"] = paths
+
+    return capture_manifest(folder_path, capture_table(folder_path, records), frames, folder_mtime, metadata)
+
+
+def open_capture_manifest(folder_path: str) -> capture_manifest:
+    """
+    Loads the manifest of a capture folder, or builds and saves it if it is missing or out of date.
+
+    Parameters
+    ----------
+    folder_path : str
+        The folder path containing data collected.
+
+    Returns
+    ----------
+    manifest : capture_manifest
+        The manifest of the capture folder.
+    """
+
+    manifest = load_capture_manifest(folder_path)
+    if manifest is None:
+        manifest = capture_manifest(folder_path)
+        manifest_path = manifest.save()
+        print("Capture manifest saved: " + manifest_path)
+
+    return manifest
@@ -1,113 +1,287 @@
 import os
+import json
 import shutil
 import socket
+import uuid
+import tarfile
+import threading
 import time
 from flask import Flask, request, jsonify
+from werkzeug.serving import make_server
+from depth_codec import DEPTH_CODEC_EXTENSION, decode_depth_file
 import argparse
 
 # Initialise flask server
 app = Flask(__name__)      
+
+# Size of the buffer uploaded files are copied to disk with
+UPLOAD_BUFFER_SIZE = 1024 * 1024
+
+
+class upload_tracker:
+    """
+    Tracks how many files each raspberry pi has uploaded against how many it said it would send. Uploads
+    are handled on several threads at once, so every update takes a lock.
+    """
+    
+    def __init__(self, raspberry_pis: list = None):
+        """
+        Constructor.
+        
+        Parameters
+        ----------
+        raspberry_pis : list
+            Names of the raspberry pis expected to upload. If None, uploads are never complete.
+        
+        Returns
+        ----------
+        tracker : upload_tracker
+            An upload_tracker object.
+        """
+        
+        self.raspberry_pis = raspberry_pis
+        self.received = {}
+        self.expected = {}
+        self.telemetry = {}
+        self.lock = threading.Lock()
+        
+        # Set once every expected raspberry pi has completed its upload
+        self.all_complete = threading.Event()
+        
+    def add_received(self, raspi_name: str, num_files: int):
+        """
+        Adds to the number of files received from a raspberry pi.
+        """
+        
+        with self.lock:
+            self.received[raspi_name] = self.received.get(raspi_name, 0) + num_files
+            self.check_complete()
+        
+    def set_telemetry(self, raspi_name: str, telemetry: dict):
+        """
+        Sets the telemetry a raspberry pi reported for its capture.
+        """
+        
+        with self.lock:
+            self.telemetry[raspi_name] = telemetry
+        
+    def set_expected(self, raspi_name: str, num_files: int):
+        """
+        Sets the number of files a raspberry pi has uploaded in total, once it reports its upload as finished.
+        """
+        
+        with self.lock:
+            self.expected[raspi_name] = num_files
+            self.check_complete()
+            
+    def is_complete(self, raspi_name: str) -> bool:
+        """
+        Checks if every file a raspberry pi reported has been received. Must be called with the lock held.
+        """
+        
+        return raspi_name in self.expected and self.received.get(raspi_name, 0) >= self.expected[raspi_name]
+            
+    def check_complete(self):
+        """
+        Sets all_complete if every expected raspberry pi has completed its upload. Must be called with the lock held.
+        """
+        
+        if self.raspberry_pis is not None and all(self.is_complete(raspi_name) for raspi_name in self.raspberry_pis):
+            self.all_complete.set()
+            
+    def get_incomplete(self) -> list:
+        """
+        Gets the expected raspberry pis that have not completed their upload.
+        """
+        
+        with self.lock:
+            return [raspi_name for raspi_name in (self.raspberry_pis or []) if not self.is_complete(raspi_name)]
+            
+    def get_summary(self) -> dict:
+        """
+        Gets the number of files received and expected from each raspberry pi.
+        """
+        
+        with self.lock:
+            return {raspi_name : {"received" : self.received.get(raspi_name, 0), "expected" : self.expected.get(raspi_name)}
+                    for raspi_name in set(self.received) | set(self.expected) | set(self.raspberry_pis or [])}
+
+
+    def get_report(self) -> dict:
+        """
+        Gets the per-capture report: the upload summary and telemetry of each raspberry pi. Telemetry is None
+        for raspberry pis that sent none.
+        """
+        
+        summary = self.get_summary()
+        with self.lock:
+            return {raspi_name : {"upload" : summary[raspi_name], "telemetry" : self.telemetry.get(raspi_name)}
+                    for raspi_name in sorted(set(summary) | set(self.telemetry))}
+
+
+# Upload tracker of the current capture, replaced by receive_files_from_pis
+tracker = upload_tracker()
+
+
+def print_telemetry(raspi_name: str, telemetry: dict):
+    """
+    Prints a one line summary of a raspberry pi's capture telemetry.
+    """
+    
+    if telemetry is None:
+        print(f"{raspi_name}: no telemetry received")
+        return
+    
+    streams = ", ".join(f"{stream} {info['frames_delivered']}/{telemetry['frames_requested']} frames "
+                        f"({info['frames_missing']} missing in {info['frame_counter_gaps']} gaps)"
+                        for stream, info in telemetry["streams"].items() if info["frames_delivered"] > 0)
+    latency = telemetry["write_latency_ms"]
+    throughput = telemetry["disk_throughput_mb_s"]
+    throttling = telemetry["throttling"]
+    throttled = None if throttling is None else [name for name, value in throttling.items() if value is True]
+    
+    print(f"{raspi_name}: {streams or 'no frames'}, write latency p50/p95/p99 {latency['p50']}/{latency['p95']}/{latency['p99']} ms, "
+          f"disk {'n/a' if throughput is None else f'{throughput:.1f}'} MB/s, CPU {telemetry['cpu_temperature']} C, "
+          f"throttling: {'n/a' if throttled is None else ', '.join(throttled) or 'none'}")
      
 
-def send_command_to_raspis(command: str, capture_duration: int):
+def broadcast_command(command: str, raspberry_pis: list = None, start_delay: float = None, retries: int = 10,
+                      ack_timeout: float = 0.5, parameters: dict = None) -> set:
     """
-    Uses UDP to broadcast commands to Raspberry Pi 5s in the network.
+    Broadcasts a command to the Raspberry Pi 5s and waits for each of them to acknowledge it. The command is
+    resent, with the same id so no pi executes it twice, until every expected pi has acknowledged it or the 
+    retries run out. Every pi starts the command at the same scheduled time, which is after the last copy 
+    can be sent. Pis that still receive the command after its start report it in their acknowledgement.
     
     Parameters
     ----------
-    command: str
-        The type of command to broadcast to raspberry pis.
-    capture_duration: int
-        Duration of capture.
+    command : str
+        The command to broadcast.
+    raspberry_pis : list
+        Names of the raspberry pis expected to acknowledge. If None, it is not known when every pi has the
+        command, so it is resent until the retries run out.
+    start_delay : float
+        Seconds from now that the command is scheduled to start at, by default the time taken to send every 
+        copy plus a second. The raspberry pis' clocks must be synchronised (NTP) with the Orin Nano's.
+    retries : int
+        Maximum number of times the command is resent.
+    ack_timeout : float
+        Seconds to wait for acknowledgements after each broadcast.
+    parameters : dict
+        Parameters of the command, sent with it.
+    
+    Returns
+    ----------
+    acknowledged : set
+        Names of the raspberry pis that acknowledged the command.
     """
+    
     # Broadcast address to send to all devices in the subnet
     BROADCAST_IP = "192.168.249.255"
     
     # Port to broadcast on
     PORT = 5005
-
-    # Create a UDP socket
+    
+    # The start time is fixed on the first broadcast, so every copy schedules the same instant
+    if start_delay is None:
+        start_delay = (retries + 1) * ack_timeout + 1.0
+    start_time = time.time() + start_delay
+    command_id = uuid.uuid4().hex
+    message = json.dumps({"id" : command_id,
+                          "command" : command,
+                          "start_time" : start_time,
+                          "parameters" : parameters or {}}).encode()
+    
+    # Create a UDP socket, the acknowledgements are sent back to it
     sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
     sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-
-    # Store the different capture commands
-    capture_commands = ["CAPTURE_1s",
-                        "CAPTURE_2s",
-                        "CAPTURE_5s",
-                        "CAPTURE_10s",
-                        "CAPTURE_15s",
-                        "CAPTURE_20s",
-                        "CAPTURE_25s",
-                        "CAPTURE_30s",
-                        "CAPTURE_60s",
-                        "CAPTURE_100s"]
     
+    acknowledged = set()
+    late = {}
     try:
-        if command == 'C':
-            if capture_duration == 1:
-                sock.sendto(capture_commands[0].encode(), (BROADCAST_IP, PORT))
-                print(f"Broadcast message sent: {capture_commands[0]}")
-                time.sleep(5)
-                
-            elif capture_duration == 2:
-                sock.sendto(capture_commands[1].encode(), (BROADCAST_IP, PORT))
-                print(f"Broadcast message sent: {capture_commands[1]}")
-                time.sleep(5)
-                
-            elif capture_duration == 5:
-                sock.sendto(capture_commands[2].encode(), (BROADCAST_IP, PORT))
-                print(f"Broadcast message sent: {capture_commands[2]}")
-                time.sleep(5)
-                
-            elif capture_duration == 10:
-                sock.sendto(capture_commands[3].encode(), (BROADCAST_IP, PORT))
-                print(f"Broadcast message sent: {capture_commands[3]}")
-                time.sleep(5)
-                
-            elif capture_duration == 15:
-                sock.sendto(capture_commands[4].encode(), (BROADCAST_IP, PORT))
-                print(f"Broadcast message sent: {capture_commands[4]}")
-                time.sleep(5)
-                
-            elif capture_duration == 20:
-                sock.sendto(capture_commands[5].encode(), (BROADCAST_IP, PORT))
-                print(f"Broadcast message sent: {capture_commands[5]}")
-                time.sleep(5)
-                
-            elif capture_duration == 25:
-                sock.sendto(capture_commands[6].encode(), (BROADCAST_IP, PORT))
-                print(f"Broadcast message sent: {capture_commands[6]}")
-                time.sleep(5)
-                
-            elif capture_duration == 30:
-                sock.sendto(capture_commands[7].encode(), (BROADCAST_IP, PORT))
-                print(f"Broadcast message sent: {capture_commands[7]}")
-                time.sleep(5)
-                
-            elif capture_duration == 60:
-                sock.sendto(capture_commands[8].encode(), (BROADCAST_IP, PORT))
-                print(f"Broadcast message sent: {capture_commands[8]}")
-                time.sleep(5)
-                
-            elif capture_duration == 100:
-                sock.sendto(capture_commands[9].encode(), (BROADCAST_IP, PORT))
-                print(f"Broadcast message sent: {capture_commands[9]}")
-                time.sleep(5)
+        for attempt in range(retries + 1):
+            # A pi receiving a copy after the start would start late
+            if attempt > 0 and time.time() >= start_time:
+                break
+            
+            sock.sendto(message, (BROADCAST_IP, PORT))
+            print(f"Broadcast message sent: {command} (attempt {attempt + 1})")
+            
+            # Collect acknowledgements until the timeout
+            deadline = time.time() + ack_timeout
+            while time.time() < deadline:
+                sock.settimeout(max(deadline - time.time(), 0.001))
+                try:
+                    data, addr = sock.recvfrom(1024)
+                except socket.timeout:
+                    break
                 
-            else:
-                print("Incorrect capture duration received, terminating program...")
-                exit(1)
+                try:
+                    ack = json.loads(data.decode())
+                except ValueError:
+                    continue
+                if isinstance(ack, dict) and ack.get("id") == command_id:
+                    acknowledged.add(ack.get("raspi"))
+                    if ack.get("late", 0) > 0:
+                        late[ack.get("raspi")] = ack["late"]
+                    
+                if raspberry_pis is not None and acknowledged.issuperset(raspberry_pis):
+                    break
             
-        elif command == 'R':
-            reboot_command = "REBOOT"
-            sock.sendto(reboot_command.encode(), (BROADCAST_IP, PORT))
-            print(f"Broadcast message sent: {reboot_command}")
-            time.sleep(5)
+            if raspberry_pis is not None and acknowledged.issuperset(raspberry_pis):
+                break
             
     except KeyboardInterrupt:
         print("Broadcasting stopped.")
     finally:
         sock.close()
+        
+    print("Acknowledged by: " + ", ".join(sorted(acknowledged)))
+    if raspberry_pis is not None and not acknowledged.issuperset(raspberry_pis):
+        print("No acknowledgement from: " + ", ".join(sorted(set(raspberry_pis) - acknowledged)))
+    if len(late) > 0:
+        print("Warning: started late on: " + ", ".join(f"{raspi_name} ({seconds:.2f}s)" for raspi_name, seconds in sorted(late.items())))
+        
+    return acknowledged
+
+
+def send_command_to_raspis(command: str, capture_duration: float, raspberry_pis: list = None, capture_parameters: dict = None) -> set:
+    """
+    Broadcasts commands to Raspberry Pi 5s in the network and waits for them to acknowledge it.
+    
+    Parameters
+    ----------
+    command: str
+        The type of command to broadcast to raspberry pis.
+    capture_duration: float
+        Duration of capture in seconds.
+    raspberry_pis : list
+        Names of the raspberry pis expected to acknowledge the command.
+    capture_parameters : dict
+        Capture settings forwarded to the capture binary: fps, depth_resolution and colour_resolution 
+        ("<width>x<height>"), streams (list of "depth" and "colour"), decimation, spatial, spatial_alpha, 
+        spatial_delta, writers and queue_size. Settings that are not given use the capture binary's defaults.
+    
+    Returns
+    ----------
+    acknowledged : set
+        Names of the raspberry pis that acknowledged the command.
+    """
+    
+    if command == 'C':
+        if capture_duration is None or capture_duration <= 0:
+            print("Incorrect capture duration received, terminating program...")
+            exit(1)
+        
+        parameters = dict(capture_parameters or {})
+        parameters["duration"] = capture_duration
+        
+        return broadcast_command("CAPTURE", raspberry_pis, parameters=parameters)
+        
+    elif command == 'R':
+        return broadcast_command("REBOOT", raspberry_pis)
+    
+    return set()
 
 
 @app.route('/uploads', methods=['POST'])
@@ -123,19 +297,103 @@ def upload_file():
         return jsonify({"error": "No file selected"})
 
     # Save the uploaded file in the uploads directory
-    file_path = os.path.join(app.config['UPLOAD_FOLDER'], file.filename)
-    file.save(file_path)
+    file_path = os.path.join(app.config['UPLOAD_FOLDER'], os.path.basename(file.filename))
+    file.save(file_path, UPLOAD_BUFFER_SIZE)
+    
+    # Filenames start with the name of the raspberry pi that captured them
+    tracker.add_received(request.headers.get("X-Raspi-Name", file.filename.split("_")[0]), 1)
     
     return jsonify({"message": f"File {file.filename} saved at {file_path}"})
 
 
-def receive_files_from_pis():
+@app.route('/uploads/archive', methods=['POST'])
+def upload_archive():
+    """
+    Receives a whole capture from a raspberry pi as one streamed tar archive. The archive is unpacked as it 
+    arrives, each file being written to the uploads directory under its filename. Compressed depth frames 
+    are decompressed back to .raw files.
+    """
+    
+    raspi_name = request.headers.get("X-Raspi-Name", "unknown")
+    num_files = 0
+    
+    # Read the request body as a stream, so the archive is never held in memory
+    with tarfile.open(fileobj=request.stream, mode="r|") as archive:
+        for member in archive:
+            # Only regular files are expected, and they are kept flat in the uploads directory
+            if not member.isfile():
+                continue
+            file_path = os.path.join(app.config['UPLOAD_FOLDER'], os.path.basename(member.name))
+            
+            # Compressed depth frames are saved decompressed, under their original .raw filename
+            if file_path.endswith(DEPTH_CODEC_EXTENSION):
+                decode_depth_file(archive.extractfile(member).read(), file_path[ : len(file_path) - len(DEPTH_CODEC_EXTENSION)])
+            else:
+                with open(file_path, "wb") as file:
+                    shutil.copyfileobj(archive.extractfile(member), file, UPLOAD_BUFFER_SIZE)
+            num_files += 1
+            
+    print(f"Received {num_files} files from {raspi_name}")
+    tracker.add_received(raspi_name, num_files)
+    
+    # The raspberry pi sends the number of files in the archive with it
+    if "X-File-Count" in request.headers:
+        tracker.set_expected(raspi_name, int(request.headers["X-File-Count"]))
+    
+    return jsonify({"message": f"{num_files} files from {raspi_name} saved at {app.config['UPLOAD_FOLDER']}"})
+
+
+@app.route('/uploads/complete', methods=['POST'])
+def upload_complete():
     """
-    Receives the files sent from the raspberry pi 5s. A flask server is created and the program
-    waits for files from the pis. The server is terminated by inputting: Ctrl + C, into the 
-    terminal.
+    Receives the number of files a raspberry pi sent, once it has finished uploading them one per request.
     """
     
+    info = request.get_json()
+    tracker.set_expected(info["raspi"], int(info["file_count"]))
+    
+    return jsonify({"message": f"{info['raspi']} upload complete"})
+
+
+@app.route('/uploads/telemetry', methods=['POST'])
+def upload_telemetry():
+    """
+    Receives the telemetry of a raspberry pi's capture, sent before its upload is complete.
+    """
+    
+    telemetry = request.get_json()
+    tracker.set_telemetry(telemetry["raspi"], telemetry)
+    
+    return jsonify({"message": f"Telemetry from {telemetry['raspi']} received"})
+
+
+def receive_files_from_pis(raspberry_pis: list = None, timeout: float = None) -> dict:
+    """
+    Receives the files sent from the raspberry pi 5s. A threaded server is created, so every pi can upload 
+    at once, and the program waits for files from the pis. The server stops by itself once every pi in 
+    raspberry_pis has reported its upload as complete and all of its files have been received, or once
+    timeout seconds have passed. If raspberry_pis is not given, the server is terminated by inputting: 
+    Ctrl + C, into the terminal.
+    
+    Parameters
+    ----------
+    raspberry_pis : list
+        Names of the raspberry pis expected to upload.
+    timeout : float
+        Seconds to wait for the uploads in total, unlimited if None.
+    
+    Returns
+    ----------
+    report : dict
+        The upload summary and capture telemetry of each raspberry pi, see upload_tracker.get_report.
+    """
+    
+    global tracker
+    
+    if raspberry_pis is not None and len(raspberry_pis) == 0:
+        print("No raspberry pis to receive files from.")
+        return {}
+    
     # Delete previous uploads folder and then create a new one
     UPLOAD_FOLDER = './uploads'
     if os.path.exists(f"uploads"):
@@ -144,9 +402,36 @@ def receive_files_from_pis():
     
     # Tell which folder to use
     app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+    tracker = upload_tracker(raspberry_pis)
+    
+    # Start the server in the background, one thread per request
+    server = make_server('0.0.0.0', 5000, app, threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+    print("Waiting for uploads from " + (", ".join(raspberry_pis) if raspberry_pis else "raspberry pis (Ctrl + C to stop)") + "...")
     
-    # Start Flask server
-    app.run(host='0.0.0.0', port=5000)
+    start = time.time()
+    try:
+        # Wake up regularly so Ctrl + C and the timeout are handled
+        while not tracker.all_complete.wait(1.0):
+            if timeout is not None and time.time() - start >= timeout:
+                break
+        if tracker.all_complete.is_set():
+            print("All uploads complete.")
+        else:
+            print(f"Uploads timed out after {timeout}s, incomplete: " + (", ".join(tracker.get_incomplete()) or "none"))
+    except KeyboardInterrupt:
+        print("Upload server stopped.")
+    finally:
+        server.shutdown()
+        server_thread.join()
+        
+    report = tracker.get_report()
+    for raspi_name, info in report.items():
+        print(f"{raspi_name}: {info['upload']['received']} files received, {info['upload']['expected']} expected")
+        print_telemetry(raspi_name, info["telemetry"])
+        
+    return report
 
 
 
@@ -154,21 +439,58 @@ if __name__ == "__main__":
     parser=argparse.ArgumentParser(description="collect camera data")
     parser.add_argument("mode", choices=['capture', 'reboot'])
     parser.add_argument("--filename")
-    parser.add_argument("--duration", choices=['1', '2', '5', '10', '15', '20', '25', '30', '60', '100'])
+    parser.add_argument("--duration", type=float)
+    parser.add_argument("--raspberry_pis", nargs="*", type=str, default=None,
+                        help="pis expected to acknowledge the command, it is resent until they all have. If not given, it "
+                             "is resent until the retries run out and uploads are awaited from the pis that acknowledged it")
+    parser.add_argument("--fps", type=int)
+    parser.add_argument("--depth_resolution", help="<width>x<height>")
+    parser.add_argument("--colour_resolution", help="<width>x<height>")
+    parser.add_argument("--streams", nargs="+", choices=['depth', 'colour'])
+    parser.add_argument("--decimation", type=int)
+    parser.add_argument("--no_spatial", action="store_true")
+    parser.add_argument("--spatial_alpha", type=float)
+    parser.add_argument("--spatial_delta", type=float)
+    parser.add_argument("--writers", type=int, help="threads saving frames on each pi")
+    parser.add_argument("--queue_size", type=int, help="framesets queued for the writers before frames are dropped")
+    parser.add_argument("--upload_timeout", type=float, default=600, help="seconds to wait for every pi's upload")
     args=parser.parse_args()
     print ("My filename is ", args.filename)
     print ("My capture duration is ", args.duration)
     
     # Capture images
     if args.mode == 'capture':
-        capture_duration = int(args.duration)
-        send_command_to_raspis('C', capture_duration)
+        capture_duration = args.duration
+        capture_parameters = {"fps" : args.fps,
+                              "depth_resolution" : args.depth_resolution,
+                              "colour_resolution" : args.colour_resolution,
+                              "streams" : args.streams,
+                              "decimation" : args.decimation,
+                              "spatial" : False if args.no_spatial else None,
+                              "spatial_alpha" : args.spatial_alpha,
+                              "spatial_delta" : args.spatial_delta,
+                              "writers" : args.writers,
+                              "queue_size" : args.queue_size}
+        acknowledged = send_command_to_raspis('C', capture_duration, args.raspberry_pis, capture_parameters)
     else:
-        send_command_to_raspis('R', -1)
+        # Rebooted pis upload nothing
+        send_command_to_raspis('R', -1, args.raspberry_pis)
+        exit(0)
         
-    # Receive the images from the raspberry pis
-    receive_files_from_pis()
+    if len(acknowledged) == 0:
+        print("No raspberry pi acknowledged the capture, terminating program...")
+        exit(1)
+        
+    # Receive the images from the raspberry pis, only waiting for the ones that acknowledged the capture
+    report = receive_files_from_pis(sorted(acknowledged), args.upload_timeout)
     
     # Rename uploads folder
     os.rename("uploads", args.filename)
+    
+    # Save the capture report beside the capture
+    if args.mode == 'capture':
+        report_filename = args.filename.rstrip("/") + "_report.json"
+        with open(report_filename, "w") as file:
+            json.dump({"filename" : args.filename, "capture_parameters" : capture_parameters, "raspberry_pis" : report}, file, indent=4)
+        print("Capture report saved to " + report_filename)
         
@@ -10,13 +10,18 @@ import shutil
 import argparse
 from collections import defaultdict
 import copy
+from capture_index import ToAt_index, capture_table, open_capture_manifest, read_metadata_file
+from frame_sync import match_framesets
+from depth_processing import load_depth_image
+from intrinsics_registry import get_intrinsics_registry
 
 class raspberry_pi:
     """
     Class of raspberry pi objects. Each raspberry pi has a camera attached to it.
     """
     
-    def __init__(self, raspi_name: str, serial_number: int, folder_path: str):
+    def __init__(self, raspi_name: str, serial_number: int, folder_path: str, table: capture_table = None,
+                 depth_resolution: tuple = (428, 240)):
         """
         Constructor.
         
@@ -28,6 +33,10 @@ class raspberry_pi:
             The serial number of the attached D455 camera.
         folder_path : str
             The folder path containing data collected.
+        table : capture_table
+            Capture table of folder_path shared by all raspberry pi objects. The folder is scanned if not given.
+        depth_resolution : tuple
+            (width, height) of the depth frames, 1280 x 720 decimated by 3 for Develop3 captures.
         
         Returns
         ----------
@@ -38,6 +47,8 @@ class raspberry_pi:
         self.raspi_name = raspi_name
         self.serial_number = serial_number
         self.folder_path = folder_path
+        self.table = table if table is not None else capture_table(folder_path)
+        self.depth_resolution = depth_resolution
         
         self.camera_intrinsics = self.load_cam_intrinsics()
         self.total_num_depth_frames = self.calculate_total_num_frames("depth")
@@ -63,28 +74,19 @@ class raspberry_pi:
         else:
             return self.colour_frame_numbers
     
-    def load_cam_intrinsics(self) -> list:
+    def load_cam_intrinsics(self) -> tuple:
         """
-        Loads the camera instrinsics from a .txt file.
+        Loads the camera instrinsics at the depth resolution from the intrinsics registry.
         
         Returns
         ----------
-        intrinsics : list
-            A list of the D455 intrinsics connected to the give RPi (fx, fy, ppx, ppy).
+        intrinsics : tuple
+            The intrinsics of the D455 connected to the given RPi (fx, fy, ppx, ppy).
         """
     
-        # Open the frame_metadata csv
-        df = pd.read_csv("camera_intrinsics.csv")
-        
-        # Search for the correct row
-        row_num = 0
-        while True:
-            if df.loc[row_num, "serial_number"] == self.serial_number:
-                break
-            else:
-                row_num += 1
+        width, height = self.depth_resolution
                         
-        return df.loc[row_num, "fx"], df.loc[row_num, "fy"], df.loc[row_num, "ppx"], df.loc[row_num, "ppy"]  
+        return get_intrinsics_registry("camera_intrinsics.csv").get(self.serial_number, width, height)
     
     
     def calculate_total_num_frames(self, data_type: str) -> int:
@@ -102,32 +104,10 @@ class raspberry_pi:
             Total number of frames for collected by the raspberry pi.
         """
         
-        num_frames = 0
-        # Store the filename to use when search directory
-        filename = ""
-        filename += self.raspi_name
+        # Depth frames are saved as .raw files and colour frames as .png files
+        extension = "raw" if data_type == "depth" else "png"
         
-        # Search for depth frames
-        if data_type == "depth":
-            filename += "_depth"
-            
-            # Get all the filenames in the directory and loop through them
-            for root, dirs, files in os.walk(self.folder_path):
-                for file in files: 
-                    # Count only the .raw files that match the filename 
-                    if file.count(filename) != 0 and file.endswith('.raw'):
-                        num_frames += 1
-                        
-        # Search for colour frames
-        else:
-            filename += "_colour"
-            
-            # Get all the filenames in the directory and loop through them
-            for root, dirs, files in os.walk(self.folder_path):
-                for file in files: 
-                    # Count only the .png files that match the filename 
-                    if file.count(filename) != 0 and file.endswith('.png'):
-                        num_frames += 1
+        num_frames = self.table.count_frames(self.raspi_name, data_type, "frame", extension)
                             
         return num_frames
             
@@ -148,62 +128,16 @@ class raspberry_pi:
             A list of the frame numbers for the raspberry pi.
         """
                 
-        # Scan directory and get an iterator
-        obj = os.scandir(self.folder_path)
-        
-        frame_numbers = []        
-        num_frames = self.total_num_depth_frames if data_type == "depth" else self.total_num_colour_frames
-        # Loop through each file
-        for file in obj:
-            # Check if we have already gotten all frame numbers
-            if len(frame_numbers) == num_frames:
-                break
-            
-            # Check if the file is for the correct raspi and the file is not metadata
-            if (file.name).find(self.raspi_name) != -1 and (file.name).find("metadata") == -1:
-                # Check if the file is a colour image and if we are searching for colour images
-                if (file.name).find("colour") != -1 and data_type == "colour":
-                    # Split file names based on the _ separator
-                    split1 = (file.name).split("_")
-                    
-                    # The 3rd item in the first split will be <fnum>.png. Split again using . as separator
-                    split2 = split1[2].split(".")
-                    
-                    frame_num = int(split2[0])
-                    frame_numbers.append(frame_num)
-                    
-                # Check if the file is a depth image and if we are searching for depth images
-                elif (file.name).find("depth") != -1 and data_type == "depth":
-                    # Split file names based on the _ separator
-                    split1 = (file.name).split("_")
-                    
-                    # Add a check for if any .png depth image files exist in folder
-                    if split1[2] == "image":
-                        # The 4th item in the first split will be <fnum>.raw. Split again using . as separator
-                        split2 = split1[3].split(".")
-                        frame_num = int(split2[0])
-                        
-                    else:
-                        # The 3rd item in the first split will be <fnum>.raw. Split again using . as separator
-                        split2 = split1[2].split(".")
-                        frame_num = int(split2[0])
-                    
-                    frame_numbers.append(frame_num)
-                else:
-                    continue
-            else:
-                continue
-                
-        # Close iterator
-        obj.close()
+        # Depth frames are saved as .raw files and colour frames as .png files
+        extension = "raw" if data_type == "depth" else "png"
         
-        # Sort frame numbers
-        frame_numbers.sort()
+        # The capture table is already sorted by frame number
+        frame_numbers = self.table.get_frame_numbers(self.raspi_name, data_type, "frame", extension).tolist()
         
         return frame_numbers
 
 
-def create_raspberry_pi(raspi: str, folder_path: str) -> raspberry_pi:
+def create_raspberry_pi(raspi: str, folder_path: str, table: capture_table = None) -> raspberry_pi:
     """
     Creates a new raspberry pi object.
     
@@ -213,6 +147,8 @@ def create_raspberry_pi(raspi: str, folder_path: str) -> raspberry_pi:
         The name of the raspberry pi.
     folder_path : str
         The folder path of the captured data.
+    table : capture_table
+        Capture table of folder_path shared by all raspberry pi objects.
     
     Returns
     ----------
@@ -232,7 +168,7 @@ def create_raspberry_pi(raspi: str, folder_path: str) -> raspberry_pi:
             row_num += 1
     serial_number = df.loc[row_num, "serial_number"]
     
-    return raspberry_pi(raspi, serial_number, folder_path)
+    return raspberry_pi(raspi, serial_number, folder_path, table)
 
 
 def get_filename(folder_path: str, date_type: str, raspi_name: str, frame_number: int, is_metadata: bool):
@@ -299,30 +235,14 @@ def extract_ToAt_from_file(folder_path: str, date_type: str, raspi_name: str, fr
     
     file_name = get_filename(folder_path, date_type, raspi_name, frame_number, True)
      
-    if date_type == "depth":
-        # Open file and get line 9 (ToAt is always on line 9 of metadata)
-        with open(file_name) as fp:
-            for i, line in enumerate(fp):
-                if i == 8:
-                    # Split line using comma
-                    split = line.split(",")
-                    
-                    # The ToAt should be the second item in the list
-                    return int(split[1])
-    else:
-        # Open file and get line 7 (ToAt is always on line 9 of metadata)
-        with open(file_name) as fp:
-            for i, line in enumerate(fp):
-                if i == 6:
-                    # Split line using comma
-                    split = line.split(",")
-                    
-                    # The ToAt should be the second item in the list
-                    return int(split[1])
+    # Look the ToAt up by attribute name, its line number depends on which attributes the stream supports
+    metadata = read_metadata_file(file_name)
+    if "Time Of Arrival" in metadata:
+        return metadata["Time Of Arrival"]
        
     return -1
 
-def sync_data(threshold: int, folder_path: str, raspberry_pis: list, data_type: str) -> list:
+def sync_data(threshold: int, folder_path: str, raspberry_pis: list, data_type: str, index: ToAt_index = None) -> list:
     """
     Uses the Time of Arrival timestamps (ToAt) of the depth frame metadata to find
     closely-matching frames (when the difference in ToAt is within the given threshold).
@@ -337,6 +257,8 @@ def sync_data(threshold: int, folder_path: str, raspberry_pis: list, data_type:
         The list of raspberry pi objects.
     data_type : str
         The data type of the frames to synchronise.
+    index : ToAt_index
+        Pre-built ToAt index of the capture. Built from folder_path if not given.
     
     Returns
     ----------
@@ -344,92 +266,29 @@ def sync_data(threshold: int, folder_path: str, raspberry_pis: list, data_type:
         A list of framesets of closely-matching frames.
     """
     
-    # Get and store the current frame index for each raspberry pi
-    curr_frame_index = []
+    # Read every metadata file once instead of once per comparison
+    if index is None:
+        index = ToAt_index(folder_path, [raspi.get_raspi_name() for raspi in raspberry_pis], raspberry_pis[0].table)
+    
+    # Store the ToAt of every frame of each raspberry pi, in frame number order. Frames without a ToAt are
+    # left out so the ToAts stay sorted for matching
+    frame_numbers = []
+    ToAts = []
     for raspi in raspberry_pis:
-        curr_frame_index.append(0)
+        raspi_frame_numbers, raspi_ToAts = index.lookup_valid(raspi.get_raspi_name(), data_type, raspi.get_frame_numbers(data_type))
+        frame_numbers.append(raspi_frame_numbers)
+        ToAts.append(raspi_ToAts)
+    
+    # Match all frames at once on the ToAt arrays
+    frameset_indexes = match_framesets(ToAts, threshold, consume_matches=True)
     
-    # List to store the framesets
+    # Convert frame indexes to frame numbers
     all_framesets = []
-        
-    # Loop until just one camera has no more frames to match
-    all_cameras_have_frames = True
-    # print(raspberry_pis[0].get_frame_numbers(data_type))
-    # print(raspberry_pis[1].get_frame_numbers(data_type))
-    while all_cameras_have_frames:
-    # for i in range(0, 20):
-        curr_frameset = copy.deepcopy(curr_frame_index)
-        # Amongst the current frames, search for the one with the largest ToAt (most recent frame)
-        ref_ToAt = extract_ToAt_from_file(folder_path, data_type, raspberry_pis[0].get_raspi_name(), 
-                                          raspberry_pis[0].get_frame_numbers(data_type)[curr_frame_index[0]])
-        ref_raspi = 0
-        for raspi in range(1, len(raspberry_pis)):
-            curr_ToAt = extract_ToAt_from_file(folder_path, data_type, raspberry_pis[raspi].get_raspi_name(), 
-                                               raspberry_pis[raspi].get_frame_numbers(data_type)[curr_frame_index[raspi]])
-            if ref_ToAt < curr_ToAt:
-                ref_ToAt = curr_ToAt
-                ref_raspi = raspi
-                
-        # Store the reference raspberry pi's frame number in the current frameset
-        curr_frameset[ref_raspi] = raspberry_pis[ref_raspi].get_frame_numbers(data_type)[curr_frame_index[ref_raspi]]
-        
-        # Search for a frameset, i.e. a group of closely-matching frames from each raspberry pi
-        continue_search = True
-        matching_frame_counter = 0
-        raspi = 0
-        new_curr_frame_index = copy.deepcopy(curr_frame_index)
-        # print("Ref " + str(raspberry_pis[ref_raspi].get_frame_numbers(data_type)[curr_frame_index[ref_raspi]]) + ": " + raspberry_pis[ref_raspi].get_raspi_name() + " -> " + str(ref_ToAt))
-        while continue_search and raspi < len(raspberry_pis):
-            # Do not search for matching frame within reference raspberry's frames
-            if raspi != ref_raspi:
-                # Search for matching frame
-                for frame in range(curr_frame_index[raspi], raspberry_pis[raspi].get_total_num_frames(data_type)):
-                    curr_ToAt = extract_ToAt_from_file(folder_path, data_type, raspberry_pis[raspi].get_raspi_name(), 
-                                                       raspberry_pis[raspi].get_frame_numbers(data_type)[frame])
-                    
-                    # print(raspberry_pis[raspi].get_raspi_name() + " " + str(raspberry_pis[raspi].get_frame_numbers(data_type)[curr_frame_index[raspi]]) + ": " + str(curr_ToAt))
-                    if abs(curr_ToAt - ref_ToAt) < threshold:
-                        # print("Valid Frame: " + raspberry_pis[raspi].get_raspi_name() + " " + str(raspberry_pis[raspi].get_frame_numbers(data_type)[curr_frame_index[raspi]]) + ": " + str(curr_ToAt))
-                        curr_frameset[raspi] = raspberry_pis[raspi].get_frame_numbers(data_type)[frame]
-                        
-                         # Store this frame number index temporarily
-                        new_curr_frame_index[raspi] = frame + 1
-                        
-                        matching_frame_counter += 1
-                         
-                        # Found closely-matching frame, so terminate search
-                        break
-                    
-                    # Check if the current ToAt is much bigger than the reference one or no more frames to match, terminate search if it is
-                    elif curr_ToAt > ref_ToAt or frame >= (raspberry_pis[raspi].get_total_num_frames(data_type) - 1):
-                        continue_search = False
-                        # # Increment the frame index of the raspberry pi that ended the search
-                        # curr_frame_index[raspi] += 1
-                        break
-            
-            raspi += 1
-                        
-        # Save frameset if it is valid
-        if matching_frame_counter == (len(raspberry_pis) - 1):
-            # print("Valid Frameset")
-            all_framesets.append(curr_frameset)
-            
-            # Update current frame number indexes
-            curr_frame_index = copy.deepcopy(new_curr_frame_index)
-            curr_frame_index[ref_raspi] += 1
-                
-        else:
-            # # Increment the frame index of the reference raspberry pi
-            # curr_frame_index[ref_raspi] += 1
-            
-            # Increment all current frame indexes
-            for raspi in range(0, len(raspberry_pis)):
-                curr_frame_index[raspi] += 1
-
-        # Check if any raspberry pi has no frames to search
+    for frameset_index in frameset_indexes:
+        frameset = []
         for raspi in range(0, len(raspberry_pis)):
-            if curr_frame_index[raspi] >= raspberry_pis[raspi].get_total_num_frames(data_type):
-                all_cameras_have_frames = False
+            frameset.append(frame_numbers[raspi][frameset_index[raspi]])
+        all_framesets.append(frameset)
             
     return all_framesets    
 
@@ -538,7 +397,8 @@ def create_depthmap(filepath: str, depth_info: dict, min_depth: int, max_depth:
         The file path of the depthmap.
     """
     
-    depth_array = np.fromfile(filepath, dtype=np.uint16).reshape((depth_info['height'], depth_info['width']))
+    # Memory-map the depth file instead of reading a copy of it
+    depth_array = load_depth_image(filepath, depth_info['height'], depth_info['width'])
     
     # Clip the values for visualization
     depth_clipped = np.clip(depth_array, min_depth, max_depth)
@@ -570,13 +430,20 @@ def main():
     
     folder_path = args.folder_path + "/"
     
+    # Load the capture manifest, or scan the capture folder once for all raspberry pis if it is out of date
+    manifest = open_capture_manifest(folder_path)
+    table = manifest.table
+    
     # Create raspberry pi objects
     raspis = []
     for raspi in args.raspberry_pis:
-        raspis.append(create_raspberry_pi(raspi, folder_path))
+        raspis.append(create_raspberry_pi(raspi, folder_path, table))
+                
+    # Index the ToAts of every metadata file once for both syncs
+    index = ToAt_index(folder_path, args.raspberry_pis, manifest=manifest)
                 
     # Sync depth data
-    depth_framesets = sync_data(int(args.sync_threshold), folder_path, raspis, "depth")
+    depth_framesets = sync_data(int(args.sync_threshold), folder_path, raspis, "depth", index)
     print(depth_framesets)
     print(len(depth_framesets))
     
@@ -584,7 +451,7 @@ def main():
                   'width' : 428}
     
     # Sync colour data
-    colour_framesets = sync_data(int(args.sync_threshold), folder_path, raspis, "colour")
+    colour_framesets = sync_data(int(args.sync_threshold), folder_path, raspis, "colour", index)
     print(colour_framesets)
     print(len(colour_framesets))
     
@@ -2,11 +2,21 @@ import numpy as np
 import csv
 import cv2
 import os
+import time
 import open3d as o3d
 import numpy as np
 from PIL import Image
 import pandas as pd
 import shutil
+from capture_index import ToAt_index, open_capture_manifest, read_metadata_file
+from frame_sync import match_framesets, match_to_reference
+from depth_processing import load_depth_image, depth_distance_crop, depth_barrier_subtract, depth_pipeline, depth_images_to_point_clouds
+from batch_processing import reconstruct_framesets
+from intrinsics_registry import get_intrinsics_registry
+from feature_cache import feature_cache
+from registration_runner import register_pairs, register_with_fgr, register_with_icp, register_with_multiscale_icp
+from extrinsics_store import extrinsics_store, refine_extrinsics
+from multiway_registration import get_neighbour_pairs, optimise_pose_graph
 
 class processor:
     """
@@ -28,6 +38,21 @@ class processor:
         self.raspberrys = raspberrys
         self.serial_numbers = serial_numbers
         
+        # Manifest and ToAt index of the capture, loaded on first use by get_capture_manifest and get_ToAt_index
+        self.capture_manifest = None
+        self.capture_ToAt_index = None
+        
+        # Point clouds created by this processor, keyed by (raspi index, depth frame number), so registration and
+        # reconstruction do not have to read them back from .ply files
+        self.point_clouds = {}
+        
+        # Downsampled clouds, normals and FPFH features used by registration, keyed by cloud and voxel size. Bounded, so
+        # long batch runs and parameter sweeps only keep the most recently used clouds
+        self.registration_features = feature_cache()
+        
+        # Calibrated extrinsics of each rig, so framesets can be reconstructed without registering them
+        self.extrinsics = extrinsics_store()
+        
         if processing_empty_crush:
             self.processing_data_filepath = "empty_crush_data/"
             
@@ -58,33 +83,11 @@ class processor:
     Return: (int) number of frames
     """
     def count_depth_frames(self, raspi, is_depth_frames):
-        num_frames = 0
-        
-        # Store the filename to use when search directory
-        filename = ""
-        filename += raspi
-        
-        # Search for depth frames
+        # Depth frames are saved as .csv files and colour frames as .png files
         if is_depth_frames:
-            filename += "_depth"
-            
-            # Get all the filenames in the directory and loop through them
-            for root, dirs, files in os.walk(self.data_filepath):
-                for file in files: 
-                    # Count only the .csv files that match the filename 
-                    if file.count(filename) != 0 and file.endswith('.csv'):
-                        num_frames += 1
-                        
-        # Search for colour frames
+            num_frames = self.get_capture_table().count_frames(raspi, "depth", "frame", "csv")
         else:
-            filename += "_colour"
-            
-            # Get all the filenames in the directory and loop through them
-            for root, dirs, files in os.walk(self.data_filepath):
-                for file in files: 
-                    # Count only the .png files that match the filename 
-                    if file.count(filename) != 0 and file.endswith('.png'):
-                        num_frames += 1
+            num_frames = self.get_capture_table().count_frames(raspi, "colour", "frame", "png")
                         
         return num_frames
     
@@ -99,54 +102,14 @@ class processor:
     Return: (list) frame numbers
     """
     def get_frame_numbers(self, raspi, is_depth_frames, num_frames) -> list:
-        frame_numbers = []
-        
-        # Scan directory and get an iterator
-        obj = os.scandir(self.data_filepath)
+        # Depth frames are saved as .csv files and colour frames as .png files
+        if is_depth_frames:
+            frame_numbers = self.get_capture_table().get_frame_numbers(raspi, "depth", "frame", "csv")
+        else:
+            frame_numbers = self.get_capture_table().get_frame_numbers(raspi, "colour", "frame", "png")
         
-        # Loop through each file
-        for file in obj:
-            # Check if we have already gotten all depth frame numbers
-            if len(frame_numbers) == num_frames:
-                break
-            
-            # Check if the file is for the correct raspi and the file is not metadata
-            if (file.name).find(raspi) != -1 and (file.name).find("metadata") == -1:
-                # Check if the file is a colour image and if we are searching for colour images
-                if (file.name).find("colour") != -1 and is_depth_frames == False:
-                    # Split file names based on the _ separator
-                    split1 = (file.name).split("_")
-                    
-                    # The 3rd item in the first split will be <frame-num>.png. Split again using . as separator
-                    split2 = split1[2].split(".")
-                    
-                    frame_num = int(split2[0])
-                    frame_numbers.append(frame_num)
-                    
-                # Check if the file is a depth image and if we are searching for depth images
-                elif (file.name).find("depth") != -1 and is_depth_frames:
-                    # Split file names based on the _ separator
-                    split1 = (file.name).split("_")
-                    
-                    # Add a check for if any .png depth image files exist in folder
-                    if split1[2] == "image":
-                        # The 4th item in the first split will be <fnum>.csv. Split again using . as separator
-                        split2 = split1[3].split(".")
-                        frame_num = int(split2[0])
-                        
-                    else:
-                        # The 3rd item in the first split will be <fnum>.csv. Split again using . as separator
-                        split2 = split1[2].split(".")
-                        frame_num = int(split2[0])
-                    
-                    frame_numbers.append(frame_num)
-                else:
-                    continue
-            else:
-                continue
-
-        # Close iterator
-        obj.close()
+        # Keep at most num_frames frame numbers
+        frame_numbers = frame_numbers[:num_frames].tolist()
         
         return frame_numbers
     
@@ -159,24 +122,44 @@ class processor:
     Return: (int) ToA timestamp
     """
     def get_ToA_from_file(self, filename, is_depth_frame):     
-        if is_depth_frame:
-            # Open file and get line 9 (ToA timestamp is always on line 9 of metadata)
-            with open(filename) as fp:
-                for i, line in enumerate(fp):
-                    if i == 8:
-                        # Split line using comma
-                        split = line.split(",")
-                        # The ToA timestamp should be the second item in the list
-                        return int(split[1])
-        else:
-            # Open file and get line 7 (ToA timestamp is always on line 9 of metadata)
-            with open(filename) as fp:
-                for i, line in enumerate(fp):
-                    if i == 6:
-                        # Split line using comma
-                        split = line.split(",")
-                        # The ToA timestamp should be the second item in the list
-                        return int(split[1])
+        # Look the ToA timestamp up by attribute name, its line number depends on which attributes the stream supports
+        return read_metadata_file(filename).get("Time Of Arrival", -1)
+    
+    
+    """
+    Function that gets the manifest of the captured data. The manifest saved beside the uploads folder is loaded
+    if the folder has not changed, otherwise the folder is scanned once and a new manifest is saved.
+    
+    Return: (capture_manifest) manifest of self.data_filepath
+    """
+    def get_capture_manifest(self):
+        if self.capture_manifest is None:
+            self.capture_manifest = open_capture_manifest(self.data_filepath)
+            
+        return self.capture_manifest
+    
+    
+    """
+    Function that gets the capture table of the captured data, which is reused for all frame counts and frame 
+    number lists.
+    
+    Return: (capture_table) table of every capture file in self.data_filepath
+    """
+    def get_capture_table(self):
+        return self.get_capture_manifest().table
+    
+    
+    """
+    Function that gets the ToAt index of the captured data. The index is built from the capture manifest the
+    first time this is called and is reused by all later syncs.
+    
+    Return: (ToAt_index) index of the ToAts of self.raspberrys
+    """
+    def get_ToAt_index(self):
+        if self.capture_ToAt_index is None:
+            self.capture_ToAt_index = ToAt_index(self.data_filepath, self.raspberrys, manifest=self.get_capture_manifest())
+            
+        return self.capture_ToAt_index
     
     
     """
@@ -281,100 +264,6 @@ class processor:
     #     return frame_set
     
     
-    """
-    Algorithm that finds a closely matched frameset.
-    
-    raspi_curr_frame_num -> (list) the current index to use for the raspi_frame_numbers for each raspi
-    raspi_frame_numbers -> (list) the actual frame numbers captured for each raspi
-    threshold -> (int) the maximum allowable difference in timestamps between frames of different RPis
-    is_depth_frames -> (bool) do you want to get the frame numbers of the depth frames?
-    
-    Return: (list) frameset
-    """
-    def find_a_frameset(self, raspi_curr_frame_num, raspi_frame_numbers, threshold, is_depth_frames, reference_ToAt, reference_RPi):
-        frame_set = raspi_curr_frame_num.copy()
-        
-        # Find the frame number of each RPi that is closely matched to the largest ToA timestamp
-        for i in range(0, len(self.raspberrys)):
-            # Avoid comparing reference Pi to itself
-            if i == reference_RPi:
-                continue
-            
-            else:
-                # Find a closely matched ToAt
-                not_found_match = True
-                j = 0
-                while not_found_match:
-                    # Check if reached the last frame for current RPi
-                    if raspi_curr_frame_num[i]+j >= len(raspi_frame_numbers[i]):
-                        for k in range(0, len(self.raspberrys)):
-                            frame_set[k] = -1
-                        return frame_set
-                    else:
-                        curr_ToAt = self.get_ToA_from_file(self.get_filename(self.raspberrys[i], raspi_frame_numbers[i][raspi_curr_frame_num[i]+j], is_depth_frames, True), is_depth_frames)
-                        # If within threshold
-                        if abs(curr_ToAt - reference_ToAt) < threshold:
-                            not_found_match = False
-                            frame_set[i] += j
-                        else:
-                            # Check if the current ToAt is much larger than the reference one (implies that there is no matching ToAt and we should stop checking)
-                            if curr_ToAt - reference_ToAt > threshold:
-                                for k in range(0, len(self.raspberrys)):
-                                    frame_set[k] = -2
-                                return frame_set
-                            else:
-                                j += 1 
-                                
-        return frame_set
-                
-        # # Find the frame number of each RPi that is closely matched to the largest ToA timestamp
-        # for i in range(0, len(self.raspberrys)):
-        #     # Avoid comparing reference Pi to itself
-        #     if i == reference_RPi:
-        #         continue
-        #     else:
-        #         # Find a closely matched ToA timestamp
-        #         not_found_match = True
-        #         while not_found_match:
-        #             # Check if reached the last frame for current RPi
-        #             if raspi_curr_frame_num[i]+j >= len(raspi_frame_numbers[i]) and raspi_curr_frame_num[reference_RPi] < len(raspi_frame_numbers[reference_RPi]):
-        #                 # Add to reference RPi index
-        #                 frame_set_index[reference_RPi] += 1
-        #                 return frame_set_index
-        #             else:
-        #                 curr_ToA = self.get_ToA_from_file(self.get_filename(self.raspberrys[i], raspi_frame_numbers[i][raspi_curr_frame_num[i]+j], is_depth_frames, True))
-        #                 # If within threshold
-        #                 if abs(curr_ToA - largest_ToA) < threshold:
-        #                     not_found_match = False
-        #                     frame_set_index[i] += j
-        #                 else:
-        #                     if curr_ToA - largest_ToA > threshold:
-                                
-        #                     j += 1 
-                
-        #         difference_above_threshold = True
-        #         j = 0
-        #         while difference_above_threshold:
-        #             # Check if we have reached the last frame for the RPi
-        #             if raspi_curr_frame_num[i]+j >= len(raspi_frame_numbers[i]):
-        #                 # Set a flag to indicate no matched frames
-        #                 for k in range(len(self.raspberrys)):
-        #                     frame_set[k] = -1
-        #                 # Break out of function
-        #                 return frame_set
-                    
-        #             else:
-        #                 curr_ToA = self.get_ToA_from_file(self.get_filename(self.raspberrys[i], raspi_frame_numbers[i][raspi_curr_frame_num[i]+j], is_depth_frames, True))
-        #                 if abs(curr_ToA - largest_ToA) < threshold:
-        #                     difference_above_threshold = False
-        #                     frame_set[i] += j
-        #                 else:
-        #                     j += 1 
-        
-        # return frame_set
-    
-    
-    
     """
     Algorithm that performs software synchronisation of captured depth data. The algorithm uses the Time of Arrival (ToA)
     timestamp to determine which frames from the respective RPis are closely-matched. The output is a list of framesets.
@@ -400,48 +289,23 @@ class processor:
             # Ensure list is sorted
             raspi_frame_numbers[j].sort()
             j += 1
-                        
-        # Store the index in raspi_frame_numbers of the current frame number for each RPi
-        raspi_curr_frame_num = []
-        for i in range(0, len(self.raspberrys)):
-            raspi_curr_frame_num.append(0)
-            
-        # Loop through frames to find matching frameset
-        not_done_matching = True
-        while not_done_matching:
-            # Get the RPi with the most recent frame (largest ToAt)
-            reference_ToAt = self.get_ToA_from_file(self.get_filename(self.raspberrys[0], raspi_frame_numbers[0][raspi_curr_frame_num[0]], True, True), True)
-            reference_RPi = 0
-            
-            for i in range(1, len(self.raspberrys)):
-                current_ToAt = self.get_ToA_from_file(self.get_filename(self.raspberrys[i], raspi_frame_numbers[i][raspi_curr_frame_num[i]], True, True), True)
-                
-                if reference_ToAt < current_ToAt:
-                    reference_ToAt = current_ToAt
-                    reference_RPi = i
-                    
-            # Try find a frameset
-            frameset_index = self.find_a_frameset(raspi_curr_frame_num, raspi_frame_numbers, threshold, True, reference_ToAt, reference_RPi)
             
-            # Look for flags
-            if frameset_index[0] == -1 or frameset_index[0] == -2 and raspi_curr_frame_num[reference_RPi] < len(raspi_frame_numbers[reference_RPi]):
-                # Increment previous reference RPi frame number index if it is still smaller than 
-                raspi_curr_frame_num[reference_RPi] += 1
-            else:
-                # Store frameset
-                frameset = []
-                for i in range(0, len(self.raspberrys)):
-                    frameset.append(raspi_frame_numbers[i][frameset_index[i]])
-                    
-                framesets.append(frameset)
-                # Increment frame numbers
-                for i in range(0, len(self.raspberrys)):
-                    raspi_curr_frame_num[i] += 1
-                    
-            # Check if exhausted all the frames of any RPi
+        # Get the ToAts of all frames from the index instead of reopening metadata files, frames without a ToAt
+        # are left out so the ToAts stay sorted for matching
+        index = self.get_ToAt_index()
+        raspi_ToAts = []
+        for i in range(0, len(self.raspberrys)):
+            raspi_frame_numbers[i], ToAts = index.lookup_valid(self.raspberrys[i], "depth", raspi_frame_numbers[i])
+            raspi_ToAts.append(ToAts)
+                        
+        # Match all frames at once on the ToAt arrays
+        for frameset_index in match_framesets(raspi_ToAts, threshold, consume_matches=False):
+            # Store frameset
+            frameset = []
             for i in range(0, len(self.raspberrys)):
-                if raspi_curr_frame_num[i] >= num_frames[i]:
-                    not_done_matching = False
+                frameset.append(raspi_frame_numbers[i][frameset_index[i]])
+                
+            framesets.append(frameset)
                     
         return framesets
     
@@ -471,35 +335,30 @@ class processor:
             # Ensure list is sorted
             raspi_frame_numbers[j].sort()
             j += 1
+            
+        # Get the ToAts of all colour frames from the index instead of reopening metadata files, frames without 
+        # a ToAt are left out so the ToAts stay sorted for matching
+        index = self.get_ToAt_index()
+        raspi_ToAts = []
+        for i in range(0, len(self.raspberrys)):
+            raspi_frame_numbers[i], ToAts = index.lookup_valid(self.raspberrys[i], "colour", raspi_frame_numbers[i])
+            raspi_ToAts.append(ToAts)
         
-        # Loop through each frameset
-        for depth_frameset in range(0, len(depth_framesets)):
-            colour_frameset = []
+        # Match the colour frames of each raspi to the depth frames of all depth framesets at once
+        depth_framesets_array = np.asarray(depth_framesets, dtype=np.int64).reshape(len(depth_framesets), len(self.raspberrys))
+        colour_matches = []
+        for i in range(0, len(self.raspberrys)):
+            depth_ToAts = index.lookup(self.raspberrys[i], "depth", depth_framesets_array[:, i])
+            colour_matches.append(match_to_reference(depth_ToAts, raspi_ToAts[i], threshold))
             
-            # For each depth frame in the frameset
-            for depth_frame in range(0, len(depth_framesets[depth_frameset])):
-                # Get the ToAt of the depth frame
-                curr_depth_frame_ToAt = self.get_ToA_from_file(self.get_filename(self.raspberrys[depth_frame], depth_framesets[depth_frameset][depth_frame], True, True), True)
-                
-                # Loop through each colour frame for the current raspi
-                for curr_colour_frame in raspi_frame_numbers[depth_frame]:
-                    curr_colour_frame_ToAt = self.get_ToA_from_file(self.get_filename(self.raspberrys[depth_frame], curr_colour_frame, False, True), False)
-                                        
-                    if abs(curr_depth_frame_ToAt - curr_colour_frame_ToAt) < threshold:
-                        colour_frameset.append(curr_colour_frame)
-                        # No need to keep searching colour frames when we found a matching one
-                        break
-                        
-                    # If the curr_colour_frame_ToAt is much larger than the (threshold + curr_depth_frame_ToAt) we want to break since there is no need
-                    # to continue searching
-                    if curr_colour_frame_ToAt > (threshold + curr_depth_frame_ToAt):
-                        break
-                    
-            # Check if a matching colour frame was found for each depth frame in the depth framest
-            if len(colour_frameset) == len(depth_framesets[depth_frameset]):
+        # Keep the depth framesets that have a matching colour frame for each depth frame
+        for depth_frameset in range(0, len(depth_framesets)):
+            if all(colour_matches[i][depth_frameset] != -1 for i in range(0, len(self.raspberrys))):
+                colour_frameset = []
+                for i in range(0, len(self.raspberrys)):
+                    colour_frameset.append(raspi_frame_numbers[i][colour_matches[i][depth_frameset]])
                 colour_frameset.append(depth_frameset)
                 colour_framesets.append(colour_frameset)
-                # colour_framesets.append(depth_frameset)
                     
         return colour_framesets
         
@@ -514,22 +373,9 @@ class processor:
         # Store the depth image file path
         depth_image_path = self.data_filepath + self.raspberrys[raspi_index] + "_depth_" + str(depth_frame_number) + ".csv"
         
-        # Create the numpy array depth image
-        depth_image = np.empty((self.depth_stream_config['height'], self.depth_stream_config['width']), dtype=float)  
-        # Access the depth image .csv file and extract the data
-        with open(depth_image_path, newline='') as csvfile:
-            spamreader = csv.reader(csvfile, delimiter=",", quotechar='|')
-            i = 0
-            for row in spamreader:
-                j = 0
-                for depth in row:
-                    if j != self.depth_stream_config['width']:
-                        depth_image[i,j] = float(depth)
-                        j += 1
-                i += 1
-                
-        return depth_image
-        
+        # Parse the whole .csv at once into a float32 array
+        return load_depth_image(depth_image_path, self.depth_stream_config['height'], self.depth_stream_config['width'])
+    
     
     """
     Opens up a .npy file and returns it as a numpy array
@@ -548,11 +394,12 @@ class processor:
     
     depth_frameset -> (list) frameset of depth frames to be used for registration
     colour_frameset -> (list) frameset of colour frames to be used for registration
+    copy_depth -> (bool) also save the depth frames as .npy files, not needed when using a depth pipeline
     """    
-    def separate_frameset_images(self, depth_frameset, colour_frameset):
+    def separate_frameset_images(self, depth_frameset, colour_frameset, copy_depth=True):
         # For each depth frame
         i = 0
-        for depth_frame_number in depth_frameset:
+        for depth_frame_number in (depth_frameset if copy_depth else []):
             # Open depth frame .csv
             depth_frame = self.get_numpy_from_csv(i, depth_frame_number)
             
@@ -635,12 +482,8 @@ class processor:
         # Get depth image
         depth_image = (self.get_numpy_from_npy(raspi_index, depth_frame_number)).astype(np.float32)
         
-        # Find pixels beyond distance threshold and set them to 0.0
-        for i in range(0, len(depth_image)):
-            for j in range(0, len(depth_image[i])):
-                if depth_image[i][j] >= distance_threshold:
-                    # Set pixel to 0.0
-                    depth_image[i][j] = 0.0
+        # Find pixels beyond distance threshold and set them to 0.0, in place
+        depth_distance_crop(depth_image, distance_threshold, out=depth_image)
                     
         # Apply a colour map to the depth image
         depth_colormap = cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=25.5), cv2.COLORMAP_JET)
@@ -672,11 +515,8 @@ class processor:
         empty_depth_image_path = "empty_crush_data/" + self.raspberrys[raspi_index] + "_depth_" + str(empty_depth_frame_number) + ".npy"
         empty_depth_image = np.load(empty_depth_image_path).astype(np.float32)
         
-        # Find pixels beyond distance threshold and set them to 0.0
-        for i in range(0, len(depth_image)):
-            for j in range(0, len(depth_image[i])):
-                # Subtract pixel values
-                depth_image[i][j] = depth_image[i][j] - empty_depth_image[i][j]
+        # Subtract pixel values, in place
+        depth_barrier_subtract(depth_image, empty_depth_image, out=depth_image)
                     
         # Apply a colour map to the depth image
         depth_colormap = cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=25.5), cv2.COLORMAP_JET)
@@ -692,6 +532,108 @@ class processor:
         print("Raspi " + str(raspi_index) + " depth cropped image .npys saved.")
             
         
+    """
+    Creates the depth preprocessing pipeline for a raspi. The pipeline loads each depth frame once and runs
+    rotation, distance cropping, barrier subtraction, colourising and point cloud creation in memory.
+    
+    raspi_index -> (int) index of raspi name in self.raspberrys
+    rotate -> (bool) rotate the depth frames by 180 degrees (camera mounted upside down)
+    distance_threshold -> (float) maximum allowable distance in metres, no cropping if None
+    empty_depth_frame_number -> (int) frame number of empty depth frame in empty_crush_data/ to subtract, no subtraction if None
+    depth_scale -> (float) adjust according to the depth unit in your images (e.g., 1000 for mm to meters)
+    depth_trunc -> (float) how much should the depth image be truncated
+    
+    Return: (depth_pipeline) the raspi's depth pipeline
+    """
+    def create_depth_pipeline(self, raspi_index, rotate, distance_threshold=None, empty_depth_frame_number=None, depth_scale=1000.0, depth_trunc=1.5):
+        # Get empty depth image
+        empty_depth_image = None
+        if empty_depth_frame_number is not None:
+            empty_depth_image_path = "empty_crush_data/" + self.raspberrys[raspi_index] + "_depth_" + str(empty_depth_frame_number) + ".npy"
+            empty_depth_image = np.load(empty_depth_image_path)
+            
+        return depth_pipeline(self.depth_stream_config['height'], self.depth_stream_config['width'], rotate, distance_threshold,
+                              empty_depth_image, self.load_cam_intrinsics(raspi_index), depth_scale, depth_trunc)
+    
+    
+    """
+    Gets the file path of a depth frame in the capture folder, the .raw depth frame if it exists, else the .csv one.
+    
+    raspi_index -> (int) index of raspi name in self.raspberrys
+    depth_frame_number -> (int) frame number of depth frame
+    
+    Return: (str) file path of the depth frame
+    """
+    def get_depth_frame_path(self, raspi_index, depth_frame_number):
+        depth_image_path = self.data_filepath + self.raspberrys[raspi_index] + "_depth_" + str(depth_frame_number) + ".raw"
+        if not os.path.exists(depth_image_path):
+            depth_image_path = depth_image_path[ : len(depth_image_path) - 3] + "csv"
+            
+        return depth_image_path
+    
+    
+    """
+    Runs a raspi's depth pipeline on one depth frame and saves the requested outputs in the processing data folder.
+    
+    pipeline -> (depth_pipeline) the raspi's depth pipeline, from create_depth_pipeline
+    raspi_index -> (int) index of raspi name in self.raspberrys
+    depth_frame_number -> (int) frame number of depth frame to process
+    outputs -> (list) outputs to save: "npy" (processed depth), "png" (colourised processed depth), "ply" (point cloud)
+    create_point_cloud -> (bool) create the point cloud even if it is not saved
+    
+    Return: (dict) "depth", and "colour_map" and "pcd" if they were created
+    """
+    def run_depth_pipeline(self, pipeline, raspi_index, depth_frame_number, outputs, create_point_cloud=False):
+        depth_image_path = self.get_depth_frame_path(raspi_index, depth_frame_number)
+        
+        # Output files use the same names as the step by step processing
+        output_filenames = {"npy" : "_depth_" + str(depth_frame_number) + ".npy",
+                            "png" : "_depth_image_" + str(depth_frame_number) + ".png",
+                            "ply" : "_pcd_" + str(depth_frame_number) + ".ply"}
+        output_paths = {}
+        for output in outputs:
+            output_paths[output] = self.processing_data_filepath + self.raspberrys[raspi_index] + output_filenames[output]
+            
+        results = pipeline.run(depth_image_path, output_paths, create_point_cloud)
+        if "pcd" in results:
+            self.point_clouds[(raspi_index, depth_frame_number)] = results["pcd"]
+        print("Raspi " + str(raspi_index) + " depth frame " + str(depth_frame_number) + " processed.")
+        
+        return results
+    
+    
+    """
+    Reconstructs every frameset that has matching colour frames, in parallel across a process pool. Each 
+    frameset's depth frames go through the raspis' depth pipelines, are deprojected, transformed with the given
+    transformations and combined. Only the combined point clouds are saved, as combined_pcd_<frameset>.ply in the
+    processing data folder.
+    
+    pipelines -> (list) the depth pipeline of each raspi, from create_depth_pipeline
+    depth_framesets -> (list) depth framesets, from depth_software_sync
+    colour_framesets -> (list) colour framesets, from colour_software_sync
+    transformation_matrices -> (list) 4x4 transformation of each raspi into the reference raspi's view
+    num_workers -> (int) number of worker processes, defaults to the number of CPUs
+    max_pending -> (int) maximum number of framesets queued or in progress, bounding memory use
+    refine_voxel_size -> (float) if given, the transformations are refined against each frameset with a few ICP 
+                         iterations on point clouds downsampled to this voxel size
+    reference_raspi_index -> (int) index of the reference raspi, used for refinement
+    
+    Return: (dict) file path of each combined point cloud, keyed by depth frameset index
+    """
+    def batch_reconstruction(self, pipelines, depth_framesets, colour_framesets, transformation_matrices, num_workers=None, max_pending=None,
+                             refine_voxel_size=None, reference_raspi_index=0):
+        # The last entry of each colour frameset is the index of its depth frameset
+        framesets_depth_paths = {}
+        for colour_frameset in colour_framesets:
+            depth_frameset_index = colour_frameset[len(self.raspberrys)]
+            depth_frameset = depth_framesets[depth_frameset_index]
+            framesets_depth_paths[depth_frameset_index] = [self.get_depth_frame_path(x, depth_frameset[x]) for x in range(len(self.raspberrys))]
+        
+        print("Reconstructing " + str(len(framesets_depth_paths)) + " framesets...")
+        return reconstruct_framesets(framesets_depth_paths, pipelines, transformation_matrices, self.processing_data_filepath,
+                                     num_workers, max_pending, refine_voxel_size, reference_raspi_index)
+    
+    
     """
     Algorithm that converts depth .csv files to colourised depth .png images using opencv.
     
@@ -702,20 +644,8 @@ class processor:
         for x in range(len(self.raspberrys)):
             depth_image_path = self.data_filepath + self.raspberrys[x] + "_depth_" + str(depth_frame_numbers[x]) + ".csv"
             
-            # Create the numpy array depth image
-            depth_image = np.empty((self.depth_stream_config['height'], self.depth_stream_config['width']), dtype=float)  
-            
-            # Access the depth image .csv file and extract the data
-            with open(depth_image_path, newline='') as csvfile:
-                spamreader = csv.reader(csvfile, delimiter=",", quotechar='|')
-                i = 0
-                for row in spamreader:
-                    j = 0
-                    for depth in row:
-                        if j != self.depth_stream_config['width']:
-                            depth_image[i,j] = float(depth)
-                            j += 1
-                    i += 1
+            # Parse the whole .csv at once into a float32 array
+            depth_image = load_depth_image(depth_image_path, self.depth_stream_config['height'], self.depth_stream_config['width'])
 
             # Apply a colour map to the depth image
             depth_colormap = cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=25.5), cv2.COLORMAP_JET)
@@ -746,66 +676,58 @@ class processor:
         
         
     """
-    # Loads the camera instrinsics for a specific camera from a .csv file
-    # serial_number -> the serial number of the camera
+    # Loads the camera instrinsics for a specific camera at the depth stream resolution
+    # raspi_index -> (int) index of raspi name in self.raspberrys
     # return: fx, fy, ppx, ppy
     """
     def load_cam_intrinsics(self, raspi_index):
-        # Get serial number
-        serial_number = np.int64(self.serial_numbers[self.raspberrys[raspi_index]])
-        
-        # Open the frame_metadata csv
-        df = pd.read_csv("camera_intrinsics.csv")
-        
-        # Search for the correct row
-        row_num = 0
-        while True:
-            if df.loc[row_num, "serial_number"] == serial_number:
-                break
-            else:
-                row_num += 1
-                        
-        return df.loc[row_num, "fx"], df.loc[row_num, "fy"], df.loc[row_num, "ppx"], df.loc[row_num, "ppy"]    
+        # Intrinsics at the depth stream resolution, the intrinsics file is only parsed once
+        return get_intrinsics_registry("camera_intrinsics.csv").get(self.serial_numbers[self.raspberrys[raspi_index]],
+                                                                     self.depth_stream_config['width'], self.depth_stream_config['height'])
     
     
     """
-    Algorithm that converts a depth .csv file to a point cloud and stores it in the same folder
+    Algorithm that converts depth .npy files to point clouds, keeping them in memory for registration and reconstruction
     
     raspi_index -> (int) index of raspi name in self.raspberrys to convert
-    depth_frame_number -> (int) frame number of depth frame to convert
+    depth_frame_number -> (int or list) frame number of depth frame to convert, or a list of frame numbers to convert together
     depth_scale -> (float) adjust according to the depth unit in your images (e.g., 1000 for mm to meters)
     depth_trunc -> (float) how much should the depth image be truncated
-    is_rotated -> (bool) if the original image needed rotation
+    save_pcd -> (bool) also save the point clouds as .ply files in the processing data folder
+    
+    Return: (open3d.geometry.PointCloud or list) the point cloud, or a list of point clouds if a list of frame numbers was given
     """
-    def convert_csv_to_pcd(self, raspi_index, depth_frame_number, depth_scale, depth_trunc):
-        # Get depth image
-        depth_image = (self.get_numpy_from_npy(raspi_index, depth_frame_number)).astype(np.float32)
-                
-        # Get instrinsic of camera
-        fx, fy, ppx, ppy = self.load_cam_intrinsics(raspi_index)
+    def convert_csv_to_pcd(self, raspi_index, depth_frame_number, depth_scale, depth_trunc, save_pcd=False):
+        depth_frame_numbers = depth_frame_number if isinstance(depth_frame_number, list) else [depth_frame_number]
+        
+        # Stack the depth images so they are deprojected together
+        depth_images = np.stack([self.get_numpy_from_npy(raspi_index, frame_number) for frame_number in depth_frame_numbers])
         
-        # Define intrinsic parameters for Open3D
-        intrinsic = o3d.camera.PinholeCameraIntrinsic(self.depth_stream_config['height'], self.depth_stream_config['width'], fx, fy, ppx, ppy)
-         
-        # Create point cloud from depth image
-        pcd = o3d.geometry.PointCloud.create_from_depth_image(o3d.geometry.Image(depth_image), 
-                                                            intrinsic, depth_scale=depth_scale, 
-                                                            depth_trunc=depth_trunc)
+        point_clouds = depth_images_to_point_clouds(depth_images, self.load_cam_intrinsics(raspi_index), depth_scale, depth_trunc)
         
-        # Save point cloud
-        pcd_filename = self.processing_data_filepath + self.raspberrys[raspi_index] + "_pcd_" + str(depth_frame_number) + ".ply"
-        o3d.io.write_point_cloud(pcd_filename, pcd)
-        print("Point cloud .pcd saved.")
+        for frame_number, pcd in zip(depth_frame_numbers, point_clouds):
+            self.point_clouds[(raspi_index, frame_number)] = pcd
+            
+            # Save point cloud
+            if save_pcd:
+                pcd_filename = self.processing_data_filepath + self.raspberrys[raspi_index] + "_pcd_" + str(frame_number) + ".ply"
+                o3d.io.write_point_cloud(pcd_filename, pcd)
+                print("Point cloud .pcd saved.")
+                
+        return point_clouds if isinstance(depth_frame_number, list) else point_clouds[0]
         
     
     """
-    # Loads images from png file
+    # Gets a point cloud, from memory if this processor created it, else from its .ply file
     # raspi_index -> (int) index of raspi name in self.raspberrys to convert
     # depth_frame_number -> (int) frame number of depth frame to convert
     
     # return: point cloud
     """
     def load_point_cloud(self, raspi_index, depth_frame_number):
+        if (raspi_index, depth_frame_number) in self.point_clouds:
+            return self.point_clouds[(raspi_index, depth_frame_number)]
+        
         # Load the .ply file
         pcd_file_path = self.processing_data_filepath + self.raspberrys[raspi_index] + f"_pcd_{depth_frame_number}.ply"
         pcd = o3d.io.read_point_cloud(pcd_file_path)
@@ -820,6 +742,7 @@ class processor:
 
     """
     # Downsamples point clouds to reduce computational costs, applies noise filtering and computers normals for robust alignment.
+    # The result is cached, so preprocessing the same cloud at the same voxel size again reuses it.
     
     # pcd -> (open3d.geometry.PointCloud) point cloud
     # voxel_size -> (float) size of voxel
@@ -827,38 +750,22 @@ class processor:
     # return: (open3d.geometry.PointCloud) pre-processed point cloud
     """
     def preprocess_point_cloud(self, pcd, voxel_size):
-        # Down sample point cloud
-        pcd_down = pcd.voxel_down_sample(voxel_size)
-        
-        pcd_down.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2, max_nn=30))
-        
-        return pcd_down
+        # Down sample point cloud and estimate its normals, once per cloud and voxel size
+        return self.registration_features.get_preprocessed(pcd, voxel_size)
 
 
     """
     # Performs fast global registration registration. Rough registration using a RANSAC-based algorithm.
+    # FPFH features are cached, so a target registered against several times has its features computed once.
     
     # source -> (open3d.geometry.PointCloud) point cloud to register
     # target -> stationary point cloud 
+    # search_radius -> (float) radius of the FPFH features
     
     # return: (np.ndarray) transformation matrix
     """
-    def registration_with_fgr(self, source, target):
-        # Define search radius for FPFH computation
-        search_radius = 0.05
-        search_param = o3d.geometry.KDTreeSearchParamRadius(radius=search_radius)
-        
-        # Get FPFh feature for each point cloud
-        source_fpfh = o3d.pipelines.registration.compute_fpfh_feature(source, search_param)
-        target_fpfh = o3d.pipelines.registration.compute_fpfh_feature(target, search_param)
-        
-        # Global registration
-        result = o3d.pipelines.registration.registration_fgr_based_on_feature_matching(
-            source, target, source_fpfh, target_fpfh)
-        
-        print("Registration with FGR complete.")
-        
-        return result.transformation
+    def registration_with_fgr(self, source, target, search_radius=0.05):
+        return register_with_fgr(source, target, self.registration_features, search_radius)
 
 
     """
@@ -867,26 +774,148 @@ class processor:
     # source -> (open3d.geometry.PointCloud) point cloud to register
     # target -> stationary point cloud 
     # voxel_size -> size of voxel
+    # init -> (np.ndarray) initial transformation, e.g. from FGR, identity if None
     
     # return: (np.ndarray) transformation matrix
     """
-    def registration_with_icp(self, source, target, voxel_size):
-        distance_threshold = voxel_size * 1.5
-        source_down = source
-        target_down = target
+    def registration_with_icp(self, source, target, voxel_size, init=None):
+        return register_with_icp(source, target, voxel_size, init)
+
+
+    """
+    Performs coarse to fine point-to-plane ICP over a voxel pyramid. Each level starts from the previous level's
+    transformation, so most iterations run on the coarse clouds and only a few on the finest. ICP is run a few 
+    iterations at a time, and a level ends early once its fitness and inlier RMSE stop improving.
+    
+    source -> (open3d.geometry.PointCloud) point cloud to register
+    target -> stationary point cloud 
+    voxel_sizes -> (list) voxel size of each level, coarsest first
+    max_iterations -> (list) iteration cap of each level
+    init -> (np.ndarray) initial transformation, e.g. from FGR, identity if None
+    iteration_step -> (int) iterations run between checks for improvement
+    tolerance -> (float) smallest improvement in fitness or inlier RMSE (relative) that continues a level
+    
+    return: (np.ndarray) transformation matrix, (list) per-level stats: voxel size, points, iterations, fitness,
+            inlier RMSE, whether the level converged before its cap, and seconds taken
+    """
+    def registration_with_multiscale_icp(self, source, target, voxel_sizes=(0.008, 0.004, 0.002), max_iterations=(50, 30, 14), 
+                                         init=None, iteration_step=5, tolerance=1e-4):
+        return register_with_multiscale_icp(source, target, self.registration_features, voxel_sizes, max_iterations, 
+                                            init, iteration_step, tolerance)
+
+
+    """
+    Registers every camera view to the reference camera view in parallel, each pair with FGR refined by ICP in 
+    its own worker process. Takes about as long as the slowest pair rather than the sum of every pair.
+    
+    point_clouds -> (list) preprocessed point cloud of each raspi, from preprocess_point_cloud
+    reference_raspi_index -> (int) index of raspi name in self.raspberrys to be used as the reference camera view
+    voxel_size -> (float) voxel size the point clouds were preprocessed with
+    timeout -> (float) seconds each pair may take before it is abandoned, unlimited if None
+    num_workers -> (int) number of pairs registered at once, defaults to the number of CPUs
+    icp_voxel_sizes -> (list) voxel pyramid for multi-scale ICP, coarsest first, see registration_with_multiscale_icp. 
+                       Single scale ICP at voxel_size if None
+    
+    Return: (list) 4x4 transformation of each raspi into the reference raspi's view, None for raspis whose 
+    registration failed or timed out
+    """
+    def parallel_registration(self, point_clouds, reference_raspi_index, voxel_size, timeout=None, num_workers=None, icp_voxel_sizes=None):
+        pairs = [(x, reference_raspi_index) for x in range(len(point_clouds)) if x != reference_raspi_index]
+        results = register_pairs(self, point_clouds, pairs, voxel_size, timeout=timeout, num_workers=num_workers, 
+                                 icp_voxel_sizes=icp_voxel_sizes)
+        
+        transformations = [np.eye(4) if x == reference_raspi_index else None for x in range(len(point_clouds))]
+        for (source_index, _), result in results.items():
+            if result is not None and "transformation" in result:
+                transformations[source_index] = result["transformation"]
+                
+        return transformations
+
+
+    """
+    Multiway registration. Only neighbouring camera views, which overlap well, are registered to each other, in 
+    parallel with FGR refined by ICP. Pairs that still overlap poorly once registered are dropped, and the rest 
+    form a pose graph that is optimised globally, giving every camera its transformation into the reference view.
+    Registration work scales with the overlapping pairs rather than with every camera against the reference.
+    
+    point_clouds -> (list) preprocessed point cloud of each raspi, from preprocess_point_cloud
+    reference_raspi_index -> (int) index of raspi name in self.raspberrys to be used as the reference camera view
+    voxel_size -> (float) voxel size the point clouds were preprocessed with
+    pairs -> (list) (source index, target index) of each pair of neighbouring raspis, a ring of the raspis in 
+             order if None
+    min_fitness -> (float) smallest fraction of a source's points that must lie near the target for its pair to be kept
+    timeout -> (float) seconds each pair may take before it is abandoned, unlimited if None
+    num_workers -> (int) number of pairs registered at once, defaults to the number of CPUs
+    icp_voxel_sizes -> (list) voxel pyramid for multi-scale ICP, single scale ICP if None
+    
+    Return: (list) 4x4 transformation of each raspi into the reference raspi's view, None for raspis with no kept 
+    pair connecting them to the reference
+    """
+    def multiway_registration(self, point_clouds, reference_raspi_index, voxel_size, pairs=None, min_fitness=0.3, timeout=None,
+                              num_workers=None, icp_voxel_sizes=None):
+        if pairs is None:
+            pairs = get_neighbour_pairs(len(point_clouds))
+        results = register_pairs(self, point_clouds, pairs, voxel_size, timeout=timeout, num_workers=num_workers, 
+                                 icp_voxel_sizes=icp_voxel_sizes)
+        
+        # Keep pairs that overlap well once registered
+        max_correspondence_distance = voxel_size * 1.5
+        edges = []
+        for (source_index, target_index), result in results.items():
+            if result is None or "transformation" not in result:
+                continue
+            evaluation = o3d.pipelines.registration.evaluate_registration(point_clouds[source_index], point_clouds[target_index], 
+                                                                          max_correspondence_distance, result["transformation"])
+            if evaluation.fitness < min_fitness:
+                print("Dropping pair " + str(source_index) + " to " + str(target_index) + ", fitness " + "{:.3f}".format(evaluation.fitness))
+                continue
+            edges.append((source_index, target_index, result["transformation"]))
+            
+        transformations = optimise_pose_graph(point_clouds, edges, reference_raspi_index, max_correspondence_distance)
+        print("Multiway registration complete, " + str(len(edges)) + " of " + str(len(pairs)) + " pairs used.")
+        
+        return transformations
+    
+    
+    """
+    Saves the transformations found by a calibration run as a new version of this rig's extrinsics. The rig is 
+    the set of serial numbers of the raspis' cameras.
+    
+    transformation_matrices -> (list) 4x4 transformation of each raspi into the reference raspi's view
+    reference_raspi_index -> (int) index of raspi name in self.raspberrys used as the reference camera view
+    metadata -> (dict) kept with the version, e.g. the voxel size used for registration
+    
+    Return: (int) the saved version
+    """
+    def save_extrinsics(self, transformation_matrices, reference_raspi_index, metadata=None):
+        serial_numbers = [self.serial_numbers[raspi] for raspi in self.raspberrys]
+        metadata = dict(metadata or {}, capture=self.data_filepath)
         
-        # Global registration
-        result = o3d.pipelines.registration.registration_icp(
-            source_down, target_down, distance_threshold, 
-            np.eye(4), o3d.pipelines.registration.TransformationEstimationPointToPlane())
+        version = self.extrinsics.save(dict(zip(serial_numbers, transformation_matrices)), serial_numbers[reference_raspi_index], metadata)
+        print("Extrinsics version " + str(version) + " saved to " + self.extrinsics.get_file_path(serial_numbers))
         
-        print("Registration with ICP complete.")
+        return version
+    
+    
+    """
+    Loads this rig's calibrated extrinsics.
+    
+    reference_raspi_index -> (int) index of raspi name in self.raspberrys to be used as the reference camera view
+    version -> (int) version to load, the newest if None
+    
+    Return: (list) 4x4 transformation of each raspi into the reference raspi's view. Raises KeyError if the rig
+    has no extrinsics
+    """
+    def load_extrinsics(self, reference_raspi_index, version=None):
+        serial_numbers = [self.serial_numbers[raspi] for raspi in self.raspberrys]
+        transformations = self.extrinsics.load(serial_numbers, serial_numbers[reference_raspi_index], version)
         
-        return result.transformation
-
-
+        return [transformations[str(serial_number)] for serial_number in serial_numbers]
+    
+    
     """
-    Algorithm that performs registration of the different camera views
+    Algorithm that performs registration of the different camera views. Uses the rig's calibrated extrinsics,
+    falling back to the transforms measured for the original two camera setup if the rig has none.
     
     reference_raspi_index -> (int) index of raspi name in self.raspberrys to be used as the reference camera view
     depth_frameset -> (list) frameset of depth frames to be used for registration
@@ -895,6 +924,11 @@ class processor:
     returns (list) transformation matrix
     """
     def registration(self, reference_raspi_index, depth_frameset, colour_frameset):
+        try:
+            return self.load_extrinsics(reference_raspi_index)
+        except KeyError as error:
+            print(str(error) + ", using the default two camera transforms.")
+            
         transforms = [
         np.eye(4),  # Camera 1 (identity, reference frame)
         np.array([[0.952304544001, 0.055685926827, 0.300025220655, -0.337908239954],
@@ -912,20 +946,31 @@ class processor:
     reference_raspi_index -> (int) index of raspi name in self.raspberrys to be used as the reference camera view
     depth_frameset -> (list) frameset of depth frames to be used for registration
     colour_frameset -> (list) frameset of colour frames to be used for registration
-    transformation_matrices -> (list) holds the transformation matrices to be used to different camera views
+    transformation_matrices -> (list) holds the transformation matrices to be used to different camera views,
+                               the rig's calibrated extrinsics are loaded if None
+    refine_voxel_size -> (float) if given, the transformations are refined against this frameset with a few ICP
+                         iterations on point clouds downsampled to this voxel size
     
     Saves the reconstruction in the processed data folder
     """
-    def reconstruction(self, reference_raspi_index, depth_frameset, colour_frameset, transformation_matrices):
+    def reconstruction(self, reference_raspi_index, depth_frameset, colour_frameset, transformation_matrices=None, refine_voxel_size=None):
         # Define the combined point cloud
         pcd_combined = o3d.geometry.PointCloud()
         
+        if transformation_matrices is None:
+            transformation_matrices = self.load_extrinsics(reference_raspi_index)
+        
+        # Copy the point clouds so the ones kept in memory are not transformed
+        raw_point_clouds = [o3d.geometry.PointCloud(self.load_point_cloud(raspi, depth_frameset[raspi])) for raspi in range(0, len(self.raspberrys))]
+        
+        if refine_voxel_size is not None:
+            transformation_matrices = refine_extrinsics(raw_point_clouds, transformation_matrices, reference_raspi_index, refine_voxel_size)
+        
         # Transform point clouds
         point_clouds = []
         i = 0
         for raspi in range(0, len(self.raspberrys)):
-            # Load the .ply file
-            point_cloud = self.load_point_cloud(raspi, depth_frameset[raspi])
+            point_cloud = raw_point_clouds[raspi]
             
             # Transform point cloud
             point_cloud.transform(transformation_matrices[i])
@@ -0,0 +1,67 @@
+import zlib
+import numpy as np
+
+
+# Compressed depth frames start with this magic followed by the codec id, and arrive with this extension added.
+# This is the source of truth for the wire format, raspi/control/raspi_control.py keeps an identical copy of
+# these three constants for the encoder on the raspberry pis, so change both together
+DEPTH_CODEC_MAGIC = b"DZ16"
+DEPTH_CODEC_EXTENSION = ".dz"
+DEPTH_CODECS = {"zlib" : 0, "zstd" : 1}
+
+# Codec of each codec id
+DEPTH_CODEC_NAMES = {codec_id : codec for codec, codec_id in DEPTH_CODECS.items()}
+
+
+def decode_depth(encoded: bytes) -> np.ndarray:
+    """
+    Decompresses a depth frame compressed by raspi_control.encode_depth_file on the raspberry pi. The
+    low and high byte planes of the pixel differences are interleaved back together and a wrapping uint16
+    cumulative sum undoes the differences, all without a Python loop over the pixels.
+
+    Parameters
+    ----------
+    encoded : bytes
+        DEPTH_CODEC_MAGIC, the codec id and the compressed planes.
+
+    Returns
+    ----------
+    depth : np.ndarray
+        The flat uint16 depth frame, exactly as in the original .raw file.
+    """
+
+    if encoded[:len(DEPTH_CODEC_MAGIC)] != DEPTH_CODEC_MAGIC:
+        raise ValueError("Not a compressed depth frame")
+
+    codec = DEPTH_CODEC_NAMES.get(encoded[len(DEPTH_CODEC_MAGIC)])
+    payload = encoded[len(DEPTH_CODEC_MAGIC) + 1:]
+    if codec == "zlib":
+        planes = zlib.decompress(payload)
+    elif codec == "zstd":
+        import zstandard
+        planes = zstandard.ZstdDecompressor().decompress(payload)
+    else:
+        raise ValueError("Unknown depth codec id: " + str(encoded[len(DEPTH_CODEC_MAGIC)]))
+
+    # Interleave the low and high byte planes back into little-endian uint16 differences
+    planes = np.frombuffer(planes, dtype=np.uint8).reshape(2, -1)
+    delta = np.empty((planes.shape[1], 2), dtype=np.uint8)
+    delta[:, 0] = planes[0]
+    delta[:, 1] = planes[1]
+
+    return np.cumsum(delta.view("<u2").ravel(), dtype=np.uint16)
+
+
+def decode_depth_file(encoded: bytes, file_path: str):
+    """
+    Decompresses a depth frame and saves it as a .raw file.
+
+    Parameters
+    ----------
+    encoded : bytes
+        The compressed depth frame.
+    file_path : str
+        File path of the .raw file to save.
+    """
+
+    decode_depth(encoded).astype("<u2", copy=False).tofile(file_path)
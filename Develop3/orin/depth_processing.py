@@ -0,0 +1,399 @@
+import os
+import cv2
+import numpy as np
+import open3d as o3d
+import pandas as pd
+
+
+def load_depth_image(file_path: str, height: int, width: int) -> np.ndarray:
+    """
+    Loads a depth image, choosing the reader from the file extension.
+
+    .raw files (Develop3 capture) are memory-mapped as uint16 without being read into memory.
+    .csv files (older captures) are parsed by the pandas C parser straight into a float32 array.
+    .npy files are memory-mapped.
+
+    Parameters
+    ----------
+    file_path : str
+        File path of the depth image.
+    height : int
+        Height of the depth image in pixels.
+    width : int
+        Width of the depth image in pixels.
+
+    Returns
+    ----------
+    depth_image : np.ndarray
+        (height, width) depth image, uint16 for .raw files and float32 for .csv files.
+    """
+
+    extension = os.path.splitext(file_path)[1].lower()
+
+    if extension == ".raw":
+        # Raw depth is written by the capture binary as little-endian Z16
+        return np.memmap(file_path, dtype="<u2", mode="r", shape=(height, width))
+
+    elif extension == ".csv":
+        # Rows may end in a trailing comma, so only read the first width columns
+        df = pd.read_csv(file_path, header=None, usecols=range(width), dtype=np.float32, engine="c")
+        return df.to_numpy(dtype=np.float32, copy=False)[:height]
+
+    elif extension == ".npy":
+        return np.load(file_path, mmap_mode="r")
+
+    else:
+        raise ValueError("Unsupported depth image file: " + file_path)
+
+
+def get_output_buffer(depth_images: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """
+    Gets the float32 buffer to write processed depth images into. A new buffer is allocated if out is None.
+    """
+
+    if out is None:
+        out = np.empty(np.shape(depth_images), dtype=np.float32)
+
+    return out
+
+
+def depth_distance_crop(depth_images: np.ndarray, distance_threshold, out: np.ndarray = None) -> np.ndarray:
+    """
+    Depth image distance cropping, i.e. any pixel at or beyond a certain distance is set to 0.0.
+
+    Parameters
+    ----------
+    depth_images : np.ndarray
+        A (H, W) depth image or a (N, H, W) stack of depth images.
+    distance_threshold : float or np.ndarray
+        Maximum allowable distance, in the units of the depth images. A (N, 1, 1) array gives each
+        image of a stack its own threshold.
+    out : np.ndarray
+        float32 buffer for the result. Passing depth_images itself crops in place.
+
+    Returns
+    ----------
+    cropped_images : np.ndarray
+        The cropped depth images (out).
+    """
+
+    out = get_output_buffer(depth_images, out)
+
+    # Zero every pixel beyond the threshold
+    mask = depth_images >= distance_threshold
+    if out is not depth_images:
+        np.copyto(out, depth_images, casting="unsafe")
+    np.copyto(out, 0.0, where=mask)
+
+    return out
+
+
+def depth_barrier_subtract(depth_images: np.ndarray, empty_depth_images: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+    """
+    Depth barrier subtraction using images of an empty crush.
+
+    Parameters
+    ----------
+    depth_images : np.ndarray
+        A (H, W) depth image or a (N, H, W) stack of depth images.
+    empty_depth_images : np.ndarray
+        (H, W) empty crush depth image, or a (N, H, W) stack with one per depth image.
+    out : np.ndarray
+        float32 buffer for the result. Passing depth_images itself subtracts in place.
+
+    Returns
+    ----------
+    subtracted_images : np.ndarray
+        The barrier subtracted depth images (out).
+    """
+
+    out = get_output_buffer(depth_images, out)
+
+    np.subtract(depth_images, empty_depth_images, out=out, casting="unsafe")
+
+    return out
+
+
+def depth_crop_and_subtract(depth_images: np.ndarray, distance_threshold, empty_depth_images: np.ndarray,
+                            out: np.ndarray = None) -> np.ndarray:
+    """
+    Distance cropping followed by barrier subtraction in one stage. Gives the same result as
+    depth_distance_crop then depth_barrier_subtract, without an intermediate image.
+
+    Parameters
+    ----------
+    depth_images : np.ndarray
+        A (H, W) depth image or a (N, H, W) stack of depth images.
+    distance_threshold : float or np.ndarray
+        Maximum allowable distance, in the units of the depth images. A (N, 1, 1) array gives each
+        image of a stack its own threshold.
+    empty_depth_images : np.ndarray
+        (H, W) empty crush depth image, or a (N, H, W) stack with one per depth image.
+    out : np.ndarray
+        float32 buffer for the result. Passing depth_images itself processes in place.
+
+    Returns
+    ----------
+    processed_images : np.ndarray
+        The cropped and barrier subtracted depth images (out).
+    """
+
+    out = get_output_buffer(depth_images, out)
+
+    # Find cropped pixels before out (which may be depth_images) is overwritten
+    mask = depth_images >= distance_threshold
+
+    # Cropped pixels are 0.0 before subtraction, so they end up as minus the empty image
+    np.subtract(depth_images, empty_depth_images, out=out, casting="unsafe")
+    np.negative(empty_depth_images, out=out, where=mask, casting="unsafe")
+
+    return out
+
+
+# Pixel-ray grids already built, keyed by (fx, fy, ppx, ppy, height, width)
+pixel_ray_grids = {}
+
+
+def get_pixel_rays(intrinsics: tuple, height: int, width: int) -> np.ndarray:
+    """
+    Gets the ray through every pixel of a camera, i.e. the point each pixel sees at a depth of 1. The grid
+    only depends on the intrinsics and resolution, so it is built once per camera and cached.
+
+    Parameters
+    ----------
+    intrinsics : tuple
+        (fx, fy, ppx, ppy) of the camera.
+    height : int
+        Height of the depth images in pixels.
+    width : int
+        Width of the depth images in pixels.
+
+    Returns
+    ----------
+    rays : np.ndarray
+        (height * width, 3) float32 rays (x / z, y / z, 1) in row-major pixel order. Read only.
+    """
+
+    fx, fy, ppx, ppy = (float(value) for value in intrinsics)
+    key = (fx, fy, ppx, ppy, height, width)
+
+    if key not in pixel_ray_grids:
+        rays = np.empty((height, width, 3), dtype=np.float32)
+        rays[:, :, 0] = ((np.arange(width, dtype=np.float32) - ppx) / fx)[np.newaxis, :]
+        rays[:, :, 1] = ((np.arange(height, dtype=np.float32) - ppy) / fy)[:, np.newaxis]
+        rays[:, :, 2] = 1.0
+        rays = rays.reshape(height * width, 3)
+        rays.flags.writeable = False
+        pixel_ray_grids[key] = rays
+
+    return pixel_ray_grids[key]
+
+
+def deproject_depth_images(depth_images: np.ndarray, intrinsics: tuple, depth_scale: float = 1000.0,
+                           depth_trunc: float = 1000.0) -> np.ndarray:
+    """
+    Converts depth images to XYZ points in metres with one multiply against the camera's cached pixel-ray grid.
+    Pixels with no depth (0, negative or NaN) or beyond depth_trunc are set to NaN, so every image keeps
+    one point per pixel and a stack of images stays one array.
+
+    Parameters
+    ----------
+    depth_images : np.ndarray
+        A (H, W) depth image or a (N, H, W) stack of depth images from the same camera.
+    intrinsics : tuple
+        (fx, fy, ppx, ppy) of the camera.
+    depth_scale : float
+        Depth units per metre (e.g. 1000 for mm).
+    depth_trunc : float
+        Depth in metres beyond which points are dropped.
+
+    Returns
+    ----------
+    points : np.ndarray
+        (H * W, 3) or (N, H * W, 3) float32 points, NaN where the pixel has no valid depth.
+    """
+
+    height, width = np.shape(depth_images)[-2:]
+    rays = get_pixel_rays(intrinsics, height, width)
+
+    # Depth in metres, flattened to one value per pixel
+    z = np.multiply(depth_images, np.float32(1.0 / depth_scale), dtype=np.float32)
+    z = z.reshape(z.shape[:-2] + (height * width, 1))
+
+    # Invalid pixels become NaN so they propagate through the multiply
+    with np.errstate(invalid="ignore"):
+        z[~((z > 0.0) & (z <= depth_trunc))] = np.nan
+
+    return z * rays
+
+
+def points_to_point_cloud(points: np.ndarray) -> o3d.geometry.PointCloud:
+    """
+    Creates an Open3D point cloud from (M, 3) points, dropping NaN points.
+    """
+
+    points = points[~np.isnan(points[:, 2])]
+
+    return o3d.geometry.PointCloud(o3d.utility.Vector3dVector(points.astype(np.float64)))
+
+
+def depth_images_to_point_clouds(depth_images: np.ndarray, intrinsics: tuple, depth_scale: float = 1000.0,
+                                 depth_trunc: float = 1000.0) -> list:
+    """
+    Converts a stack of depth images from one camera to point clouds in a single deprojection.
+
+    Parameters
+    ----------
+    depth_images : np.ndarray
+        (N, H, W) stack of depth images from the same camera.
+    intrinsics : tuple
+        (fx, fy, ppx, ppy) of the camera.
+    depth_scale : float
+        Depth units per metre (e.g. 1000 for mm).
+    depth_trunc : float
+        Depth in metres beyond which points are dropped.
+
+    Returns
+    ----------
+    point_clouds : list
+        One open3d.geometry.PointCloud per depth image.
+    """
+
+    points = deproject_depth_images(depth_images, intrinsics, depth_scale, depth_trunc)
+
+    return [points_to_point_cloud(image_points) for image_points in points]
+
+
+class depth_pipeline:
+    """
+    Per-camera depth preprocessing pipeline. Each depth frame is loaded once and the configured stages
+    (rotate, crop, subtract, colourise, deproject) run in memory on a preallocated buffer. Only the
+    outputs that are asked for are written to disk.
+    """
+
+    def __init__(self, height: int, width: int, rotate: bool = False, distance_threshold: float = None,
+                 empty_depth_image: np.ndarray = None, intrinsics: tuple = None, depth_scale: float = 1000.0,
+                 depth_trunc: float = 1000.0, colour_map_alpha: float = 25.5):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        height : int
+            Height of the depth frames in pixels.
+        width : int
+            Width of the depth frames in pixels.
+        rotate : bool
+            Rotate frames by 180 degrees (camera mounted upside down).
+        distance_threshold : float
+            Maximum allowable distance, pixels at or beyond it are set to 0.0. No cropping if None.
+        empty_depth_image : np.ndarray
+            Empty crush depth image to subtract, already rotated and cropped. No subtraction if None.
+        intrinsics : tuple
+            (fx, fy, ppx, ppy) of the camera. Point clouds can only be created if given.
+        depth_scale : float
+            Depth units per metre (e.g. 1000 for mm), used when creating point clouds.
+        depth_trunc : float
+            Depth in metres beyond which points are dropped when creating point clouds.
+        colour_map_alpha : float
+            Scale applied to depth values before the colour map is applied.
+
+        Returns
+        ----------
+        pipeline : depth_pipeline
+            A depth_pipeline object.
+        """
+
+        self.height = height
+        self.width = width
+        self.rotate = rotate
+        self.distance_threshold = distance_threshold
+        self.empty_depth_image = None if empty_depth_image is None else np.asarray(empty_depth_image, dtype=np.float32)
+        self.intrinsics = intrinsics
+        self.depth_scale = depth_scale
+        self.depth_trunc = depth_trunc
+        self.colour_map_alpha = colour_map_alpha
+
+        # Buffer that every frame is processed in
+        self.buffer = np.empty((height, width), dtype=np.float32)
+
+    def process(self, depth_image: np.ndarray) -> np.ndarray:
+        """
+        Runs the rotate, crop and subtract stages on a depth image.
+
+        Parameters
+        ----------
+        depth_image : np.ndarray
+            (height, width) depth image.
+
+        Returns
+        ----------
+        processed_image : np.ndarray
+            The processed depth image. This is the pipeline's buffer, so it is overwritten by the next frame.
+        """
+
+        # Rotating is a view, the copy into the buffer is the only copy of the frame
+        if self.rotate:
+            depth_image = np.rot90(depth_image, 2)
+        np.copyto(self.buffer, depth_image, casting="unsafe")
+
+        if self.distance_threshold is not None and self.empty_depth_image is not None:
+            depth_crop_and_subtract(self.buffer, self.distance_threshold, self.empty_depth_image, out=self.buffer)
+        elif self.distance_threshold is not None:
+            depth_distance_crop(self.buffer, self.distance_threshold, out=self.buffer)
+        elif self.empty_depth_image is not None:
+            depth_barrier_subtract(self.buffer, self.empty_depth_image, out=self.buffer)
+
+        return self.buffer
+
+    def colourise(self, depth_image: np.ndarray) -> np.ndarray:
+        """
+        Applies a colour map to a depth image.
+        """
+
+        return cv2.applyColorMap(cv2.convertScaleAbs(depth_image, alpha=self.colour_map_alpha), cv2.COLORMAP_JET)
+
+    def deproject(self, depth_image: np.ndarray) -> o3d.geometry.PointCloud:
+        """
+        Creates a point cloud from a depth image using the camera intrinsics.
+        """
+
+        return points_to_point_cloud(deproject_depth_images(depth_image, self.intrinsics, self.depth_scale, self.depth_trunc))
+
+    def run(self, file_path: str, output_paths: dict = None, create_point_cloud: bool = False) -> dict:
+        """
+        Loads a depth frame once, runs every configured stage in memory and writes the requested outputs.
+
+        Parameters
+        ----------
+        file_path : str
+            File path of the depth frame (.raw, .csv or .npy).
+        output_paths : dict
+            Outputs to write, keyed by output: "npy" (processed depth), "png" (colourised processed depth)
+            or "ply" (point cloud). Nothing is written if None.
+        create_point_cloud : bool
+            Create the point cloud even if it is not written.
+
+        Returns
+        ----------
+        results : dict
+            "depth" (processed depth, the pipeline's buffer), and "colour_map" and "pcd" if they were created.
+        """
+
+        output_paths = output_paths or {}
+
+        results = {"depth": self.process(load_depth_image(file_path, self.height, self.width))}
+
+        if "png" in output_paths:
+            results["colour_map"] = self.colourise(results["depth"])
+            cv2.imwrite(output_paths["png"], results["colour_map"])
+
+        if "npy" in output_paths:
+            np.save(output_paths["npy"], results["depth"])
+
+        if "ply" in output_paths or create_point_cloud:
+            results["pcd"] = self.deproject(results["depth"])
+            if "ply" in output_paths:
+                o3d.io.write_point_cloud(output_paths["ply"], results["pcd"])
+
+        return results
@@ -0,0 +1,182 @@
+import os
+import json
+import time
+import numpy as np
+import open3d as o3d
+
+
+def get_rig_id(serial_numbers: list) -> str:
+    """
+    Gets the id of a rig, the sorted serial numbers of its cameras joined with "-", so the same set of cameras
+    always has the same id whatever order they are listed in.
+    """
+
+    return "-".join(sorted(str(serial_number) for serial_number in serial_numbers))
+
+
+class extrinsics_store:
+    """
+    Versioned camera extrinsics, one .json file per rig in the store's folder. Each calibration of a rig adds a
+    new version holding the 4x4 transformation of every camera, keyed by serial number, into the reference
+    camera's view. Older versions are kept so a reconstruction can be repeated with the extrinsics it used.
+    """
+
+    def __init__(self, folder_path: str = "extrinsics"):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        folder_path : str
+            Folder the rig files are kept in. Created when the first version is saved.
+
+        Returns
+        ----------
+        store : extrinsics_store
+            An extrinsics_store object.
+        """
+
+        self.folder_path = folder_path
+
+    def get_file_path(self, serial_numbers: list) -> str:
+        """
+        Gets the file path of a rig's extrinsics.
+        """
+
+        return os.path.join(self.folder_path, "rig_" + get_rig_id(serial_numbers) + ".json")
+
+    def get_versions(self, serial_numbers: list) -> list:
+        """
+        Gets every version of a rig's extrinsics, oldest first. Empty if the rig has never been calibrated.
+        """
+
+        file_path = self.get_file_path(serial_numbers)
+        if not os.path.exists(file_path):
+            return []
+
+        with open(file_path, "r") as file:
+            return json.load(file)["versions"]
+
+    def save(self, transformations: dict, reference_serial_number, metadata: dict = None) -> int:
+        """
+        Saves the extrinsics of a calibration run as the rig's newest version.
+
+        Parameters
+        ----------
+        transformations : dict
+            4x4 transformation of each camera into the reference camera's view, keyed by serial number. The
+            cameras given make up the rig.
+        reference_serial_number : str or int
+            Serial number of the reference camera.
+        metadata : dict
+            Anything worth keeping with the version, e.g. the capture and voxel size it was calibrated with.
+
+        Returns
+        ----------
+        version : int
+            Number of the saved version.
+        """
+
+        serial_numbers = list(transformations)
+        versions = self.get_versions(serial_numbers)
+        version = versions[-1]["version"] + 1 if len(versions) > 0 else 1
+
+        versions.append({"version" : version,
+                         "created" : time.strftime("%Y-%m-%dT%H:%M:%S"),
+                         "reference_serial_number" : str(reference_serial_number),
+                         "metadata" : metadata or {},
+                         "transformations" : {str(serial_number) : np.asarray(transformation).tolist()
+                                              for serial_number, transformation in transformations.items()}})
+
+        # Write to a temporary file first, so a failed write never leaves the rig's file half written
+        os.makedirs(self.folder_path, exist_ok=True)
+        file_path = self.get_file_path(serial_numbers)
+        with open(file_path + ".tmp", "w") as file:
+            json.dump({"serial_numbers" : sorted(str(serial_number) for serial_number in serial_numbers),
+                       "versions" : versions}, file, indent=4)
+        os.replace(file_path + ".tmp", file_path)
+
+        return version
+
+    def load(self, serial_numbers: list, reference_serial_number=None, version: int = None) -> dict:
+        """
+        Loads a version of a rig's extrinsics.
+
+        Parameters
+        ----------
+        serial_numbers : list
+            Serial numbers of the rig's cameras.
+        reference_serial_number : str or int
+            Serial number of the camera to express the transformations relative to. Defaults to the reference
+            camera the version was calibrated with.
+        version : int
+            Version to load. Defaults to the newest.
+
+        Returns
+        ----------
+        transformations : dict
+            4x4 transformation of each camera into the reference camera's view, keyed by serial number.
+        """
+
+        versions = self.get_versions(serial_numbers)
+        if version is not None:
+            versions = [entry for entry in versions if entry["version"] == version]
+        if len(versions) == 0:
+            raise KeyError("No extrinsics" + ("" if version is None else " version " + str(version)) + " for rig " +
+                           get_rig_id(serial_numbers) + " in " + self.folder_path)
+
+        transformations = {serial_number : np.array(transformation) for serial_number, transformation in versions[-1]["transformations"].items()}
+
+        # Re-express the transformations relative to another camera of the rig
+        if reference_serial_number is not None and str(reference_serial_number) != versions[-1]["reference_serial_number"]:
+            to_reference = np.linalg.inv(transformations[str(reference_serial_number)])
+            transformations = {serial_number : to_reference @ transformation for serial_number, transformation in transformations.items()}
+
+        return transformations
+
+
+def refine_extrinsics(point_clouds: list, transformations: list, reference_index: int, voxel_size: float,
+                      max_iteration: int = 15) -> list:
+    """
+    Refines stored extrinsics against one frameset with a few iterations of point-to-plane ICP, starting from
+    the stored transformations. Much cheaper than registering the frameset from scratch, as no features are
+    computed and ICP starts close to the answer.
+
+    Parameters
+    ----------
+    point_clouds : list
+        Point cloud of each camera, in its own camera's view.
+    transformations : list
+        Stored 4x4 transformation of each camera into the reference camera's view.
+    reference_index : int
+        Index of the reference camera.
+    voxel_size : float
+        Voxel size the clouds are downsampled to for refinement.
+    max_iteration : int
+        ICP iterations for each camera.
+
+    Returns
+    ----------
+    transformations : list
+        The refined 4x4 transformation of each camera.
+    """
+
+    point_clouds_down = []
+    for point_cloud in point_clouds:
+        point_cloud_down = point_cloud.voxel_down_sample(voxel_size)
+        point_cloud_down.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2, max_nn=30))
+        point_clouds_down.append(point_cloud_down)
+
+    refined = []
+    for index, (point_cloud_down, transformation) in enumerate(zip(point_clouds_down, transformations)):
+        if index == reference_index:
+            refined.append(np.asarray(transformation))
+            continue
+
+        result = o3d.pipelines.registration.registration_icp(
+            point_cloud_down, point_clouds_down[reference_index], voxel_size * 1.5, np.asarray(transformation),
+            o3d.pipelines.registration.TransformationEstimationPointToPlane(),
+            o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=max_iteration))
+        refined.append(result.transformation)
+
+    return refined
@@ -0,0 +1,172 @@
+import numpy as np
+import open3d as o3d
+from collections import OrderedDict
+
+
+def get_cloud_fingerprint(pcd: o3d.geometry.PointCloud) -> tuple:
+    """
+    Gets a cheap fingerprint of a point cloud's points, so a cloud changed in place (e.g. transformed) is not
+    matched to features computed before the change.
+
+    Parameters
+    ----------
+    pcd : open3d.geometry.PointCloud
+        The point cloud.
+
+    Returns
+    ----------
+    fingerprint : tuple
+        Number of points and the first, middle and last point.
+    """
+
+    points = np.asarray(pcd.points)
+    if len(points) == 0:
+        return (0, )
+
+    return len(points), points[0].tobytes(), points[len(points) // 2].tobytes(), points[-1].tobytes()
+
+
+class feature_cache:
+    """
+    Cache of the data registration derives from a point cloud: the downsampled cloud with normals and FPFH
+    features. Entries are keyed by the identity of the cloud and the voxel size, so repeated pairwise
+    registrations against the same reference cloud, and parameter sweeps over the same clouds, compute each
+    of them once.
+
+    Entries keep a reference to their cloud, so its identity cannot be reused by another cloud while it is
+    cached. The least recently used entries are evicted beyond max_entries, so memory stays bounded.
+    """
+
+    def __init__(self, max_entries: int = 32):
+        """
+        Constructor.
+
+        Parameters
+        ----------
+        max_entries : int
+            Number of (cloud, voxel size) entries kept.
+
+        Returns
+        ----------
+        cache : feature_cache
+            An empty feature_cache object.
+        """
+
+        # Cached data keyed by (id of the cloud, voxel size), voxel size is None for the cloud as given. Kept
+        # in order of use, least recent first
+        self.entries = OrderedDict()
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+    def get_entry(self, pcd: o3d.geometry.PointCloud, voxel_size: float = None) -> dict:
+        """
+        Gets the cache entry of a cloud at a voxel size, replacing it if the cloud has changed since it was cached.
+        """
+
+        key = (id(pcd), voxel_size)
+        fingerprint = get_cloud_fingerprint(pcd)
+
+        entry = self.entries.get(key)
+        if entry is None or entry["cloud"] is not pcd or entry["fingerprint"] != fingerprint:
+            entry = {"cloud" : pcd, "fingerprint" : fingerprint, "fpfh" : {}}
+            self.entries[key] = entry
+        self.entries.move_to_end(key)
+
+        # Evict the least recently used entries
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+        return entry
+
+    def get_preprocessed(self, pcd: o3d.geometry.PointCloud, voxel_size: float, max_nn: int = 30) -> o3d.geometry.PointCloud:
+        """
+        Gets a cloud downsampled to voxel_size with its normals estimated.
+
+        Parameters
+        ----------
+        pcd : open3d.geometry.PointCloud
+            The point cloud.
+        voxel_size : float
+            Size of the voxels in metres. Normals are estimated within twice this radius.
+        max_nn : int
+            Maximum number of neighbours used to estimate each normal.
+
+        Returns
+        ----------
+        pcd_down : open3d.geometry.PointCloud
+            The downsampled cloud. It is shared with the cache, transforming it in place makes the cache
+            compute it again on the next call.
+        """
+
+        entry = self.get_entry(pcd, voxel_size)
+
+        pcd_down = entry.get("down")
+        if pcd_down is None or entry["down_fingerprint"] != get_cloud_fingerprint(pcd_down):
+            self.misses += 1
+            pcd_down = pcd.voxel_down_sample(voxel_size)
+            pcd_down.estimate_normals(search_param=o3d.geometry.KDTreeSearchParamHybrid(radius=voxel_size * 2, max_nn=max_nn))
+            entry["down"] = pcd_down
+            entry["down_fingerprint"] = get_cloud_fingerprint(pcd_down)
+        else:
+            self.hits += 1
+
+        return pcd_down
+
+    def get_fpfh(self, pcd: o3d.geometry.PointCloud, search_radius: float) -> o3d.pipelines.registration.Feature:
+        """
+        Gets the FPFH features of a cloud, which must already have normals.
+
+        Parameters
+        ----------
+        pcd : open3d.geometry.PointCloud
+            The point cloud, as given to registration.
+        search_radius : float
+            Radius in metres of the neighbourhood each feature is computed over.
+
+        Returns
+        ----------
+        fpfh : open3d.pipelines.registration.Feature
+            The FPFH feature of every point.
+        """
+
+        entry = self.get_entry(pcd)
+
+        if search_radius not in entry["fpfh"]:
+            self.misses += 1
+            entry["fpfh"][search_radius] = o3d.pipelines.registration.compute_fpfh_feature(
+                pcd, o3d.geometry.KDTreeSearchParamRadius(radius=search_radius))
+        else:
+            self.hits += 1
+
+        return entry["fpfh"][search_radius]
+
+    def set_fpfh(self, pcd: o3d.geometry.PointCloud, search_radius: float, fpfh: o3d.pipelines.registration.Feature):
+        """
+        Caches FPFH features computed elsewhere, e.g. in another process, for a cloud.
+
+        Parameters
+        ----------
+        pcd : open3d.geometry.PointCloud
+            The point cloud, as given to registration.
+        search_radius : float
+            Radius in metres of the neighbourhood the features were computed over.
+        fpfh : open3d.pipelines.registration.Feature
+            The FPFH feature of every point.
+        """
+
+        self.get_entry(pcd)["fpfh"][search_radius] = fpfh
+
+    def clear(self):
+        """
+        Removes every entry, releasing the cached clouds.
+        """
+
+        self.entries.clear()
+
+    def get_stats(self) -> dict:
+        """
+        Gets the number of entries and of cache hits and misses.
+        """
+
+        return {"entries" : len(self.entries), "hits" : self.hits, "misses" : self.misses}
@@ -0,0 +1,119 @@
+import numpy as np
+
+
+def match_framesets(ToAts: list, threshold: int, consume_matches: bool = True) -> list:
+    """
+    Finds closely-matching framesets across cameras from their Time of Arrival timestamps (ToAt).
+
+    The matching window of every frame of every camera against every other camera is found up front
+    with one vectorised searchsorted pass, so the walk over the frames only does integer comparisons.
+    The walk keeps the greedy behaviour of the original sync loops: the camera with the most recent
+    current frame is the reference, and every other camera must have a frame within the threshold of it.
+
+    Parameters
+    ----------
+    ToAts : list
+        One array of ToAts per camera, sorted in frame number order.
+    threshold : int
+        The maximum ToAt difference allowed between frames.
+    consume_matches : bool
+        If True (data_processing.sync_data), a valid frameset moves each camera past its matched frame
+        and a failed search steps every camera forward. If False (processor.depth_software_sync), a valid
+        frameset steps every camera forward and a failed search only steps the reference camera.
+
+    Returns
+    ----------
+    framesets : list
+        A list of framesets, each holding the index of the matched frame of every camera.
+    """
+
+    ToAts = [np.asarray(camera_ToAts, dtype=np.int64) for camera_ToAts in ToAts]
+    num_cameras = len(ToAts)
+    num_frames = [len(camera_ToAts) for camera_ToAts in ToAts]
+
+    if num_cameras == 0 or min(num_frames) == 0:
+        return []
+
+    # For each reference camera and each other camera, find the window of frames that
+    # could match each reference frame: first_match is the first frame newer than (ToAt - threshold)
+    # and end_match is the first frame at least (ToAt + threshold)
+    first_match = [[None] * num_cameras for _ in range(num_cameras)]
+    end_match = [[None] * num_cameras for _ in range(num_cameras)]
+    for ref in range(num_cameras):
+        for other in range(num_cameras):
+            if other == ref:
+                continue
+            first_match[ref][other] = np.searchsorted(ToAts[other], ToAts[ref] - threshold, side="right").tolist()
+            end_match[ref][other] = np.searchsorted(ToAts[other], ToAts[ref] + threshold, side="left").tolist()
+
+    # Plain lists are much faster than NumPy scalars in the walk below
+    ToAt_lists = [camera_ToAts.tolist() for camera_ToAts in ToAts]
+
+    framesets = []
+    curr_frame_index = [0] * num_cameras
+    while all(curr_frame_index[camera] < num_frames[camera] for camera in range(num_cameras)):
+        # The camera with the largest (most recent) ToAt is the reference
+        ref = 0
+        ref_ToAt = ToAt_lists[0][curr_frame_index[0]]
+        for camera in range(1, num_cameras):
+            if ref_ToAt < ToAt_lists[camera][curr_frame_index[camera]]:
+                ref = camera
+                ref_ToAt = ToAt_lists[camera][curr_frame_index[camera]]
+        ref_frame = curr_frame_index[ref]
+
+        # Every other camera needs its first unused frame newer than (ref ToAt - threshold) to
+        # also be older than (ref ToAt + threshold)
+        frameset = list(curr_frame_index)
+        found_frameset = True
+        for camera in range(num_cameras):
+            if camera == ref:
+                continue
+            frame = max(curr_frame_index[camera], first_match[ref][camera][ref_frame])
+            if frame >= end_match[ref][camera][ref_frame]:
+                found_frameset = False
+                break
+            frameset[camera] = frame
+
+        if found_frameset:
+            framesets.append(frameset)
+            if consume_matches:
+                curr_frame_index = [frame + 1 for frame in frameset]
+            else:
+                curr_frame_index = [frame + 1 for frame in curr_frame_index]
+        else:
+            if consume_matches:
+                curr_frame_index = [frame + 1 for frame in curr_frame_index]
+            else:
+                curr_frame_index[ref] += 1
+
+    return framesets
+
+
+def match_to_reference(reference_ToAts, candidate_ToAts, threshold: int) -> np.ndarray:
+    """
+    Finds, for every reference ToAt, the first candidate frame within the threshold of it. Used to match
+    colour frames to the depth frames of a frameset.
+
+    Parameters
+    ----------
+    reference_ToAts : array_like
+        ToAts to find matches for.
+    candidate_ToAts : array_like
+        ToAts of the candidate frames, sorted in frame number order.
+    threshold : int
+        The maximum ToAt difference allowed between frames.
+
+    Returns
+    ----------
+    matches : np.ndarray
+        The index of the matching candidate frame for each reference ToAt, -1 where there is no match.
+    """
+
+    reference_ToAts = np.asarray(reference_ToAts, dtype=np.int64)
+    candidate_ToAts = np.asarray(candidate_ToAts, dtype=np.int64)
+
+    # The first candidate newer than (ToAt - threshold) is a match if it is older than (ToAt + threshold)
+    first_match = np.searchsorted(candidate_ToAts, reference_ToAts - threshold, side="right")
+    end_match = np.searchsorted(candidate_ToAts, reference_ToAts + threshold, side="left")
+
+    return np.where(first_match < end_match, first_match, -1)
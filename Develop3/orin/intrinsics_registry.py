@@ -0,0 +1,201 @@
+import os
+import re
+
+
+# Matches the resolution in a section header, e.g. "Recified Resolution (Decimation d=3): 428 x 240"
+INTRINSICS_SECTION_PATTERN = re.compile(r"(\d+)\s*x\s*(\d+)\s*$")
+
+# Registries already parsed, keyed by absolute file path
+intrinsics_registries = {}
+
+
+def get_decimated_resolution(width: int, height: int, magnitude: int) -> tuple:
+    """
+    Gets the resolution of a stream after the RealSense decimation filter. The filter pads the decimated
+    resolution up to a multiple of 4, e.g. 1280 x 720 with a magnitude of 3 gives 428 x 240.
+
+    Parameters
+    ----------
+    width : int
+        Width of the stream before decimation.
+    height : int
+        Height of the stream before decimation.
+    magnitude : int
+        Decimation magnitude.
+
+    Returns
+    ----------
+    resolution : tuple
+        (width, height) of the decimated stream.
+    """
+
+    return ((width // magnitude + 3) // 4) * 4, ((height // magnitude + 3) // 4) * 4
+
+
+def scale_intrinsics(intrinsics: tuple, scale_x: float, scale_y: float) -> tuple:
+    """
+    Scales intrinsics to a resized stream, the same way the RealSense decimation filter does.
+
+    Parameters
+    ----------
+    intrinsics : tuple
+        (fx, fy, ppx, ppy) of the original stream.
+    scale_x : float
+        New width over original width.
+    scale_y : float
+        New height over original height.
+
+    Returns
+    ----------
+    intrinsics : tuple
+        (fx, fy, ppx, ppy) of the resized stream.
+    """
+
+    fx, fy, ppx, ppy = intrinsics
+
+    return fx * scale_x, fy * scale_y, ppx * scale_x, ppy * scale_y
+
+
+class intrinsics_registry:
+    """
+    Camera intrinsics keyed by (serial number, width, height), parsed once from an intrinsics .csv file.
+
+    The file holds one or more sections, each a header line ending in the resolution ("... : 640 x 480")
+    followed by "serial_number,fx,fy,ppx,ppy" rows. Rows before any header have no known resolution and
+    are used for any resolution that has no intrinsics of its own.
+    """
+
+    def __init__(self, file_path: str):
+        """
+        Constructor. Parses the intrinsics file.
+
+        Parameters
+        ----------
+        file_path : str
+            File path of the intrinsics .csv file.
+
+        Returns
+        ----------
+        registry : intrinsics_registry
+            An intrinsics_registry object.
+        """
+
+        self.file_path = file_path
+
+        # (fx, fy, ppx, ppy) keyed by (serial number, width, height), width and height are None if unknown
+        self.intrinsics = {}
+
+        resolution = (None, None)
+        with open(file_path, "r") as file:
+            for line in file:
+                line = line.strip()
+                if len(line) == 0 or line.startswith("serial_number"):
+                    continue
+
+                # A section header gives the resolution of the rows below it
+                section = INTRINSICS_SECTION_PATTERN.search(line)
+                if section is not None:
+                    resolution = (int(section.group(1)), int(section.group(2)))
+                    continue
+
+                values = line.split(",")
+                self.intrinsics[(values[0].strip(), ) + resolution] = tuple(float(value) for value in values[1:5])
+
+    def get_resolutions(self, serial_number) -> list:
+        """
+        Gets every resolution with intrinsics for a camera.
+        """
+
+        serial_number = str(serial_number)
+
+        return [(width, height) for serial, width, height in self.intrinsics if serial == serial_number and width is not None]
+
+    def get(self, serial_number, width: int, height: int) -> tuple:
+        """
+        Gets the intrinsics of a camera at a resolution. If the resolution has no intrinsics of its own, they are
+        derived from a resolution it is a decimation of, else the intrinsics with no known resolution are used.
+
+        Parameters
+        ----------
+        serial_number : str or int
+            Serial number of the camera.
+        width : int
+            Width of the stream.
+        height : int
+            Height of the stream.
+
+        Returns
+        ----------
+        intrinsics : tuple
+            (fx, fy, ppx, ppy) of the camera at the resolution.
+        """
+
+        serial_number = str(serial_number)
+
+        if (serial_number, width, height) in self.intrinsics:
+            return self.intrinsics[(serial_number, width, height)]
+
+        # Derive from a resolution that decimates to the requested one
+        for source_width, source_height in self.get_resolutions(serial_number):
+            for magnitude in range(2, 9):
+                if get_decimated_resolution(source_width, source_height, magnitude) == (width, height):
+                    return self.get_decimated(serial_number, source_width, source_height, magnitude)
+
+        if (serial_number, None, None) in self.intrinsics:
+            return self.intrinsics[(serial_number, None, None)]
+
+        raise KeyError("No intrinsics for camera " + serial_number + " at " + str(width) + " x " + str(height) +
+                       " in " + self.file_path)
+
+    def get_decimated(self, serial_number, width: int, height: int, magnitude: int) -> tuple:
+        """
+        Gets the intrinsics of a camera's stream after the decimation filter.
+
+        Parameters
+        ----------
+        serial_number : str or int
+            Serial number of the camera.
+        width : int
+            Width of the stream before decimation.
+        height : int
+            Height of the stream before decimation.
+        magnitude : int
+            Decimation magnitude.
+
+        Returns
+        ----------
+        intrinsics : tuple
+            (fx, fy, ppx, ppy) of the decimated stream.
+        """
+
+        serial_number = str(serial_number)
+        decimated_width, decimated_height = get_decimated_resolution(width, height, magnitude)
+
+        # Intrinsics read from the decimated stream itself are used if there are any
+        if (serial_number, decimated_width, decimated_height) in self.intrinsics:
+            return self.intrinsics[(serial_number, decimated_width, decimated_height)]
+
+        return scale_intrinsics(self.get(serial_number, width, height), decimated_width / width, decimated_height / height)
+
+
+def get_intrinsics_registry(file_path: str = "camera_intrinsics.csv") -> intrinsics_registry:
+    """
+    Gets the intrinsics registry of a file, parsing the file only the first time it is asked for.
+
+    Parameters
+    ----------
+    file_path : str
+        File path of the intrinsics .csv file.
+
+    Returns
+    ----------
+    registry : intrinsics_registry
+        The intrinsics registry of the file.
+    """
+
+    file_path = os.path.abspath(file_path)
+
+    if file_path not in intrinsics_registries:
+        intrinsics_registries[file_path] = intrinsics_registry(file_path)
+
+    return intrinsics_registries[file_path]
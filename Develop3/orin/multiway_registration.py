@@ -0,0 +1,128 @@
+import numpy as np
+import open3d as o3d
+from collections import deque
+
+
+def get_neighbour_pairs(num_cameras: int, loop_closure: bool = True) -> list:
+    """
+    Gets the pairs of neighbouring cameras for cameras mounted in a ring, each camera being registered to the
+    next one around the ring.
+
+    Parameters
+    ----------
+    num_cameras : int
+        Number of cameras, in order around the ring.
+    loop_closure : bool
+        Also pair the last camera with the first, closing the ring.
+
+    Returns
+    ----------
+    pairs : list
+        (source index, target index) of each neighbouring pair.
+    """
+
+    pairs = [(index + 1, index) for index in range(num_cameras - 1)]
+    if loop_closure and num_cameras > 2:
+        pairs.append((0, num_cameras - 1))
+
+    return pairs
+
+
+def get_initial_poses(num_cameras: int, edges: list, reference_index: int) -> tuple:
+    """
+    Chains pairwise transformations outwards from the reference camera, breadth first, to give each camera an
+    initial pose in the reference camera's view.
+
+    Parameters
+    ----------
+    num_cameras : int
+        Number of cameras.
+    edges : list
+        (source index, target index, 4x4 transformation of source into target's view) of each registered pair.
+    reference_index : int
+        Index of the reference camera.
+
+    Returns
+    ----------
+    poses : list
+        4x4 pose of each camera in the reference camera's view, None for cameras not connected to the reference.
+    tree_edges : set
+        Indices of the edges used to chain the poses. The other edges close loops.
+    """
+
+    poses = [None] * num_cameras
+    poses[reference_index] = np.eye(4)
+    tree_edges = set()
+
+    queue = deque([reference_index])
+    while len(queue) > 0:
+        camera = queue.popleft()
+        for edge_index, (source_index, target_index, transformation) in enumerate(edges):
+            if target_index == camera and poses[source_index] is None:
+                poses[source_index] = poses[camera] @ transformation
+                neighbour = source_index
+            elif source_index == camera and poses[target_index] is None:
+                poses[target_index] = poses[camera] @ np.linalg.inv(transformation)
+                neighbour = target_index
+            else:
+                continue
+            tree_edges.add(edge_index)
+            queue.append(neighbour)
+
+    return poses, tree_edges
+
+
+def optimise_pose_graph(point_clouds: list, edges: list, reference_index: int, max_correspondence_distance: float,
+                        edge_prune_threshold: float = 0.25) -> list:
+    """
+    Builds a pose graph from pairwise registrations and optimises every camera's pose together, so the error
+    of each pair is spread over the graph instead of accumulating along chains of cameras. Edges that close
+    loops are marked uncertain, so the optimisation prunes them if they disagree with the rest of the graph.
+
+    Parameters
+    ----------
+    point_clouds : list
+        Preprocessed point cloud of each camera, used for the information matrix of each edge.
+    edges : list
+        (source index, target index, 4x4 transformation of source into target's view) of each registered pair.
+    reference_index : int
+        Index of the reference camera, whose pose is held fixed.
+    max_correspondence_distance : float
+        Distance in metres within which points are counted as corresponding.
+    edge_prune_threshold : float
+        Uncertain edges with a line process weight below this are pruned.
+
+    Returns
+    ----------
+    poses : list
+        Optimised 4x4 transformation of each camera into the reference camera's view, None for cameras not
+        connected to the reference.
+    """
+
+    poses, tree_edges = get_initial_poses(len(point_clouds), edges, reference_index)
+
+    # Only cameras connected to the reference are in the graph
+    node_ids = {}
+    pose_graph = o3d.pipelines.registration.PoseGraph()
+    for camera, pose in enumerate(poses):
+        if pose is not None:
+            node_ids[camera] = len(pose_graph.nodes)
+            pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(pose))
+
+    for edge_index, (source_index, target_index, transformation) in enumerate(edges):
+        if source_index not in node_ids or target_index not in node_ids:
+            continue
+        information = o3d.pipelines.registration.get_information_matrix_from_point_clouds(
+            point_clouds[source_index], point_clouds[target_index], max_correspondence_distance, transformation)
+        pose_graph.edges.append(o3d.pipelines.registration.PoseGraphEdge(
+            node_ids[source_index], node_ids[target_index], transformation, information, uncertain=edge_index not in tree_edges))
+
+    option = o3d.pipelines.registration.GlobalOptimizationOption(max_correspondence_distance=max_correspondence_distance,
+                                                                 edge_prune_threshold=edge_prune_threshold,
+                                                                 reference_node=node_ids[reference_index])
+    o3d.pipelines.registration.global_optimization(pose_graph, o3d.pipelines.registration.GlobalOptimizationLevenbergMarquardt(),
+                                                   o3d.pipelines.registration.GlobalOptimizationConvergenceCriteria(), option)
+
+    # Express every pose relative to the reference camera
+    to_reference = np.linalg.inv(pose_graph.nodes[node_ids[reference_index]].pose)
+    return [to_reference @ pose_graph.nodes[node_ids[camera]].pose if camera in node_ids else None for camera in range(len(point_clouds))]
@@ -1,4 +1,5 @@
-from data_processing import processor
+from data_processing_2 import processor
+from extrinsics_store import refine_extrinsics
 import numpy as np
 import open3d as o3d
 
@@ -36,190 +37,215 @@ capture_duration = 10 #s
 
 processing_empty_crush = False
 
-if processing_empty_crush == False:
-    processor_1 = processor("25_Mar_OP_6_uploads_five_10_15/", capture_duration, depth_capture_config, 
-                            colour_capture_config, raspberrys, serial_numbers, processing_empty_crush)
-    
-    # Do SW syncing
-    print("Performing SW synchronisation now...")
-    threshold = 66 #ms
-    depth_framesets = processor_1.depth_software_sync(threshold)
-    print(depth_framesets)
-    print(len(depth_framesets))
-
-    colour_framesets = processor_1.colour_software_sync(threshold, depth_framesets)
-    print(colour_framesets)
-    print(len(colour_framesets))
-
-
-    # frameset = int(input("Please select the index of the frameset to process further from the given SW colour framesets \t"))
-    frameset = 0 # REMOVE IN FINAL PROGRAM
-
-
-    # Isolate frameset images in their own directory (processed data folder)
-    print("Separating frameset images...")
-    processor_1.separate_frameset_images(depth_framesets[colour_framesets[frameset][len(raspberrys)]], colour_framesets[frameset])
-
-
-    # Rotate upside down images: raspi 1 and 3
-    print("Rotating upside down images...")
-    # Rotate raspi 1
-    processor_1.rotate_image(0, depth_framesets[colour_framesets[frameset][len(raspberrys)]][0], True)
-    processor_1.rotate_image(0, colour_framesets[frameset][0], False)
-
-    # Rotate raspi 3
-    processor_1.rotate_image(2, depth_framesets[colour_framesets[frameset][len(raspberrys)]][2], True)
-    processor_1.rotate_image(2, colour_framesets[frameset][2], False)
-
-
-    # Convert the depth images in selected frameset to pngs
-    print("Converting depth image .csv files to .png images...")
-    for i in range(0, len(raspberrys)):
-        processor_1.convert_single_csv_to_depth(i, depth_framesets[colour_framesets[frameset][len(raspberrys)]][i])
-
-
-    # Perform depth image cropping
-    print("Distance cropping depth images...")
-    # raspi1
-    depth_cropping_threshold = 1.75
-    processor_1.depth_distance_cropping(0, depth_framesets[colour_framesets[frameset][len(raspberrys)]][0], depth_cropping_threshold)
-    # raspi2
-    depth_cropping_threshold = 1.5
-    processor_1.depth_distance_cropping(1, depth_framesets[colour_framesets[frameset][len(raspberrys)]][1], depth_cropping_threshold)
-    # raspi3
-    depth_cropping_threshold = 2.25
-    processor_1.depth_distance_cropping(2, depth_framesets[colour_framesets[frameset][len(raspberrys)]][2], depth_cropping_threshold)
-    # raspi4
-    depth_cropping_threshold = 2.0
-    processor_1.depth_distance_cropping(3, depth_framesets[colour_framesets[frameset][len(raspberrys)]][3], depth_cropping_threshold)
-        
+# Reconstruct every synced frameset with the transformations found for the selected frameset
+batch_mode = False
+
+# Register every camera to the reference camera at once, one worker process per camera pair
+parallel_registration = True
+registration_timeout = 120 #s
 
-    # Subtract the barrier
-    print("Subtracting the barriers of the images...")
-    empty_images_frameset = [78, 58, 28, 27]
-    for i in range(0, len(raspberrys)):
-        processor_1.depth_barrier_subtraction(i, depth_framesets[colour_framesets[frameset][len(raspberrys)]][i], empty_images_frameset[i])
+# Register neighbouring cameras only and optimise a pose graph of every camera, instead of registering every 
+# camera to camera 1. Neighbours are a ring of the cameras in order unless camera_pairs lists them as (source, target)
+multiway = False
+camera_pairs = None
 
+# Refine registration with coarse to fine ICP over these voxel sizes (m) instead of one ICP at the finest
+icp_voxel_sizes = [0.008, 0.004, 0.002]
 
-    # Create point clouds from depth frames in selected frameset
-    print("Converting depth image .csv files to .ply point cloud files...")
-    depth_scale = 1000.0
-    depth_trunc = 1.5
-    for i in range(0, len(raspberrys)):
-        processor_1.convert_csv_to_pcd(i, depth_framesets[colour_framesets[frameset][len(raspberrys)]][i], depth_scale, depth_trunc)
+# Calibration run: save the transformations found by registration as a new version of the rig's extrinsics
+save_extrinsics = False
 
+# Skip registration and use the rig's newest extrinsics, refined against each frameset with a few ICP 
+# iterations at this voxel size (None to use them as stored)
+use_stored_extrinsics = False
+refine_voxel_size = 0.004
 
-    # Perform registration
-    print("Performing registration...")
+# Worker processes are spawned and import this script, so only run the processing when it is run directly
+if __name__ == "__main__":
+    if processing_empty_crush == False:
+        processor_1 = processor("25_Mar_OP_6_uploads_five_10_15/", capture_duration, depth_capture_config, 
+                                colour_capture_config, raspberrys, serial_numbers, processing_empty_crush)
     
-    # Load point cloud
-    raw_point_clouds = [processor_1.load_point_cloud(raspi, depth_framesets[colour_framesets[frameset][len(raspberrys)]][raspi]) for raspi in range(0, len(raspberrys))]
+        # Do SW syncing
+        print("Performing SW synchronisation now...")
+        threshold = 66 #ms
+        depth_framesets = processor_1.depth_software_sync(threshold)
+        print(depth_framesets)
+        print(len(depth_framesets))
+
+        colour_framesets = processor_1.colour_software_sync(threshold, depth_framesets)
+        print(colour_framesets)
+        print(len(colour_framesets))
+
+
+        # frameset = int(input("Please select the index of the frameset to process further from the given SW colour framesets \t"))
+        frameset = 0 # REMOVE IN FINAL PROGRAM
+
+
+        depth_frameset = depth_framesets[colour_framesets[frameset][len(raspberrys)]]
+
+        # Isolate frameset colour images in their own directory (processed data folder)
+        print("Separating frameset images...")
+        processor_1.separate_frameset_images(depth_frameset, colour_framesets[frameset], False)
+
+
+        # Rotate upside down colour images: raspi 1 and 3
+        print("Rotating upside down images...")
+        processor_1.rotate_image(0, colour_framesets[frameset][0], False)
+        processor_1.rotate_image(2, colour_framesets[frameset][2], False)
+
+
+        # Preprocess depth images in memory: rotate raspi 1 and 3, distance crop, subtract the barriers and
+        # create point clouds. Only the final depth .png is saved, the point clouds stay in memory
+        print("Preprocessing depth images and creating point clouds...")
+        rotate_depth = [True, False, True, False]
+        depth_cropping_thresholds = [1.75, 1.5, 2.25, 2.0]
+        empty_images_frameset = [78, 58, 28, 27]
+        depth_scale = 1000.0
+        depth_trunc = 1.5
+        pipelines = []
+        raw_point_clouds = []
+        for i in range(0, len(raspberrys)):
+            pipeline = processor_1.create_depth_pipeline(i, rotate_depth[i], depth_cropping_thresholds[i], empty_images_frameset[i], 
+                                                         depth_scale, depth_trunc)
+            results = processor_1.run_depth_pipeline(pipeline, i, depth_frameset[i], ["png"], True)
+            pipelines.append(pipeline)
+            raw_point_clouds.append(results["pcd"])
+
+
+        # Perform registration
+        print("Performing registration...")
     
-    # Pre-process point clouds
-    voxel_size = 0.002
-    processed_pcs = [processor_1.preprocess_point_cloud(pcd, voxel_size) for pcd in raw_point_clouds]
+        # Pre-process point clouds, not needed when the stored extrinsics are used
+        voxel_size = 0.002
+        processed_pcs = [] if use_stored_extrinsics else [processor_1.preprocess_point_cloud(pcd, voxel_size) for pcd in raw_point_clouds]
     
-    # Register point clouds with fgr
-    fgr_transformations = [np.eye(4)]
-    for i in range(len(processed_pcs) - 1):
-        transformation = processor_1.registration_with_fgr(processed_pcs[i + 1], processed_pcs[0])
-        fgr_transformations.append(transformation)
+        if use_stored_extrinsics:
+            # Only refine the calibrated extrinsics, no global registration
+            transformations = processor_1.load_extrinsics(0)
+            if refine_voxel_size is not None:
+                transformations = refine_extrinsics(raw_point_clouds, transformations, 0, refine_voxel_size)
+        elif multiway:
+            # Register overlapping neighbours at once and optimise the pose graph
+            transformations = processor_1.multiway_registration(processed_pcs, 0, voxel_size, camera_pairs, timeout=registration_timeout, 
+                                                                icp_voxel_sizes=icp_voxel_sizes)
+        elif parallel_registration:
+            # Register point clouds with fgr then icp, every pair at once
+            transformations = processor_1.parallel_registration(processed_pcs, 0, voxel_size, registration_timeout, icp_voxel_sizes=icp_voxel_sizes)
+        else:
+            # Register point clouds with fgr
+            fgr_transformations = [np.eye(4)]
+            for i in range(len(processed_pcs) - 1):
+                transformation = processor_1.registration_with_fgr(processed_pcs[i + 1], processed_pcs[0])
+                fgr_transformations.append(transformation)
+        
+            if icp_voxel_sizes is not None:
+                # Refine the fgr transformations with multi-scale icp, starting from the raw clouds so the coarse 
+                # levels are downsampled from full resolution
+                transformations = [np.eye(4)]
+                for i in range(len(processed_pcs) - 1):
+                    transformation, icp_levels = processor_1.registration_with_multiscale_icp(raw_point_clouds[i + 1], raw_point_clouds[0], 
+                                                                                              icp_voxel_sizes, init=fgr_transformations[i + 1])
+                    transformations.append(transformation)
+            else:
+                # Register point clouds with icp
+                icp_transformations = [np.eye(4)]
+                for i in range(len(processed_pcs) - 1):
+                    transformation = processor_1.registration_with_icp(processed_pcs[i + 1], processed_pcs[0], voxel_size)
+                    icp_transformations.append(transformation)
+                
+                # Combine transformations, fgr then icp
+                transformations = [icp_transformations[i] @ fgr_transformations[i] for i in range(len(raspberrys))]
+        print("Registration feature cache: " + str(processor_1.registration_features.get_stats()))
     
-    # Register point clouds with icp
-    icp_transformations = [np.eye(4)]
-    for i in range(len(processed_pcs) - 1):
-        transformation = processor_1.registration_with_icp(processed_pcs[i + 1], processed_pcs[0], voxel_size)
-        icp_transformations.append(transformation)
+        if save_extrinsics and not use_stored_extrinsics and all(transformation is not None for transformation in transformations):
+            processor_1.save_extrinsics(transformations, 0, {"voxel_size" : voxel_size, "frameset" : frameset})
         
-    # reference_raspi = 0
-    # transformations = processor_1.registration(reference_raspi, depth_framesets[colour_framesets[frameset][len(raspberrys)]], colour_framesets[frameset])
+        # reference_raspi = 0
+        # transformations = processor_1.registration(reference_raspi, depth_framesets[colour_framesets[frameset][len(raspberrys)]], colour_framesets[frameset])
 
 
-    # Perform reconstruction
-    print("Performing reconstruction...")
-    reference_raspi = 0
-    # processor_1.reconstruction(reference_raspi, depth_framesets[colour_framesets[frameset][len(raspberrys)]], colour_framesets[frameset], transformations)
-    # Combine transformations
-    # Define the combined point cloud
-    pcd_combined = o3d.geometry.PointCloud()
+        # Perform reconstruction
+        print("Performing reconstruction...")
+        reference_raspi = 0
+        # processor_1.reconstruction(reference_raspi, depth_framesets[colour_framesets[frameset][len(raspberrys)]], colour_framesets[frameset], transformations)
+        # Combine transformations
+        # Define the combined point cloud
+        pcd_combined = o3d.geometry.PointCloud()
     
-    # Transform point clouds
-    point_clouds = []
-    i = 0
-    for raspi in range(0, len(raspberrys)):
-        # Load the .ply file
-        point_cloud = processor_1.load_point_cloud(raspi, depth_framesets[colour_framesets[frameset][len(raspberrys)]][raspi])
+        # Transform point clouds
+        point_clouds = []
+        i = 0
+        for raspi in range(0, len(raspberrys)):
+            # Leave out cameras whose registration failed
+            if transformations[raspi] is None:
+                print("Raspi " + str(raspi) + " was not registered, leaving it out of the reconstruction.")
+                continue
+        
+            # Use the point cloud already in memory
+            point_cloud = raw_point_clouds[raspi]
         
-        # Transform point cloud
-        point_cloud.transform(fgr_transformations[raspi])
-        point_cloud.transform(icp_transformations[raspi])
-        i += 1
+            # Transform point cloud
+            point_cloud.transform(transformations[raspi])
+            i += 1
         
-        # Store transformed point cloud
-        point_clouds.append(point_cloud)
-        pcd_combined += point_cloud
+            # Store transformed point cloud
+            point_clouds.append(point_cloud)
+            pcd_combined += point_cloud
+    
+        # Visualize aligned point clouds
+        o3d.visualization.draw_geometries(point_clouds)
     
-    # Visualize aligned point clouds
-    o3d.visualization.draw_geometries(point_clouds)
+        # Save the combined point cloud
+        filename = processor_1.processing_data_filepath + "combined_pcd.ply"
+        o3d.io.write_point_cloud(filename, pcd_combined)
+        print("Combined point cloud saved.")
     
-    # Save the combined point cloud
-    filename = processor_1.processing_data_filepath + "combined_pcd.ply"
-    o3d.io.write_point_cloud(filename, pcd_combined)
-    print("Combined point cloud saved.")
-
-else:
-    processor_1 = processor("25_Mar_OP_8_uploads_five_15_15/", capture_duration, depth_capture_config, 
-                            colour_capture_config, raspberrys, serial_numbers, processing_empty_crush)
+        # Reconstruct every other frameset with the same transformations, which needs every camera registered
+        if batch_mode and any(transformation is None for transformation in transformations):
+            print("Skipping batch reconstruction as not every camera was registered.")
+        elif batch_mode:
+            print("Performing batch reconstruction...")
+            processor_1.batch_reconstruction(pipelines, depth_framesets, colour_framesets, transformations,
+                                             refine_voxel_size=refine_voxel_size if use_stored_extrinsics else None)
+
+    else:
+        processor_1 = processor("25_Mar_OP_8_uploads_five_15_15/", capture_duration, depth_capture_config, 
+                                colour_capture_config, raspberrys, serial_numbers, processing_empty_crush)
     
-    # Do SW syncing
-    print("Performing SW synchronisation now...")
-    threshold = 66 #ms
-    depth_framesets = processor_1.depth_software_sync(threshold)
-    print(depth_framesets)
-    print(len(depth_framesets))
+        # Do SW syncing
+        print("Performing SW synchronisation now...")
+        threshold = 66 #ms
+        depth_framesets = processor_1.depth_software_sync(threshold)
+        print(depth_framesets)
+        print(len(depth_framesets))
 
-    colour_framesets = processor_1.colour_software_sync(threshold, depth_framesets)
-    print(colour_framesets)
-    print(len(colour_framesets))
+        colour_framesets = processor_1.colour_software_sync(threshold, depth_framesets)
+        print(colour_framesets)
+        print(len(colour_framesets))
 
 
-    # frameset = int(input("Please select the index of the frameset to process further from the given SW colour framesets \t"))
-    frameset = 0 # REMOVE IN FINAL PROGRAM
+        # frameset = int(input("Please select the index of the frameset to process further from the given SW colour framesets \t"))
+        frameset = 0 # REMOVE IN FINAL PROGRAM
     
-    # Isolate frameset images in their own directory (processed data folder)
-    print("Separating frameset images...")
-    processor_1.separate_frameset_images(depth_framesets[colour_framesets[frameset][len(raspberrys)]], colour_framesets[frameset])
-
-
-    # Rotate upside down images: raspi 1 and 3
-    print("Rotating upside down images...")
-    # Rotate raspi 1
-    processor_1.rotate_image(0, depth_framesets[colour_framesets[frameset][len(raspberrys)]][0], True)
-    processor_1.rotate_image(0, colour_framesets[frameset][0], False)
-
-    # Rotate raspi 3
-    processor_1.rotate_image(2, depth_framesets[colour_framesets[frameset][len(raspberrys)]][2], True)
-    processor_1.rotate_image(2, colour_framesets[frameset][2], False)
-
-
-    # Convert the depth images in selected frameset to pngs
-    print("Converting depth image .csv files to .png images...")
-    for i in range(0, len(raspberrys)):
-        processor_1.convert_single_csv_to_depth(i, depth_framesets[colour_framesets[frameset][len(raspberrys)]][i])
-
-
-    # Perform depth image cropping
-    print("Distance cropping depth images...")
-    # raspi1
-    depth_cropping_threshold = 1.75
-    processor_1.depth_distance_cropping(0, depth_framesets[colour_framesets[frameset][len(raspberrys)]][0], depth_cropping_threshold)
-    # raspi2
-    depth_cropping_threshold = 1.5
-    processor_1.depth_distance_cropping(1, depth_framesets[colour_framesets[frameset][len(raspberrys)]][1], depth_cropping_threshold)
-    # raspi3
-    depth_cropping_threshold = 2.25
-    processor_1.depth_distance_cropping(2, depth_framesets[colour_framesets[frameset][len(raspberrys)]][2], depth_cropping_threshold)
-    # raspi4
-    depth_cropping_threshold = 1.5
-    processor_1.depth_distance_cropping(3, depth_framesets[colour_framesets[frameset][len(raspberrys)]][3], depth_cropping_threshold)
-        
+        depth_frameset = depth_framesets[colour_framesets[frameset][len(raspberrys)]]
+    
+        # Isolate frameset colour images in their own directory (processed data folder)
+        print("Separating frameset images...")
+        processor_1.separate_frameset_images(depth_frameset, colour_framesets[frameset], False)
+
+
+        # Rotate upside down colour images: raspi 1 and 3
+        print("Rotating upside down images...")
+        processor_1.rotate_image(0, colour_framesets[frameset][0], False)
+        processor_1.rotate_image(2, colour_framesets[frameset][2], False)
+
+
+        # Preprocess depth images in memory: rotate raspi 1 and 3 and distance crop. The cropped depth .npy is 
+        # saved for barrier subtraction
+        print("Preprocessing depth images...")
+        rotate_depth = [True, False, True, False]
+        depth_cropping_thresholds = [1.75, 1.5, 2.25, 1.5]
+        for i in range(0, len(raspberrys)):
+            pipeline = processor_1.create_depth_pipeline(i, rotate_depth[i], depth_cropping_thresholds[i])
+            processor_1.run_depth_pipeline(pipeline, i, depth_frameset[i], ["npy", "png"])
@@ -0,0 +1,359 @@
+import os
+import time
+import multiprocessing
+from multiprocessing.connection import wait
+import numpy as np
+import open3d as o3d
+from feature_cache import feature_cache
+
+
+def get_cloud_arrays(pcd: o3d.geometry.PointCloud) -> dict:
+    """
+    Gets the points and normals of a point cloud as NumPy arrays, so the cloud can be sent to another process.
+
+    Parameters
+    ----------
+    pcd : open3d.geometry.PointCloud
+        The point cloud.
+
+    Returns
+    ----------
+    arrays : dict
+        Nx3 "points" and "normals", normals is None if the cloud has none.
+    """
+
+    return {"points" : np.asarray(pcd.points).copy(),
+            "normals" : np.asarray(pcd.normals).copy() if pcd.has_normals() else None}
+
+
+def make_point_cloud(arrays: dict) -> o3d.geometry.PointCloud:
+    """
+    Rebuilds a point cloud from the arrays given by get_cloud_arrays.
+
+    Parameters
+    ----------
+    arrays : dict
+        Nx3 "points" and "normals", normals may be None.
+
+    Returns
+    ----------
+    pcd : open3d.geometry.PointCloud
+        The point cloud.
+    """
+
+    pcd = o3d.geometry.PointCloud()
+    pcd.points = o3d.utility.Vector3dVector(arrays["points"])
+    if arrays["normals"] is not None:
+        pcd.normals = o3d.utility.Vector3dVector(arrays["normals"])
+
+    return pcd
+
+
+def register_with_fgr(source: o3d.geometry.PointCloud, target: o3d.geometry.PointCloud, features: feature_cache,
+                      search_radius: float = 0.05) -> np.ndarray:
+    """
+    Performs fast global registration, a rough registration from matched FPFH features.
+
+    Parameters
+    ----------
+    source : open3d.geometry.PointCloud
+        Preprocessed point cloud to register.
+    target : open3d.geometry.PointCloud
+        Preprocessed stationary point cloud.
+    features : feature_cache
+        Cache the FPFH features are taken from.
+    search_radius : float
+        Radius of the FPFH features.
+
+    Returns
+    ----------
+    transformation : np.ndarray
+        4x4 transformation of source into target's view.
+    """
+
+    source_fpfh = features.get_fpfh(source, search_radius)
+    target_fpfh = features.get_fpfh(target, search_radius)
+
+    result = o3d.pipelines.registration.registration_fgr_based_on_feature_matching(
+        source, target, source_fpfh, target_fpfh)
+
+    print("Registration with FGR complete.")
+
+    return result.transformation
+
+
+def register_with_icp(source: o3d.geometry.PointCloud, target: o3d.geometry.PointCloud, voxel_size: float,
+                      init: np.ndarray = None) -> np.ndarray:
+    """
+    Performs point-to-plane ICP.
+
+    Parameters
+    ----------
+    source : open3d.geometry.PointCloud
+        Preprocessed point cloud to register.
+    target : open3d.geometry.PointCloud
+        Preprocessed stationary point cloud.
+    voxel_size : float
+        Voxel size the clouds were preprocessed with.
+    init : np.ndarray
+        Initial transformation, e.g. from FGR, identity if None.
+
+    Returns
+    ----------
+    transformation : np.ndarray
+        4x4 transformation of source into target's view.
+    """
+
+    distance_threshold = voxel_size * 1.5
+
+    result = o3d.pipelines.registration.registration_icp(
+        source, target, distance_threshold,
+        np.eye(4) if init is None else init, o3d.pipelines.registration.TransformationEstimationPointToPlane())
+
+    print("Registration with ICP complete.")
+
+    return result.transformation
+
+
+def register_with_multiscale_icp(source: o3d.geometry.PointCloud, target: o3d.geometry.PointCloud, features: feature_cache,
+                                 voxel_sizes: tuple = (0.008, 0.004, 0.002), max_iterations: tuple = (50, 30, 14),
+                                 init: np.ndarray = None, iteration_step: int = 5, tolerance: float = 1e-4) -> tuple:
+    """
+    Performs coarse to fine point-to-plane ICP over a voxel pyramid. Each level starts from the previous level's
+    transformation, so most iterations run on the coarse clouds and only a few on the finest. ICP is run a few
+    iterations at a time, and a level ends early once its fitness and inlier RMSE stop improving.
+
+    Parameters
+    ----------
+    source : open3d.geometry.PointCloud
+        Point cloud to register.
+    target : open3d.geometry.PointCloud
+        Stationary point cloud.
+    features : feature_cache
+        Cache the downsampled clouds of each level are taken from.
+    voxel_sizes : tuple
+        Voxel size of each level, coarsest first.
+    max_iterations : tuple
+        Iteration cap of each level.
+    init : np.ndarray
+        Initial transformation, e.g. from FGR, identity if None.
+    iteration_step : int
+        Iterations run between checks for improvement.
+    tolerance : float
+        Smallest improvement in fitness or inlier RMSE (relative) that continues a level.
+
+    Returns
+    ----------
+    transformation : np.ndarray
+        4x4 transformation of source into target's view.
+    level_stats : list
+        Per-level voxel size, points, iterations, fitness, inlier RMSE, whether the level converged before its
+        cap, and seconds taken.
+    """
+
+    transformation = np.eye(4) if init is None else np.asarray(init)
+    level_stats = []
+
+    for voxel_size, max_iteration in zip(voxel_sizes, max_iterations):
+        start = time.time()
+
+        # Downsampled clouds with normals are cached, so the pyramid is only built once per cloud
+        source_down = features.get_preprocessed(source, voxel_size)
+        target_down = features.get_preprocessed(target, voxel_size)
+        distance_threshold = voxel_size * 1.5
+
+        iterations = 0
+        fitness = 0.0
+        inlier_rmse = np.inf
+        converged = False
+        while iterations < max_iteration:
+            step = min(iteration_step, max_iteration - iterations)
+            result = o3d.pipelines.registration.registration_icp(
+                source_down, target_down, distance_threshold, transformation,
+                o3d.pipelines.registration.TransformationEstimationPointToPlane(),
+                o3d.pipelines.registration.ICPConvergenceCriteria(max_iteration=step))
+            iterations += step
+
+            # Stop once neither fitness nor inlier RMSE improves by more than the tolerance
+            fitness_gain = result.fitness - fitness
+            if np.isinf(inlier_rmse):
+                rmse_gain = np.inf
+            elif inlier_rmse > 0:
+                rmse_gain = (inlier_rmse - result.inlier_rmse) / inlier_rmse
+            else:
+                rmse_gain = 0.0
+            transformation = result.transformation
+            fitness = result.fitness
+            inlier_rmse = result.inlier_rmse
+            if fitness_gain <= tolerance and rmse_gain <= tolerance:
+                converged = True
+                break
+
+        level_stats.append({"voxel_size" : voxel_size,
+                            "source_points" : len(source_down.points),
+                            "target_points" : len(target_down.points),
+                            "iterations" : iterations,
+                            "fitness" : fitness,
+                            "inlier_rmse" : inlier_rmse,
+                            "converged" : converged,
+                            "seconds" : time.time() - start})
+        print("ICP level " + str(voxel_size * 1000) + "mm: " + str(iterations) + " iterations, fitness " + "{:.4f}".format(fitness) +
+              ", inlier RMSE " + "{:.5f}".format(inlier_rmse) + (" (converged)" if converged else ""))
+
+    print("Registration with multi-scale ICP complete.")
+
+    return transformation, level_stats
+
+
+def register_pair(source_arrays: dict, target_arrays: dict, target_fpfh: np.ndarray, voxel_size: float, search_radius: float,
+                  icp_voxel_sizes: list, connection):
+    """
+    Registers one pair of point clouds with FGR, then refines the FGR transformation with ICP. Runs in its
+    own process, rebuilding the clouds from their arrays, and sends the result back through connection.
+
+    Parameters
+    ----------
+    source_arrays : dict
+        Points and normals of the preprocessed point cloud to register, from get_cloud_arrays.
+    target_arrays : dict
+        Points and normals of the preprocessed stationary point cloud, from get_cloud_arrays.
+    target_fpfh : np.ndarray
+        33xN FPFH features of the target, computed here if None.
+    voxel_size : float
+        Voxel size the clouds were preprocessed with.
+    search_radius : float
+        Radius of the FPFH features.
+    icp_voxel_sizes : list
+        Voxel pyramid for multi-scale ICP, coarsest first. Single scale ICP at voxel_size if None.
+    connection : multiprocessing.connection.Connection
+        Connection the result is sent through.
+    """
+
+    start = time.time()
+    try:
+        source = make_point_cloud(source_arrays)
+        target = make_point_cloud(target_arrays)
+
+        features = feature_cache()
+        if target_fpfh is not None:
+            fpfh = o3d.pipelines.registration.Feature()
+            fpfh.data = target_fpfh
+            features.set_fpfh(target, search_radius, fpfh)
+
+        fgr_transformation = register_with_fgr(source, target, features, search_radius)
+        if icp_voxel_sizes is None:
+            transformation = register_with_icp(source, target, voxel_size, fgr_transformation)
+            connection.send({"transformation" : transformation, "seconds" : time.time() - start})
+        else:
+            transformation, icp_levels = register_with_multiscale_icp(source, target, features, icp_voxel_sizes, init=fgr_transformation)
+            connection.send({"transformation" : transformation, "icp_levels" : icp_levels, "seconds" : time.time() - start})
+    except Exception as error:
+        connection.send({"error" : repr(error), "seconds" : time.time() - start})
+    finally:
+        connection.close()
+
+
+def register_pairs(registrar, point_clouds: list, pairs: list, voxel_size: float, search_radius: float = 0.05,
+                   timeout: float = None, num_workers: int = None, icp_voxel_sizes: list = None) -> dict:
+    """
+    Registers pairs of point clouds in parallel, each pair in its own worker process. At most num_workers
+    pairs run at once. A pair still running timeout seconds after it started has its process terminated.
+
+    Workers are spawned rather than forked, since Open3D's OpenMP threads do not survive a fork, and are sent
+    the clouds as NumPy arrays. FPFH features of targets shared by several pairs are computed once here, from
+    the registrar's feature cache, and sent along with the clouds instead of each worker computing them again.
+    Scripts using this must guard their entry point with if __name__ == "__main__", as workers import them.
+
+    Parameters
+    ----------
+    registrar : processor
+        Processor whose feature cache computes the FPFH features of shared targets.
+    point_clouds : list
+        Preprocessed point clouds, with normals.
+    pairs : list
+        (source index, target index) of each pair to register.
+    voxel_size : float
+        Voxel size the clouds were preprocessed with.
+    search_radius : float
+        Radius of the FPFH features.
+    timeout : float
+        Seconds each pair may run for. Unlimited if None.
+    num_workers : int
+        Number of pairs registered at once. Defaults to the number of CPUs.
+    icp_voxel_sizes : list
+        Voxel pyramid for multi-scale ICP, coarsest first. Single scale ICP at voxel_size if None.
+
+    Returns
+    ----------
+    results : dict
+        Keyed by pair, the 4x4 "transformation" of source into target's view, the per-level "icp_levels" stats
+        of multi-scale ICP and the "seconds" it took, or the "error" raised. None for pairs that timed out.
+    """
+
+    num_workers = num_workers or os.cpu_count() or 1
+
+    cloud_arrays = {}
+    for pair in pairs:
+        for index in pair:
+            if index not in cloud_arrays:
+                cloud_arrays[index] = get_cloud_arrays(point_clouds[index])
+
+    target_indices = [target_index for _, target_index in pairs]
+    target_fpfhs = {}
+    for target_index in set(target_indices):
+        if target_indices.count(target_index) > 1:
+            target_fpfhs[target_index] = np.asarray(registrar.registration_features.get_fpfh(point_clouds[target_index], search_radius).data)
+
+    context = multiprocessing.get_context("spawn")
+
+    results = {}
+    jobs = iter(pairs)
+    running = {}
+    while True:
+        # Keep num_workers pairs running
+        for pair in jobs:
+            receiver, sender = context.Pipe(duplex=False)
+            process = context.Process(target=register_pair, args=(cloud_arrays[pair[0]], cloud_arrays[pair[1]], target_fpfhs.get(pair[1]),
+                                                                  voxel_size, search_radius, icp_voxel_sizes, sender),
+                                      daemon=True)
+            process.start()
+            sender.close()
+            running[receiver] = (pair, process, time.time())
+            if len(running) >= num_workers:
+                break
+
+        if len(running) == 0:
+            break
+
+        # Wake up for the first result, or the first pair to reach its timeout
+        wait_time = None
+        if timeout is not None:
+            wait_time = max(0.0, min(started + timeout for _, _, started in running.values()) - time.time())
+
+        ready = wait(list(running), wait_time)
+        for receiver in ready:
+            pair, process, _ = running.pop(receiver)
+            try:
+                results[pair] = receiver.recv()
+            except EOFError:
+                results[pair] = {"error" : "worker exited with code " + str(process.exitcode)}
+            receiver.close()
+            process.join()
+
+            if "error" in results[pair]:
+                print("Registration of " + str(pair[0]) + " to " + str(pair[1]) + " failed: " + results[pair]["error"])
+            else:
+                print("Registered " + str(pair[0]) + " to " + str(pair[1]) + " in " + "{:.2f}".format(results[pair]["seconds"]) + "s")
+
+        # Stop pairs that have run out of time
+        if timeout is not None:
+            for receiver, (pair, process, started) in list(running.items()):
+                if time.time() - started >= timeout:
+                    process.terminate()
+                    process.join()
+                    receiver.close()
+                    del running[receiver]
+                    results[pair] = None
+                    print("Registration of " + str(pair[0]) + " to " + str(pair[1]) + " timed out after " + str(timeout) + "s")
+
+    return results
@@ -7,17 +7,88 @@
 #define STB_IMAGE_WRITE_IMPLEMENTATION
 #include "stb_image_write.h"
 
+#include <algorithm>
+#include <atomic>
+#include <chrono>
+#include <condition_variable>
+#include <cstdlib>
+#include <cstdio>
 #include <fstream>
 #include <iostream>
 #include <sstream>
 #include <iomanip>
+#include <deque>
+#include <mutex>
+#include <stdexcept>
+#include <string>
 #include <thread>
 #include <utility>
 #include <vector>
 
 
+// Capture settings, set from the optional command line arguments
+struct capture_settings
+{
+    int fps = 15;
+    int depth_width = 1280;
+    int depth_height = 720;
+    int colour_width = 424;
+    int colour_height = 240;
+    bool depth = true;
+    bool colour = true;
+    int decimation = 3;         // Decimation filter magnitude, 1 disables the filter
+    bool spatial = true;
+    float spatial_alpha = 0.6f;
+    float spatial_delta = 20.0f;
+    bool daemon = false;        // Keep the pipeline running and record on commands from stdin
+    int writers = 4;            // Number of threads saving frames
+    int queue_size = 30;        // Framesets waiting to be saved before new ones are dropped
+};
+
+
+// Parses a "<width>x<height>" resolution
+void parse_resolution(const std::string& value, int& width, int& height)
+{
+    if (sscanf(value.c_str(), "%dx%d", &width, &height) != 2)
+        throw std::invalid_argument("Invalid resolution: " + value);
+}
+
+
+// Parses the optional "--<name> <value>" arguments that follow the number of frames and raspberry pi name
+capture_settings parse_capture_settings(int argc, char * argv[])
+{
+    capture_settings settings;
+
+    for (int i = 3; i + 1 < argc; i += 2)
+    {
+        std::string name = argv[i];
+        std::string value = argv[i + 1];
+
+        if (name == "--fps") settings.fps = std::stoi(value);
+        else if (name == "--depth") parse_resolution(value, settings.depth_width, settings.depth_height);
+        else if (name == "--colour") parse_resolution(value, settings.colour_width, settings.colour_height);
+        else if (name == "--streams")
+        {
+            settings.depth = value.find("depth") != std::string::npos;
+            settings.colour = value.find("colour") != std::string::npos;
+        }
+        else if (name == "--decimation") settings.decimation = std::stoi(value);
+        else if (name == "--spatial") settings.spatial = value != "0";
+        else if (name == "--spatial-alpha") settings.spatial_alpha = std::stof(value);
+        else if (name == "--spatial-delta") settings.spatial_delta = std::stof(value);
+        else if (name == "--daemon") settings.daemon = value != "0";
+        else if (name == "--writers") settings.writers = std::max(1, std::stoi(value));
+        else if (name == "--queue-size") settings.queue_size = std::max(1, std::stoi(value));
+        else throw std::invalid_argument("Unknown argument: " + name);
+    }
+
+    return settings;
+}
+
+
 // Saves metadata to a text file
-void metadata_to_text(const rs2::frame& frm, const std::string& file_name)
+// Writes a frame's metadata to a text file, returns false if the file could not be written
+bool metadata_to_text(const rs2::frame& frm, const std::string& file_name)
 {
     // Create and open text file for the metadata
     std::ofstream text_metadata_file;
@@ -36,26 +107,82 @@ void metadata_to_text(const rs2::frame& frm, const std::string& file_name)
     }
 
     text_metadata_file.close();
+    return !text_metadata_file.fail();
+}
+
+
+// Reports a file as completely written. raspi_control.py reads these lines to know which files can be uploaded
+// while the capture is still running, so each line is written whole even with several writer threads.
+void print_saved(const std::string& file_name)
+{
+    static std::mutex print_mutex;
+    std::lock_guard<std::mutex> lock(print_mutex);
+    std::cout << ("Saved " + file_name + "\n") << std::flush;
+}
+
+
+// Reports a file that could not be written, it is not reported as saved so it is never uploaded
+void print_write_failed(const std::string& file_name)
+{
+    std::cerr << ("Failed to write " + file_name + "\n") << std::flush;
+}
+
+
+// Appends the encoded png stb_image_write hands over to the file, counting the bytes written
+struct png_file
+{
+    std::ofstream file;
+    size_t bytes_written = 0;
+};
+
+void write_png_data(void* context, void* data, int size)
+{
+    png_file* png = static_cast<png_file*>(context);
+    png->file.write(static_cast<const char*>(data), size);
+    png->bytes_written += size;
 }
 
 
-void save_frame_depth_data(const std::string& pi_name, rs2::frame frame)
+// Depth filters, configured once and reused for every frame. Filters keep state, so each writer has its own.
+struct depth_filters
 {
-    // Create filters
+    capture_settings settings;
     rs2::decimation_filter dec_filter;
     rs2::spatial_filter spat_filter;
-    rs2::disparity_transform depth_to_disparity(true);
-    rs2::disparity_transform disparity_to_depth(false);
+    rs2::disparity_transform depth_to_disparity;
+    rs2::disparity_transform disparity_to_depth;
+
+    explicit depth_filters(const capture_settings& capture_settings)
+        : settings(capture_settings), depth_to_disparity(true), disparity_to_depth(false)
+    {
+        if (settings.decimation > 1)
+            dec_filter.set_option(RS2_OPTION_FILTER_MAGNITUDE, settings.decimation);
+        spat_filter.set_option(RS2_OPTION_FILTER_SMOOTH_ALPHA, settings.spatial_alpha);
+        spat_filter.set_option(RS2_OPTION_FILTER_SMOOTH_DELTA, settings.spatial_delta);
+    }
+
+    rs2::frame process(rs2::frame frame)
+    {
+        if (settings.decimation > 1)
+            frame = dec_filter.process(frame);
+        if (settings.spatial)
+        {
+            frame = depth_to_disparity.process(frame);
+            frame = spat_filter.process(frame);
+            frame = disparity_to_depth.process(frame);
+        }
+        return frame;
+    }
+};
 
-    // Configure filters
-    dec_filter.set_option(RS2_OPTION_FILTER_MAGNITUDE, 3);
-    spat_filter.set_option(RS2_OPTION_FILTER_SMOOTH_ALPHA, 0.6f); // Delta is 20 by default
+
+// Saves a depth frame and its metadata, returns the number of bytes of depth written
+size_t save_frame_depth_data(const std::string& pi_name, depth_filters& filters, rs2::frame frame)
+{
+    size_t bytes_written = 0;
 
     // Filter depth frame
-    frame = dec_filter.process(frame);
-    frame = depth_to_disparity.process(frame);
-    frame = spat_filter.process(frame);
-    frame = disparity_to_depth.process(frame);
+    frame = filters.process(frame);
 
     // We can only save video frames, so we skip the rest
     if (auto image = frame.as<rs2::video_frame>())
@@ -65,23 +192,37 @@ void save_frame_depth_data(const std::string& pi_name, rs2::frame frame)
         file_name << "depth/" << pi_name << "_depth_" << frame.get_frame_number() << ".raw";
 
         std::ofstream outfile(file_name.str(), std::ofstream::binary);
-        outfile.write(static_cast<const char*>(image.get_data()), image.get_width() * image.get_height() * image.get_bytes_per_pixel());
-
-        std::cout << "Saved " << file_name.str() << std::endl;
+        size_t frame_bytes = image.get_width() * image.get_height() * image.get_bytes_per_pixel();
+        outfile.write(static_cast<const char*>(image.get_data()), frame_bytes);
         outfile.close();
+        if (outfile.fail())
+            print_write_failed(file_name.str());
+        else
+        {
+            bytes_written = frame_bytes;
+            print_saved(file_name.str());
+        }
 
         // Create metadata file name
         std::stringstream text_metadata_file;
         text_metadata_file << "depth_metadata/" << pi_name << "_depth_metadata_" << image.get_frame_number() << ".txt";
 
         // Record per-frame metadata for UVC streams
-        metadata_to_text(image, text_metadata_file.str());
+        if (metadata_to_text(image, text_metadata_file.str()))
+            print_saved(text_metadata_file.str());
+        else
+            print_write_failed(text_metadata_file.str());
     }
+
+    return bytes_written;
 }
 
 
-void save_frame_color_data(const std::string& pi_name, rs2::frame frame)
+// Saves a colour frame as a png and its metadata, returns the size of the png
+size_t save_frame_color_data(const std::string& pi_name, rs2::frame frame)
 {
+    size_t bytes_written = 0;
+
     // We can only save video frames as pngs, so we skip the rest
     if (auto image = frame.as<rs2::video_frame>())
     {
@@ -90,20 +231,280 @@ void save_frame_color_data(const std::string& pi_name, rs2::frame frame)
         png_colour_file << "colour/" << pi_name << "_colour_" << frame.get_frame_number() << ".png";
 
         // Convert colour frame to a png and save it
-        stbi_write_png(png_colour_file.str().c_str(), image.get_width(), image.get_height(),
-                       image.get_bytes_per_pixel(), image.get_data(), image.get_stride_in_bytes());
-        std::cout << "Saved " << png_colour_file.str() << std::endl;
+        png_file png;
+        png.file.open(png_colour_file.str(), std::ofstream::binary);
+        bool encoded = png.file.is_open() &&
+                       stbi_write_png_to_func(write_png_data, &png, image.get_width(), image.get_height(),
+                                              image.get_bytes_per_pixel(), image.get_data(), image.get_stride_in_bytes());
+        png.file.close();
+        if (!encoded || png.file.fail())
+            print_write_failed(png_colour_file.str());
+        else
+        {
+            bytes_written = png.bytes_written;
+            print_saved(png_colour_file.str());
+        }
 
         // Create metadata file name
         std::stringstream text_metadata_file;
         text_metadata_file << "colour_metadata/" << pi_name << "_colour_metadata_" << frame.get_frame_number() << ".txt";
 
         // Record per-frame metadata for UVC streams
-        metadata_to_text(image, text_metadata_file.str());
+        if (metadata_to_text(image, text_metadata_file.str()))
+            print_saved(text_metadata_file.str());
+        else
+            print_write_failed(text_metadata_file.str());
     }
 
+    return bytes_written;
 }
 
+// Fixed number of writer threads saving framesets from a bounded queue. Framesets that arrive while the
+// queue is full are dropped and counted, so memory use stays bounded however slow the storage is.
+class frame_writer_pool
+{
+public:
+    frame_writer_pool(const std::string& raspi_name, const capture_settings& settings)
+        : raspi_name(raspi_name), settings(settings)
+    {
+        for (int i = 0; i < settings.writers; ++i)
+            writers.emplace_back(&frame_writer_pool::work, this);
+    }
+
+    ~frame_writer_pool()
+    {
+        stop();
+    }
+
+    // Queues a frameset to be saved, returns false if it was dropped
+    bool push(rs2::frameset data)
+    {
+        std::lock_guard<std::mutex> lock(mutex);
+        ++framesets_received;
+        if (static_cast<int>(queue.size()) >= settings.queue_size)
+        {
+            ++framesets_dropped;
+            return false;
+        }
+
+        if (framesets_received == 1)
+            first_push = std::chrono::steady_clock::now();
+
+        // Keep the frames out of the pipeline's frame pool while they wait
+        data.keep();
+        queue.push_back(data);
+        max_queue_depth = std::max(max_queue_depth, static_cast<long>(queue.size()));
+        work_available.notify_one();
+        return true;
+    }
+
+    // Waits until every queued frameset has been saved
+    void wait_idle()
+    {
+        std::unique_lock<std::mutex> lock(mutex);
+        idle.wait(lock, [this]() { return queue.empty() && busy_writers == 0; });
+    }
+
+    void reset_stats()
+    {
+        std::lock_guard<std::mutex> lock(mutex);
+        framesets_received = framesets_saved = framesets_dropped = max_queue_depth = 0;
+        bytes_written = 0;
+        latencies_ms.clear();
+        first_push = last_save = std::chrono::steady_clock::now();
+    }
+
+    // Prints the stats of the capture on one line for raspi_control.py: framesets received, saved and dropped,
+    // maximum queue depth, per-frameset write latency percentiles, bytes written, the seconds from the
+    // first frameset being queued to the last being saved, and whether the capture timed out waiting for frames
+    void print_stats(bool timed_out = false)
+    {
+        std::lock_guard<std::mutex> lock(mutex);
+
+        std::vector<double> latencies(latencies_ms);
+        std::sort(latencies.begin(), latencies.end());
+        auto percentile = [&latencies](double p)
+        {
+            return latencies.empty() ? 0.0 : latencies[static_cast<size_t>(p * (latencies.size() - 1) + 0.5)];
+        };
+        double write_seconds = std::max(0.0, std::chrono::duration<double>(last_save - first_push).count());
+
+        std::cout << "STATS received=" << framesets_received << " saved=" << framesets_saved
+                  << " dropped=" << framesets_dropped << " max_queue_depth=" << max_queue_depth
+                  << " writers=" << settings.writers << " queue_size=" << settings.queue_size
+                  << " latency_p50_ms=" << percentile(0.5) << " latency_p95_ms=" << percentile(0.95)
+                  << " latency_p99_ms=" << percentile(0.99) << " latency_max_ms=" << percentile(1.0)
+                  << " bytes_written=" << bytes_written << " write_seconds=" << write_seconds
+                  << " timed_out=" << (timed_out ? 1 : 0) << std::endl;
+
+        if (timed_out)
+            std::cerr << "WARNING: the camera stopped delivering frames, only " << framesets_received << " framesets "
+                      << "were recorded" << std::endl;
+
+        // Dropped framesets still count towards the frames asked for, so the capture saved fewer
+        if (framesets_dropped > 0)
+            std::cerr << "WARNING: " << framesets_dropped << " of " << framesets_received << " framesets were dropped as the "
+                      << "writer queue was full, increase --writers or --queue-size" << std::endl;
+    }
+
+    // Saves the framesets still queued and stops the writers
+    void stop()
+    {
+        {
+            std::lock_guard<std::mutex> lock(mutex);
+            stopping = true;
+        }
+        work_available.notify_all();
+        for (auto &t : writers)
+        {
+            if (t.joinable())
+                t.join();
+        }
+    }
+
+private:
+    void work()
+    {
+        depth_filters filters(settings);
+
+        while (true)
+        {
+            rs2::frameset data;
+            {
+                std::unique_lock<std::mutex> lock(mutex);
+                work_available.wait(lock, [this]() { return stopping || !queue.empty(); });
+                if (queue.empty())
+                    return;
+                data = queue.front();
+                queue.pop_front();
+                ++busy_writers;
+            }
+
+            auto start = std::chrono::steady_clock::now();
+            size_t frameset_bytes = 0;
+            if (settings.depth)
+                frameset_bytes += save_frame_depth_data(raspi_name, filters, data.get_depth_frame());
+            if (settings.colour)
+                frameset_bytes += save_frame_color_data(raspi_name, data.get_color_frame());
+            auto end = std::chrono::steady_clock::now();
+
+            {
+                std::lock_guard<std::mutex> lock(mutex);
+                --busy_writers;
+                ++framesets_saved;
+                bytes_written += frameset_bytes;
+                latencies_ms.push_back(std::chrono::duration<double, std::milli>(end - start).count());
+                last_save = end;
+            }
+            idle.notify_all();
+        }
+    }
+
+    std::string raspi_name;
+    capture_settings settings;
+    std::vector<std::thread> writers;
+    std::deque<rs2::frameset> queue;
+    std::mutex mutex;
+    std::condition_variable work_available;
+    std::condition_variable idle;
+    bool stopping = false;
+    int busy_writers = 0;
+    long framesets_received = 0;
+    long framesets_saved = 0;
+    long framesets_dropped = 0;
+    long max_queue_depth = 0;
+    size_t bytes_written = 0;
+    std::vector<double> latencies_ms;
+    std::chrono::steady_clock::time_point first_push = std::chrono::steady_clock::now();
+    std::chrono::steady_clock::time_point last_save = first_push;
+};
+
+
+// Seconds a recording may take beyond its length at the configured frame rate before it is abandoned
+const int record_timeout_margin = 10;
+
+
+// Keeps the pipeline running, so auto-exposure stays settled, and records frames when told to on stdin.
+// Commands are "RECORD <num_frames>" and "QUIT". "READY" is printed once frames can be recorded, and the
+// recording's stats and "DONE" once each recording has been saved, or has timed out because the camera
+// stopped delivering frames.
+int run_daemon(rs2::pipeline& pipe, const std::string& raspi_name, const capture_settings& settings)
+{
+    std::atomic<bool> running(true);
+    frame_writer_pool pool(raspi_name, settings);
+
+    // Frames left to record, set by the control thread and counted down by the capture thread
+    std::mutex record_mutex;
+    std::condition_variable recorded;
+    long frames_to_record = 0;
+
+    std::thread capture_thread([&]()
+    {
+        while (running)
+        {
+            // Frames that are not recorded are dropped, the timeout lets the thread notice QUIT
+            rs2::frameset data;
+            if (!pipe.try_wait_for_frames(&data, 1000))
+                continue;
+
+            {
+                std::lock_guard<std::mutex> lock(record_mutex);
+                if (frames_to_record <= 0)
+                    continue;
+            }
+
+            // Queue the frameset before counting it, so the recording is only complete once it is queued
+            pool.push(data);
+
+            std::lock_guard<std::mutex> lock(record_mutex);
+            if (--frames_to_record == 0)
+                recorded.notify_all();
+        }
+    });
+
+    std::cout << "READY" << std::endl;
+
+    std::string line;
+    while (std::getline(std::cin, line))
+    {
+        std::istringstream command(line);
+        std::string name;
+        command >> name;
+
+        if (name == "RECORD")
+        {
+            long num_frames = 0;
+            command >> num_frames;
+            pool.reset_stats();
+
+            // Wait for the recording here, so commands sent meanwhile stay queued on stdin and a recording
+            // is never restarted halfway through. Give up if the camera stops delivering frames
+            bool timed_out;
+            {
+                std::unique_lock<std::mutex> lock(record_mutex);
+                frames_to_record = num_frames;
+                auto timeout = std::chrono::seconds(num_frames / std::max(1, settings.fps) + record_timeout_margin);
+                timed_out = !recorded.wait_for(lock, timeout, [&]() { return frames_to_record <= 0; });
+                frames_to_record = 0;
+            }
+
+            pool.wait_idle();
+            pool.print_stats(timed_out);
+            std::cout << "DONE" << std::endl;
+        }
+        else if (name == "QUIT")
+            break;
+    }
+
+    running = false;
+    capture_thread.join();
+    pool.stop();
+    pipe.stop();
+
+    return EXIT_SUCCESS;
+}
+
+
 // Capture depth and color video streams and store them in specific files
 int main(int argc, char * argv[]) try
 {
@@ -116,10 +517,20 @@ int main(int argc, char * argv[]) try
         return EXIT_FAILURE;
     }
 
+    if (argc < 3) {
+        std::cerr << "Usage: capture <num_frames> <raspi_name> [--fps N] [--depth WxH] [--colour WxH] "
+                     "[--streams depth,colour] [--decimation N] [--spatial 0|1] [--spatial-alpha A] [--spatial-delta D] "
+                     "[--daemon 0|1] [--writers N] [--queue-size N]" << std::endl;
+        return EXIT_FAILURE;
+    }
+    capture_settings settings = parse_capture_settings(argc, argv);
+
     // Congifure the streaming configurations
     rs2::config cfg;
-    cfg.enable_stream(RS2_STREAM_DEPTH, 1280, 720, RS2_FORMAT_Z16, 15);
-    cfg.enable_stream(RS2_STREAM_COLOR, 424, 240, RS2_FORMAT_RGB8, 15);
+    if (settings.depth)
+        cfg.enable_stream(RS2_STREAM_DEPTH, settings.depth_width, settings.depth_height, RS2_FORMAT_Z16, settings.fps);
+    if (settings.colour)
+        cfg.enable_stream(RS2_STREAM_COLOR, settings.colour_width, settings.colour_height, RS2_FORMAT_RGB8, settings.fps);
 
     // Create pipe and start it
     rs2::pipeline pipe;
@@ -135,23 +546,21 @@ int main(int argc, char * argv[]) try
     // Capture 30 frames to give autoexposure, etc. a chance to settle
     for (auto i = 0; i < 30; ++i) pipe.wait_for_frames();
 
-    // Create a vector to store threads
-    std::vector<std::thread> threads;
+    // Stay running and record on command
+    if (settings.daemon)
+        return run_daemon(pipe, raspi_name, settings);
+
+    // Save the frames on a fixed pool of writer threads
+    frame_writer_pool pool(raspi_name, settings);
     for (auto i = 0; i < num_frames; ++i)
     {
         rs2::frameset data = pipe.wait_for_frames();
-
-        // Create a thread for each frame and process it in parallel
-        threads.emplace_back(save_frame_depth_data, raspi_name, data.get_depth_frame());
-        threads.emplace_back(save_frame_color_data, raspi_name, data.get_color_frame());
+        pool.push(data);
     }
 
-    // Ensure all threads are done before terminating program
-    for (auto &t : threads)
-    {
-        if (t.joinable())
-            t.join();
-    }
+    // Ensure all frames are saved before terminating program
+    pool.stop();
+    pool.print_stats();
 
     return EXIT_SUCCESS;
 }
@@ -1,35 +1,479 @@
 import os
-import shutil
+import re
 import socket
 import subprocess
+import tarfile
+import threading
+import io
+import json
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import requests
 import time
+
+
+# Folders written by the capture binary
+CAPTURE_FOLDERS = ["colour", "depth", "colour_metadata", "depth_metadata"]
+
+# Size of the chunks a capture is streamed to the Orin Nano in
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Compressed depth frames start with this magic followed by the codec id, and are sent with this extension added.
+# Copy of the wire format defined in orin/depth_codec.py, which is the source of truth, so change both together
+DEPTH_CODEC_MAGIC = b"DZ16"
+DEPTH_CODEC_EXTENSION = ".dz"
+DEPTH_CODECS = {"zlib" : 0, "zstd" : 1}
+
+# Settings of the pi, module defaults so the functions also work when imported, the main program sets its own
+pi_name = socket.gethostname()
+fps = 15
+stream_during_capture = False
+depth_codec = None
+depth_codec_pool = None
+use_capture_daemon = False
+
+# Capture daemon started by get_capture_daemon, and the session uploads reuse
+running_capture_daemon = None
+session = None
+
+# Id of the last command executed, so copies resent by the Orin Nano are only acknowledged
+last_command_id = None
+
+# Telemetry of the last capture, sent to the Orin Nano with its upload
+capture_telemetry = None
+
+# Matches the frame number at the end of a captured frame's filename, e.g. "raspi1_depth_1234.raw"
+FRAME_NUMBER_PATTERN = re.compile(r"_(\d+)\.(raw|png)$")
+
+# Bits of "vcgencmd get_throttled" that are set while the condition is happening
+THROTTLED_FLAGS = {"under_voltage" : 0, "frequency_capped" : 1, "throttled" : 2, "soft_temperature_limit" : 3}
                           
 
 def create_file_directories():
     """
-    Deletes previously captured data, if any, and creates new file directories for 
-    the new data.
+    Deletes previously captured data, if any, and creates the file directories for the new data if
+    they do not exist. The directories themselves are kept between captures.
+    """
+    
+    for folder_path in CAPTURE_FOLDERS:
+        # Creates new directories for the camera data
+        os.makedirs(folder_path, exist_ok=True)
+        
+        # Deletes the files of the previous capture
+        for entry in os.scandir(folder_path):
+            if entry.is_file():
+                os.remove(entry.path)
+    
+
+def get_capture_command(num_frames: int, pi: str, parameters: dict = None) -> list:
+    """
+    Builds the command line of the capture binary. Capture parameters that are not given are left to the 
+    binary's defaults (15 fps, 1280x720 depth decimated by 3, 424x240 colour, spatial filter on).
+    
+    Parameters
+    ----------
+    num_frames : int
+        The total number of frames to capture.
+    pi : str
+        The hostname of the raspberry pi.
+    parameters : dict
+        Capture parameters sent by the Orin Nano: fps, depth_resolution and colour_resolution ("<width>x<height>"), 
+        streams (list of "depth" and "colour"), decimation, spatial, spatial_alpha, spatial_delta, and writers 
+        and queue_size (number of threads saving frames and framesets queued for them before frames are dropped).
+    
+    Returns
+    ----------
+    command : list
+        The capture binary and its arguments.
+    """
+    
+    command = ["./capture", str(num_frames), pi]
+    parameters = parameters or {}
+    
+    # Capture binary argument of each parameter
+    arguments = {"fps" : "--fps",
+                 "depth_resolution" : "--depth",
+                 "colour_resolution" : "--colour",
+                 "streams" : "--streams",
+                 "decimation" : "--decimation",
+                 "spatial" : "--spatial",
+                 "spatial_alpha" : "--spatial-alpha",
+                 "spatial_delta" : "--spatial-delta",
+                 "writers" : "--writers",
+                 "queue_size" : "--queue-size"}
+    
+    for name, argument in arguments.items():
+        if parameters.get(name) is None:
+            continue
+        value = parameters[name]
+        if isinstance(value, list):
+            value = ",".join(value)
+        elif isinstance(value, bool):
+            value = int(value)
+        command += [argument, str(value)]
+        
+    return command
+
+
+def parse_capture_stats(line: str) -> dict:
+    """
+    Parses the "STATS <name>=<value> ..." line the capture binary prints once a capture has been saved.
+    
+    Parameters
+    ----------
+    line : str
+        The stats line.
+    
+    Returns
+    ----------
+    stats : dict
+        Framesets received, saved and dropped, the maximum writer queue depth, the writer pool settings,
+        the frameset write latency percentiles in ms, the bytes written over how many seconds, and timed_out,
+        1 if the camera stopped delivering frames before the capture was complete.
+    """
+    
+    stats = {}
+    for field in line.split()[1:]:
+        name, _, value = field.partition("=")
+        stats[name] = int(value) if value.lstrip("-").isdigit() else float(value)
+        
+    return stats
+
+
+def read_capture_output(output, reply: str = None, on_saved=None) -> dict:
+    """
+    Reads the capture binary's output until it prints reply, or until it exits if reply is None.
+    
+    Parameters
+    ----------
+    output : file
+        The capture binary's stdout.
+    reply : str
+        Line to stop at.
+    on_saved : callable
+        Called with the path of every file the binary reports as completely written ("Saved <path>").
+    
+    Returns
+    ----------
+    stats : dict
+        The capture stats, see parse_capture_stats. Empty if the binary printed none. None if the binary 
+        exited before printing reply.
+    """
+    
+    stats = {}
+    for line in output:
+        line = line.strip()
+        if line.startswith("STATS"):
+            stats = parse_capture_stats(line)
+        elif line.startswith("Saved ") and on_saved is not None:
+            on_saved(line[len("Saved ") : ])
+        elif reply is not None and line == reply:
+            return stats
+        
+    return stats if reply is None else None
+
+
+def get_pipeline_parameters(parameters: dict = None) -> dict:
+    """
+    Gets the capture parameters that configure the camera pipeline, i.e. all of them except the duration.
+    Parameters that are None are left out.
+    """
+    
+    return {name : value for name, value in (parameters or {}).items() if name != "duration" and value is not None}
+
+
+class capture_daemon:
+    """
+    Long-lived capture binary (--daemon 1) that keeps the camera pipeline streaming between captures, so a 
+    capture starts recording on the next frame instead of after device enumeration, pipeline start-up and 
+    the warm-up frames.
+    """
+    
+    def __init__(self, pi: str, parameters: dict = None):
+        """
+        Constructor. Starts the capture binary and waits until its pipeline is warm.
+        
+        Parameters
+        ----------
+        pi : str
+            The hostname of the raspberry pi.
+        parameters : dict
+            Capture parameters forwarded to the capture binary, see get_capture_command.
+        
+        Returns
+        ----------
+        daemon : capture_daemon
+            A capture_daemon object.
+        """
+        
+        self.pi = pi
+        self.parameters = get_pipeline_parameters(parameters)
+        self.start()
+    
+    def start(self):
+        """
+        Starts the capture binary and waits until its pipeline is warm.
+        """
+        
+        self.process = subprocess.Popen(get_capture_command(0, self.pi, self.parameters) + ["--daemon", "1"],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True, bufsize=1)
+        read_capture_output(self.process.stdout, "READY")
+    
+    def is_running(self) -> bool:
+        return self.process.poll() is None
+    
+    def record(self, num_frames: int, on_saved=None, timeout_margin: float = 30.0) -> dict:
+        """
+        Records num_frames frames and waits for them to be saved. If the capture binary has not finished 
+        timeout_margin seconds after the frames should have been captured, it is killed and restarted.
+        
+        Parameters
+        ----------
+        num_frames : int
+            The total number of frames to capture.
+        on_saved : callable
+            Called with the path of every file as soon as it is completely written.
+        timeout_margin : float
+            Seconds the capture may take beyond its length at the capture frame rate.
+        
+        Returns
+        ----------
+        stats : dict
+            The capture stats, see parse_capture_stats. None if the capture binary exited or timed out.
+        """
+        
+        try:
+            self.process.stdin.write("RECORD " + str(num_frames) + "\n")
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            return None
+        
+        # Read on another thread, so a capture binary that stops responding cannot block the pi forever
+        stats = [None]
+        def read():
+            stats[0] = read_capture_output(self.process.stdout, "DONE", on_saved)
+        reader = threading.Thread(target=read, daemon=True)
+        reader.start()
+        reader.join(num_frames / int(self.parameters.get("fps", fps)) + timeout_margin)
+        
+        if reader.is_alive():
+            print("Capture daemon did not finish recording, restarting it")
+            self.process.kill()
+            self.process.wait()
+            reader.join()
+            self.start()
+            return None
+        
+        return stats[0]
+    
+    def stop(self):
+        """
+        Stops the capture binary.
+        """
+        
+        if self.is_running():
+            try:
+                self.process.stdin.write("QUIT\n")
+                self.process.stdin.flush()
+            except BrokenPipeError:
+                pass
+        self.process.wait()
+
+
+def get_capture_daemon(pi: str, parameters: dict = None) -> capture_daemon:
+    """
+    Gets the running capture daemon. It is (re)started if it is not running or was started with different
+    pipeline parameters.
+    
+    Parameters
+    ----------
+    pi : str
+        The hostname of the raspberry pi.
+    parameters : dict
+        Capture parameters forwarded to the capture binary, see get_capture_command.
+    
+    Returns
+    ----------
+    daemon : capture_daemon
+        The running capture daemon.
+    """
+    
+    global running_capture_daemon
+    
+    if running_capture_daemon is not None:
+        if running_capture_daemon.is_running() and running_capture_daemon.parameters == get_pipeline_parameters(parameters):
+            return running_capture_daemon
+        running_capture_daemon.stop()
+    
+    running_capture_daemon = capture_daemon(pi, parameters)
+    
+    return running_capture_daemon
+
+
+def run_capture(num_frames: int, pi: str, parameters: dict = None, on_saved=None) -> dict:
     """
+    Records num_frames frames, with the capture daemon if it is used, else with a new capture process.
     
-    # Checkes if directories exist
-    if os.path.exists(f"colour"):
-        shutil.rmtree(f"colour")
-    if os.path.exists(f"depth"):
-        shutil.rmtree(f"depth")
-    if os.path.exists(f"colour_metadata"):
-        shutil.rmtree(f"colour_metadata")
-    if os.path.exists(f"depth_metadata"):
-        shutil.rmtree(f"depth_metadata")
+    Parameters
+    ----------
+    num_frames : int
+        The total number of frames to capture.
+    pi : str
+        The hostname of the raspberry pi.
+    parameters : dict
+        Capture parameters forwarded to the capture binary, see get_capture_command.
+    on_saved : callable
+        Called with the path of every file as soon as it is completely written.
     
-    # Creates new directories for the camera data       
-    os.makedirs(f"colour", exist_ok=True)
-    os.makedirs(f"depth", exist_ok=True)
-    os.makedirs(f"colour_metadata", exist_ok=True)
-    os.makedirs(f"depth_metadata", exist_ok=True)
+    Returns
+    ----------
+    stats : dict
+        The capture stats, see parse_capture_stats. None if the capture failed.
+    """
     
+    if use_capture_daemon:
+        stats = get_capture_daemon(pi, parameters).record(num_frames, on_saved)
+    else:
+        process = subprocess.Popen(get_capture_command(num_frames, pi, parameters), stdout=subprocess.PIPE, text=True)
+        stats = read_capture_output(process.stdout, on_saved=on_saved)
+        if process.wait() != 0:
+            print(f"Error executing capture: exit status {process.returncode}")
+            stats = None
+            
+    if stats:
+        print(f"Framesets received: {stats['received']}, saved: {stats['saved']}, dropped: {stats['dropped']}, "
+              f"max writer queue depth: {stats['max_queue_depth']}/{stats['queue_size']}")
+        if stats.get("timed_out"):
+            print(f"Warning: the camera stopped delivering frames, {stats['received']} of {num_frames} framesets were recorded")
+    
+    return stats
 
-def capture(num_frames: int, duration: int, pi: str):
+
+def get_frame_numbers(folder_path: str) -> list:
+    """
+    Gets the sorted frame numbers of the frames saved in a capture folder.
+    """
+    
+    frame_numbers = []
+    for filename in os.listdir(folder_path):
+        frame_number = FRAME_NUMBER_PATTERN.search(filename)
+        if frame_number is not None:
+            frame_numbers.append(int(frame_number.group(1)))
+            
+    return sorted(frame_numbers)
+
+
+def read_cpu_temperature() -> float:
+    """
+    Reads the CPU temperature in degrees Celsius. None if it cannot be read.
+    """
+    
+    try:
+        with open("/sys/class/thermal/thermal_zone0/temp", "r") as file:
+            return int(file.read().strip()) / 1000
+    except (OSError, ValueError):
+        return None
+
+
+def read_throttling() -> dict:
+    """
+    Reads the throttling state of the raspberry pi with vcgencmd. None if it cannot be read.
+    
+    Returns
+    ----------
+    throttling : dict
+        The raw throttled value, and whether each condition is happening now and has happened since boot.
+    """
+    
+    try:
+        output = subprocess.run(["vcgencmd", "get_throttled"], capture_output=True, text=True, timeout=5).stdout
+        throttled = int(output.strip().partition("=")[2], 16)
+    except (OSError, ValueError, subprocess.TimeoutExpired):
+        return None
+    
+    throttling = {"throttled_value" : hex(throttled)}
+    for name, bit in THROTTLED_FLAGS.items():
+        throttling[name] = bool(throttled & (1 << bit))
+        throttling[name + "_since_boot"] = bool(throttled & (1 << (bit + 16)))
+        
+    return throttling
+
+
+def get_capture_telemetry(num_frames: int, duration: float, pi: str, parameters: dict = None, stats: dict = None) -> dict:
+    """
+    Summarises a capture from the frames it saved and the stats the capture binary printed.
+    
+    Parameters
+    ----------
+    num_frames : int
+        The total number of frames requested.
+    duration : float
+        The requested duration of capture in seconds.
+    pi : str
+        The hostname of the raspberry pi.
+    parameters : dict
+        Capture parameters forwarded to the capture binary, see get_capture_command.
+    stats : dict
+        The capture stats, see parse_capture_stats. None if the capture failed.
+    
+    Returns
+    ----------
+    telemetry : dict
+        Frames requested and delivered, the gaps in the frame counter of each stream, write latency percentiles,
+        disk throughput, CPU temperature and throttling.
+    """
+    
+    parameters = parameters or {}
+    telemetry = {"raspi" : pi,
+                 "time" : time.time(),
+                 "succeeded" : stats is not None,
+                 "frames_requested" : num_frames,
+                 "duration" : duration,
+                 "fps" : int(parameters.get("fps", fps)),
+                 "streams" : {}}
+    
+    # Frames missing from the hardware frame counter were never delivered by the camera, or were dropped
+    for stream in ["depth", "colour"]:
+        frame_numbers = get_frame_numbers(stream)
+        gaps = [(previous, current) for previous, current in zip(frame_numbers, frame_numbers[1 : ]) if current - previous > 1]
+        telemetry["streams"][stream] = {"frames_delivered" : len(frame_numbers),
+                                        "frame_counter_gaps" : len(gaps),
+                                        "frames_missing" : sum(current - previous - 1 for previous, current in gaps),
+                                        "largest_gap" : max((current - previous - 1 for previous, current in gaps), default=0)}
+    
+    stats = stats or {}
+    telemetry["capture_stats"] = stats
+    telemetry["write_latency_ms"] = {percentile : stats.get("latency_" + percentile + "_ms") for percentile in ["p50", "p95", "p99", "max"]}
+    if stats.get("write_seconds"):
+        telemetry["disk_throughput_mb_s"] = stats["bytes_written"] / stats["write_seconds"] / 1e6
+    else:
+        telemetry["disk_throughput_mb_s"] = None
+    
+    telemetry["cpu_temperature"] = read_cpu_temperature()
+    telemetry["throttling"] = read_throttling()
+    
+    return telemetry
+
+
+def send_telemetry_to_orin(telemetry: dict, session: requests.Session):
+    """
+    Sends the telemetry of a capture to the Jetson Orin Nano. It is sent before the upload is reported as 
+    complete, as the Orin Nano stops receiving once every upload is complete.
+    """
+    
+    if telemetry is None:
+        return
+    
+    # Jetson Orin Nano's IP address
+    url = "http://192.168.249.155:5000/uploads/telemetry"
+    
+    response = session.post(url, json=telemetry)
+    print(f"Uploaded telemetry: {response.status_code} - {response.text}")
+
+
+def capture(num_frames: int, duration: float, pi: str, parameters: dict = None):
     """
     Capture a num_frames amount of frames using capture script.
     
@@ -37,21 +481,179 @@ def capture(num_frames: int, duration: int, pi: str):
     ----------
     num_frames : int
         The total number of frames to capture.
-    duration : int
+    duration : float
         The actual duration of capture in seconds.
     pi : str
         The hostname of the raspberry pi.
+    parameters : dict
+        Capture parameters forwarded to the capture binary, see get_capture_command.
+    
+    Returns
+    ----------
+    stats : dict
+        The capture stats, see parse_capture_stats. None if the capture failed.
     """
     
+    # Send frames to the Orin Nano as they are captured
+    if stream_during_capture:
+        return stream_capture_to_orin(num_frames, duration, pi, session or requests.Session(), parameters)
+    
+    global capture_telemetry
+    
     # Convert num frames to an integer
     total_frames = str(num_frames)
     
+    stats = run_capture(num_frames, pi, parameters)
+    if stats is not None:
+        print("Capture " + total_frames + " frames (" + str(duration) + "s) complete successfully.")
+    else:
+        print("Capture " + total_frames + " frames (" + str(duration) + "s) failed.")
+        
+    # Sent with the upload by send_files_to_orin
+    capture_telemetry = get_capture_telemetry(num_frames, duration, pi, parameters, stats)
+        
+    return stats
+
+
+def post_capture_archive(file_paths: list, pi: str, session: requests.Session) -> bool:
+    """
+    Sends capture files to the Jetson Orin Nano as one streamed tar archive.
+    
+    Parameters
+    ----------
+    file_paths : list
+        Files to send.
+    pi : str
+        The hostname of the raspberry pi.
+    session : requests.Session
+        Session whose connection is reused for every upload.
+    
+    Returns
+    ----------
+    sent : bool
+        True if the Orin Nano accepted the archive.
+    """
+    
+    # Jetson Orin Nano's IP address
+    url = "http://192.168.249.155:5000/uploads/archive"
+    
     try:
-        arguments = [total_frames, pi]
-        subprocess.run(["./capture"] + arguments, check=True)
+        response = session.post(url, data=stream_capture_archive(file_paths, depth_codec, depth_codec_pool),
+                                headers={"Content-Type": "application/x-tar", "X-Raspi-Name": pi})
+    except Exception as error:
+        print(f"Streaming {len(file_paths)} files failed: {error!r}")
+        return False
+    
+    print(f"Streamed {len(file_paths)} files: {response.status_code}")
+    
+    return 200 <= response.status_code < 300
+
+
+def stream_capture_to_orin(num_frames: int, duration: float, pi: str, session: requests.Session, parameters: dict = None,
+                           poll_interval: float = 0.5, retries: int = 3):
+    """
+    Capture a num_frames amount of frames using capture script, sending the frames to the Jetson Orin Nano
+    while the capture is still running. The capture binary reports every file once it is completely written, 
+    and the files reported since the last poll are sent in the next tar archive. Files are only counted as 
+    sent once the Orin Nano accepts their archive, otherwise they are sent again with the next one. Files that
+    cannot be read are skipped. Once the capture ends every remaining file is sent and the Orin Nano is told 
+    how many files there are in total.
+    
+    Parameters
+    ----------
+    num_frames : int
+        The total number of frames to capture.
+    duration : int
+        The actual duration of capture in seconds.
+    pi : str
+        The hostname of the raspberry pi.
+    session : requests.Session
+        Session whose connection is reused for every upload.
+    parameters : dict
+        Capture parameters forwarded to the capture binary, see get_capture_command.
+    poll_interval : float
+        Seconds between sends.
+    retries : int
+        Attempts at sending the remaining files once the capture has ended.
+    
+    Returns
+    ----------
+    stats : dict
+        The capture stats, see parse_capture_stats. None if the capture failed.
+    """
+    
+    # Jetson Orin Nano's IP address
+    url = "http://192.168.249.155:5000/uploads"
+    
+    total_frames = str(num_frames)
+    
+    # Files the capture binary has reported as completely written, appended to by the capture thread
+    saved_files = deque()
+    capture_result = [None]
+    
+    def run():
+        try:
+            capture_result[0] = run_capture(num_frames, pi, parameters, saved_files.append)
+        except Exception as error:
+            print(f"Capture failed: {error!r}")
+    
+    # Capture in the background while the files are sent
+    capture_thread = threading.Thread(target=run)
+    capture_thread.start()
+    
+    sent_files = set()
+    skipped_files = set()
+    unsent_files = []
+    while True:
+        # Check the capture before taking the files, so no file written before it ended is missed
+        capture_running = capture_thread.is_alive()
+        
+        new_files = []
+        while len(saved_files) > 0:
+            new_files.append(saved_files.popleft())
+        
+        # Every file is complete once the capture has ended, including any whose report was missed
+        if not capture_running:
+            new_files.extend(list_capture_files(CAPTURE_FOLDERS))
+        
+        queued_files = sent_files.union(skipped_files, unsent_files)
+        for file_path in new_files:
+            if file_path not in queued_files:
+                unsent_files.append(file_path)
+                queued_files.add(file_path)
+        
+        # A file that cannot be read would fail every archive it is in, so it is left out for good
+        unreadable_files = [file_path for file_path in unsent_files if not os.access(file_path, os.R_OK)]
+        if len(unreadable_files) > 0:
+            print(f"Skipping {len(unreadable_files)} unreadable files: " + ", ".join(unreadable_files))
+            skipped_files.update(unreadable_files)
+            unsent_files = [file_path for file_path in unsent_files if file_path not in skipped_files]
+        
+        if len(unsent_files) > 0 and post_capture_archive(unsent_files, pi, session):
+            sent_files.update(unsent_files)
+            unsent_files = []
+            
+        if not capture_running:
+            if len(unsent_files) == 0 or retries <= 0:
+                break
+            retries -= 1
+        time.sleep(poll_interval)
+        
+    if capture_result[0] is not None:
         print("Capture " + total_frames + " frames (" + str(duration) + "s) complete successfully.")
-    except subprocess.CalledProcessError as e:
-        print(f"Error executing Python script: {e}")
+    else:
+        print("Capture " + total_frames + " frames (" + str(duration) + "s) failed.")
+    if len(unsent_files) > 0:
+        print(f"{len(unsent_files)} files could not be sent.")
+    
+    send_telemetry_to_orin(get_capture_telemetry(num_frames, duration, pi, parameters, capture_result[0]), session)
+    
+    # Tell the Orin Nano the upload is complete, with every file counted so it knows if any are missing
+    file_count = len(sent_files) + len(unsent_files)
+    response = session.post(url + "/complete", json={"raspi": pi, "file_count": file_count})
+    print(f"Upload complete: {response.status_code} - {response.text}")
+    
+    return capture_result[0]
 
 
 """ Getting serial number of connected D455 """   
@@ -88,9 +690,86 @@ def reboot_system():
         print(f"Error rebooting system: {e}")
      
         
+def parse_command(data: bytes) -> tuple:
+    """
+    Parses a command datagram from the Jetson Orin Nano. Commands are JSON objects with the command id, the
+    command, the time it is scheduled to start at and the command's parameters. Plain text commands have no 
+    id or parameters and start immediately.
+    
+    Parameters
+    ----------
+    data : bytes
+        The datagram received.
+    
+    Returns
+    ----------
+    command : tuple
+        (command id, command, start time, parameters), the id and start time are None and the parameters empty 
+        for plain text commands.
+    """
+    
+    message = data.decode().strip()
+    try:
+        command = json.loads(message)
+    except ValueError:
+        return None, message, None, {}
+    
+    if not isinstance(command, dict):
+        return None, message, None, {}
+    
+    return command.get("id"), command.get("command", ""), command.get("start_time"), command.get("parameters") or {}
+
+
+def get_acknowledgement(command_id: str, pi: str, start_time: float) -> bytes:
+    """
+    Gets the acknowledgement of a command sent back to the Jetson Orin Nano, with the seconds the command was 
+    received after its scheduled start, so the Orin Nano can report pis that started late.
+    """
+    
+    late = 0.0 if start_time is None else max(0.0, time.time() - start_time)
+    
+    return json.dumps({"id" : command_id, "raspi" : pi, "late" : late}).encode()
+
+
+def acknowledge_until(sock: socket.socket, command_id: str, pi: str, start_time: float):
+    """
+    Keeps acknowledging copies of a command resent by the Jetson Orin Nano until the command's scheduled start, 
+    in case the first acknowledgement was lost.
+    
+    Parameters
+    ----------
+    sock : socket.socket
+        The socket the command was received on.
+    command_id : str
+        Id of the command.
+    pi : str
+        The hostname of the raspberry pi.
+    start_time : float
+        Scheduled start of the command, as a Unix time. Returns immediately if None.
+    """
+    
+    if start_time is None:
+        return
+    
+    while True:
+        remaining = start_time - time.time()
+        if remaining <= 0:
+            break
+        
+        sock.settimeout(remaining)
+        try:
+            data, addr = sock.recvfrom(1024)
+        except socket.timeout:
+            break
+        
+        if parse_command(data)[0] == command_id:
+            sock.sendto(get_acknowledgement(command_id, pi, start_time), addr)
+
+
 def wait_for_command_from_orin(pi: str) -> str:
     """
-    Waits for broadcast message from Jetson Orin Nano and then executes the commend sent.
+    Waits for broadcast message from Jetson Orin Nano and then executes the commend sent. Every command is 
+    acknowledged to the Orin Nano, and the command is executed at its scheduled start time.
     
     Parameters
     ----------
@@ -103,6 +782,8 @@ def wait_for_command_from_orin(pi: str) -> str:
         The message received from the Orin Nano.
     """
     
+    global last_command_id
+    
     # Port to listen on
     PORT = 5005
     
@@ -123,48 +804,37 @@ def wait_for_command_from_orin(pi: str) -> str:
     command_not_received = True
     while command_not_received:
         data, addr = sock.recvfrom(BUFFER_SIZE)
-        message = data.decode().strip()
-        print(f"Received message: {message} from {addr}")
+        command_id, message, start_time, parameters = parse_command(data)
         
-        # Command handling
-        if message == "CAPTURE_1s":
-            capture(fps*1, 1, pi)
-            command_not_received = False
-            
-        elif message == "CAPTURE_2s":
-            capture(fps*2, 2, pi)
-            command_not_received = False
-            
-        elif message == "CAPTURE_5s":
-            capture(fps*5, 5, pi)
-            command_not_received = False
-            
-        elif message == "CAPTURE_10s":
-            capture(fps*10, 10, pi)
-            command_not_received = False
-            
-        elif message == "CAPTURE_15s":
-            capture(fps*15, 15, pi)
-            command_not_received = False
+        # Acknowledge every copy, the Orin Nano resends the command until each pi has acknowledged it
+        if command_id is not None:
+            sock.sendto(get_acknowledgement(command_id, pi, start_time), addr)
             
-        elif message == "CAPTURE_20s":
-            capture(fps*20, 20, pi)
-            command_not_received = False
-            
-        elif message == "CAPTURE_25s":
-            capture(fps*25, 25, pi)
-            command_not_received = False
+            # Resent copy of a command already executed
+            if command_id == last_command_id:
+                continue
+            last_command_id = command_id
             
-        elif message == "CAPTURE_30s":
-            capture(fps*30, 30, pi)
-            command_not_received = False
-            
-        elif message == "CAPTURE_60s":
-            capture(fps*60, 60, pi)
+        print(f"Received message: {message} from {addr}")
+        
+        # Every pi starts at the same scheduled time rather than whenever the datagram arrived
+        if start_time is not None and time.time() > start_time:
+            print(f"Warning: command received {time.time() - start_time:.2f}s after its scheduled start, starting late")
+        acknowledge_until(sock, command_id, pi, start_time)
+        
+        # Command handling
+        fixed_capture = re.fullmatch(r"CAPTURE_(\d+)s", message)
+        if message == "CAPTURE":
+            # Parameterised capture, the number of frames follows from the duration and frame rate
+            duration = float(parameters.get("duration", 10))
+            capture_fps = int(parameters.get("fps", fps))
+            capture(max(1, round(duration * capture_fps)), duration, pi, parameters)
             command_not_received = False
             
-        elif message == "CAPTURE_100s":
-            capture(fps*100, 100, pi)
+        elif fixed_capture is not None:
+            # Fixed duration capture at the default frame rate
+            duration = int(fixed_capture.group(1))
+            capture(fps*duration, duration, pi)
             command_not_received = False
             
         elif message == "GET_SERIAL":
@@ -185,7 +855,151 @@ def wait_for_command_from_orin(pi: str) -> str:
     return message
 
 
-def send_files_to_orin(send_serial: bool):
+def list_capture_files(folder_paths: list) -> list:
+    """
+    Lists the files in the capture folders.
+    """
+    
+    return [entry.path for folder_path in folder_paths for entry in os.scandir(folder_path) if entry.is_file()]
+
+
+def encode_depth_file(file_path: str, depth_codec: str) -> bytes:
+    """
+    Losslessly compresses a raw Z16 depth frame. Each pixel is replaced by its difference from the previous 
+    pixel, which is small or zero over smooth and empty areas, the low and high bytes of the differences are 
+    split into separate planes, and the planes are compressed with the codec.
+    
+    Parameters
+    ----------
+    file_path : str
+        File path of the .raw depth frame.
+    depth_codec : str
+        Codec to compress with: "zlib", or "zstd" if the zstandard package is installed.
+    
+    Returns
+    ----------
+    encoded : bytes
+        DEPTH_CODEC_MAGIC, the codec id and the compressed planes.
+    """
+    
+    with open(file_path, "rb") as file:
+        depth = np.frombuffer(file.read(), dtype="<u2")
+    
+    # Differences wrap around in uint16, so the Orin Nano can undo them exactly with a cumulative sum
+    delta = np.empty_like(depth)
+    delta[:1] = depth[:1]
+    np.subtract(depth[1:], depth[:-1], out=delta[1:])
+    planes = np.ascontiguousarray(delta.view(np.uint8).reshape(-1, 2).T).tobytes()
+    
+    if depth_codec == "zlib":
+        payload = zlib.compress(planes, 6)
+    elif depth_codec == "zstd":
+        import zstandard
+        payload = zstandard.ZstdCompressor(level=3).compress(planes)
+    else:
+        raise ValueError("Unknown depth codec: " + str(depth_codec))
+    
+    return DEPTH_CODEC_MAGIC + bytes([DEPTH_CODECS[depth_codec]]) + payload
+
+
+def encode_capture_files(file_paths: list, depth_codec: str, executor: ProcessPoolExecutor):
+    """
+    Generator that compresses the depth frames among capture files across a worker pool, keeping the files 
+    in order. Only a few frames per worker are compressed ahead of the one being sent, so memory stays bounded.
+    
+    Parameters
+    ----------
+    file_paths : list
+        Capture files.
+    depth_codec : str
+        Codec to compress .raw depth frames with. Nothing is compressed if None.
+    executor : ProcessPoolExecutor
+        Worker pool the depth frames are compressed in.
+    
+    Returns
+    ----------
+    files : generator
+        (file path, compressed depth frame) for each file, the compressed depth frame is None if the file is 
+        sent as it is.
+    """
+    
+    max_pending = 2 * (os.cpu_count() or 1)
+    pending = deque()
+    for file_path in file_paths:
+        if depth_codec is not None and file_path.endswith(".raw"):
+            pending.append((file_path, executor.submit(encode_depth_file, file_path, depth_codec)))
+        else:
+            pending.append((file_path, None))
+            
+        while len(pending) > max_pending:
+            file_path, future = pending.popleft()
+            yield file_path, None if future is None else future.result()
+            
+    while len(pending) > 0:
+        file_path, future = pending.popleft()
+        yield file_path, None if future is None else future.result()
+
+
+def stream_capture_archive(file_paths: list, depth_codec: str = None, executor: ProcessPoolExecutor = None):
+    """
+    Generator that streams capture files as an uncompressed tar archive. The archive is written by a 
+    separate thread into a pipe as the chunks are read, so it is never held in memory or on disk.
+    
+    Parameters
+    ----------
+    file_paths : list
+        Files to add to the archive. Files are added under their filename only.
+    depth_codec : str
+        Codec to compress .raw depth frames with, they are added with DEPTH_CODEC_EXTENSION appended to 
+        their filename. Depth frames are sent as they are if None.
+    executor : ProcessPoolExecutor
+        Worker pool the depth frames are compressed in. Needed if depth_codec is given.
+    
+    Returns
+    ----------
+    chunks : generator
+        Chunks of the tar archive.
+    """
+    
+    read_fd, write_fd = os.pipe()
+    writer_errors = []
+    
+    def write_archive():
+        try:
+            with os.fdopen(write_fd, "wb") as pipe:
+                with tarfile.open(fileobj=pipe, mode="w|") as archive:
+                    for file_path, encoded in encode_capture_files(file_paths, depth_codec, executor):
+                        if encoded is None:
+                            archive.add(file_path, arcname=os.path.basename(file_path))
+                        else:
+                            info = tarfile.TarInfo(os.path.basename(file_path) + DEPTH_CODEC_EXTENSION)
+                            info.size = len(encoded)
+                            info.mtime = os.path.getmtime(file_path)
+                            archive.addfile(info, io.BytesIO(encoded))
+        except Exception as error:
+            # Raised again by the reader, so a failed archive is never sent as if it were complete
+            writer_errors.append(error)
+    
+    writer = threading.Thread(target=write_archive, daemon=True)
+    writer.start()
+    
+    try:
+        with os.fdopen(read_fd, "rb") as pipe:
+            while True:
+                chunk = pipe.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+    finally:
+        # The read end is closed by now, even if the upload was aborted, so a writer blocked on the full 
+        # pipe fails with a broken pipe instead of waiting forever
+        writer.join()
+        
+    if len(writer_errors) > 0:
+        raise writer_errors[0]
+
+
+def send_files_to_orin(send_serial: bool, session: requests.Session = None, bulk: bool = True):
     """ 
     Use HTTP REST API POST command to send all captured data to Jetson Orin Nano
     
@@ -193,8 +1007,14 @@ def send_files_to_orin(send_serial: bool):
     ----------
     send_serial: bool
         Boolean that informs function what files to send back to Orin Nano.
+    session : requests.Session
+        Session whose connection pool is reused for every upload. A new session is used if not given.
+    bulk : bool
+        Stream the whole capture as one tar archive in a single request, instead of one request per file.
     """
     
+    session = session or requests.Session()
+    
     if send_serial:
         # Jetson Orin Nano's IP address
         url = "http://192.168.249.155:5000/raspi_info"
@@ -205,24 +1025,40 @@ def send_files_to_orin(send_serial: bool):
             with open(filename, "rb") as file:
                 # Send the file with its original name
                 file = {"file": (filename, file)}
-                response = requests.post(url, files=file)
+                response = session.post(url, files=file)
                 
                 # Print response
                 print(f"Uploaded {filename}: {response.status_code} - {response.text}")
                 
+    elif bulk:
+        # Jetson Orin Nano's IP address
+        url = "http://192.168.249.155:5000/uploads/archive"
+        
+        # The archive completes the upload, so the telemetry goes first
+        send_telemetry_to_orin(capture_telemetry, session)
+        
+        # The Orin Nano checks the number of files it unpacks against this
+        file_paths = list_capture_files(CAPTURE_FOLDERS)
+        file_count = len(file_paths)
+        
+        # The generator makes requests send the archive with chunked transfer encoding as it is written
+        try:
+            response = session.post(url, data=stream_capture_archive(file_paths, depth_codec, depth_codec_pool),
+                                    headers={"Content-Type": "application/x-tar", "X-Raspi-Name": pi_name,
+                                             "X-File-Count": str(file_count)})
+        except Exception as error:
+            print(f"Upload of capture archive failed: {error!r}")
+            return
+        
+        # Print response
+        print(f"Uploaded capture archive: {response.status_code} - {response.text}")
+                
     else:
         # Jetson Orin Nano's IP address
         url = "http://192.168.249.155:5000/uploads"
 
-        # List of file paths to send
-        folder_paths_to_Send = [
-            f"colour",
-            f"depth",
-            f"colour_metadata",
-            f"depth_metadata"
-        ]
-
-        for folder_path in folder_paths_to_Send:
+        file_count = 0
+        for folder_path in CAPTURE_FOLDERS:
             for filename in os.listdir(folder_path):
                 file_path = os.path.join(folder_path, filename)
                 
@@ -231,20 +1067,44 @@ def send_files_to_orin(send_serial: bool):
                     with open(file_path, "rb") as file:
                         # Send the file with its original name
                         files = {"file": (filename, file)}
-                        response = requests.post(url, files=files)
+                        response = session.post(url, files=files, headers={"X-Raspi-Name": pi_name})
+                        file_count += 1
                         
                         # Print response
                         print(f"Uploaded {filename}: {response.status_code} - {response.text}")
+                        
+        send_telemetry_to_orin(capture_telemetry, session)
+        
+        # Tell the Orin Nano the upload is complete
+        response = session.post(url + "/complete", json={"raspi": pi_name, "file_count": file_count})
+        print(f"Upload complete: {response.status_code} - {response.text}")
                     
 
 if __name__ == "__main__":
     pi_name = socket.gethostname()
     fps = 15
+    
+    # Send frames to the Orin Nano during capture instead of after it
+    stream_during_capture = False
+    
+    # Compress depth frames for upload with "zlib" or "zstd", or send them uncompressed with None
+    depth_codec = None
+    depth_codec_pool = ProcessPoolExecutor(os.cpu_count()) if depth_codec is not None else None
+    
+    # Keep the camera pipeline running between captures, started here so the first capture is warm too
+    use_capture_daemon = True
+    if use_capture_daemon:
+        get_capture_daemon(pi_name)
+    
+    # Keep the connection to the Orin Nano open between uploads
+    session = requests.Session()
         
     while(True):
+        # Only a capture has telemetry to send
+        capture_telemetry = None
         create_file_directories()
         message = wait_for_command_from_orin(pi_name)
         if message == "GET_SERIAL":
-            send_files_to_orin(True)
-        else:
-            send_files_to_orin(False)
+            send_files_to_orin(True, session)
+        elif not (stream_during_capture and message.startswith("CAPTURE")):
+            send_files_to_orin(False, session)